@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Programmatic API and AWS Lambda handler to enable and disable Detective members.
+
+Sessions, clients, region catalogs and membership snapshots are kept at module level with a time
+to live, so warm invocations in the same process skip the role assumption and discovery calls.
+"""
+__author__ = "Amazon Detective"
+__copyright__ = "Amazon 2020"
+__credits__ = "Amazon Detective"
+__license__ = "Apache"
+__version__ = "1.1.0"
+__maintainer__ = "Amazon Detective"
+__email__ = "detective-demo-requests@amazon.com"
+__status__ = "Production"
+
+import argparse
+import io
+import logging
+import os
+import sys
+import typing
+
+import boto3
+
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_utilities as helper
+from amazon_detective_multiaccount_scripts import disableDetective
+from amazon_detective_multiaccount_scripts import enableDetective
+from amazon_detective_multiaccount_scripts import enableDetectiveMembers
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=FORMAT)
+
+ROLE_SESSION_NAME = "AmazonDetectiveMultiAccountScripts_Api"
+
+# Assumed role credentials last one hour, the sessions are renewed well before that.
+_SESSIONS = helper.TTLCache(ttl=45 * 60)
+_REGIONS = helper.TTLCache(ttl=24 * 60 * 60)
+_MEMBER_SNAPSHOTS = helper.TTLCache(ttl=5 * 60)
+
+
+class CachingSession(helper.ThreadSafeSession):
+    """
+    Wraps an assumed boto3 session so that the clients it creates are reused between invocations,
+    and shared between threads. The clients are kept on the session, so they expire with its credentials.
+    """
+
+    def __init__(self, session: boto3.Session, key: typing.Hashable):
+        super().__init__(session)
+        self._key = key
+
+
+def clear_caches() -> typing.NoReturn:
+    """
+    Drop every cached session, client, region catalog and membership snapshot.
+    """
+    for cache in (_SESSIONS, _REGIONS, _MEMBER_SNAPSHOTS):
+        cache.invalidate()
+
+
+def get_admin_session(admin_account: str, role: str) -> CachingSession:
+    """
+    Get the assumed session in the admin account, assuming the role only if there is no warm one.
+
+    Args:
+        - admin_account: AccountId for Central AWS Account.
+        - role: Role Name to assume in the admin account.
+
+    Returns:
+        Session in the admin account.
+    """
+    return _SESSIONS.get((admin_account, role),
+                         lambda: CachingSession(helper.assume_role(admin_account, role, ROLE_SESSION_NAME), (admin_account, role)))
+
+
+def get_detective_regions(regions: typing.Union[str, typing.List[str]] = None) -> typing.List[str]:
+    """
+    Get the regions to work on: the given ones, or every region where Detective is available.
+
+    Args:
+        - regions: List or comma separated string of regions. (Optional)
+
+    Returns:
+        List of region names.
+    """
+    if regions:
+        return regions.split(',') if isinstance(regions, str) else list(regions)
+    return _REGIONS.get('detective', lambda: boto3.session.Session().get_available_regions('detective'))
+
+
+def get_member_snapshot(admin_session: CachingSession, region: str) -> typing.Dict[str, typing.Dict[str, str]]:
+    """
+    Get the status of every member of the graphs of a region, from the cache when it is warm.
+
+    Args:
+        - admin_session: Session in the admin account returned by get_admin_session().
+        - region: Region name.
+
+    Returns:
+        A dictionary where the key is the graph arn and value is a dictionary of account ID to member status.
+    """
+    def _load():
+        d_client = admin_session.client('detective', region_name=region)
+        return {graph: {x['AccountId']: x['Status'] for x in helper.list_graph_members(d_client, graph)}
+                for graph in helper.get_graphs(d_client)}
+    return _MEMBER_SNAPSHOTS.get((admin_session._key, region), _load)
+
+
+def invalidate_member_snapshots(admin_session: CachingSession, regions: typing.List[str]) -> typing.NoReturn:
+    """
+    Drop the membership snapshots of some regions, so that the next get_member_snapshot() lists the members again.
+
+    Args:
+        - admin_session: Session in the admin account returned by get_admin_session().
+        - regions: Region names.
+    """
+    for region in regions:
+        _MEMBER_SNAPSHOTS.invalidate((admin_session._key, region))
+
+
+def _accounts_to_enable(admin_session: CachingSession, accounts: typing.Dict[str, str],
+                        regions: typing.List[str]) -> typing.Dict[str, str]:
+    # Accounts that are already enabled in the graph of every region don't need any work.
+    snapshots = helper.run_in_parallel(lambda region: get_member_snapshot(admin_session, region), regions)
+    if len(snapshots) != len(regions) or not all(snapshots.values()):
+        return dict(accounts)
+    return {account: email for account, email in accounts.items()
+            if any(members.get(account) != 'ENABLED' for snapshot in snapshots.values() for members in snapshot.values())}
+
+
+def _namespace(admin_account: str, role: str, regions: typing.List[str], **options) -> argparse.Namespace:
+    args = argparse.Namespace(admin_account=admin_account, assume_role=role, skip_prompt=True, disable_email=False,
+                              tags=None, verify_emails=None, account_major_acceptance=False, repair_attempts=0,
+                              delete_graph=False, shards=1, report_file=None, state_file=None, state_max_age=0, organization=False,
+                              enabled_regions=','.join(regions), disabled_regions=','.join(regions))
+    for key, value in options.items():
+        setattr(args, key, value)
+    return args
+
+
+def enable_members(admin_account: str, role: str, accounts: typing.Dict[str, str],
+                   regions: typing.Union[str, typing.List[str]] = None, **options) -> typing.Dict:
+    """
+    Add member accounts to the admin account's behavior graphs, creating the graphs if needed.
+
+    Args:
+        - admin_account: AccountId for Central AWS Account.
+        - role: Role Name to assume in each account.
+        - accounts: A dictionary where the key is account ID and value is email address.
+        - regions: List or comma separated string of regions. All Detective regions if not provided.
+        - options: Any other option of enableDetective.py, e.g. disable_email=True or tags={'Key': 'Value'}.
+
+    Returns:
+        Report with the accounts created, accepted and failed in each region.
+    """
+    detective_regions = get_detective_regions(regions)
+    admin_session = get_admin_session(admin_account, role)
+    args = _namespace(admin_account, role, detective_regions, **options)
+
+    if args.verify_emails:
+        # the mismatches are logged by verify_account_emails()
+        accounts, _ = enableDetective.verify_account_emails(accounts, admin_session, detective_regions,
+                                                            args.verify_emails == 'exclude')
+    accounts = _accounts_to_enable(admin_session, accounts, detective_regions)
+    if not accounts:
+        logging.info('All the accounts are already enabled in every region.')
+        return helper.new_report()
+
+    report = enableDetective.process_accounts_enable_detective(accounts, detective_regions, admin_session, args)
+    invalidate_member_snapshots(admin_session, detective_regions)
+    return report
+
+
+def disable_members(admin_account: str, role: str, accounts: typing.Dict[str, str],
+                    regions: typing.Union[str, typing.List[str]] = None, **options) -> typing.Dict:
+    """
+    Remove member accounts from the admin account's behavior graphs, or delete the graphs with delete_graph=True.
+
+    Args:
+        - admin_account: AccountId for Central AWS Account.
+        - role: Role Name to assume in each account.
+        - accounts: A dictionary where the key is account ID and value is email address.
+        - regions: List or comma separated string of regions. All Detective regions if not provided.
+        - options: Any other option of disableDetective.py, e.g. delete_graph=True.
+
+    Returns:
+        Report with the accounts deleted and failed in each region.
+    """
+    detective_regions = get_detective_regions(regions)
+    admin_session = get_admin_session(admin_account, role)
+    args = _namespace(admin_account, role, detective_regions, **options)
+
+    report = disableDetective.process_accounts_disable_detective(accounts, detective_regions, admin_session, args)
+    invalidate_member_snapshots(admin_session, detective_regions)
+    return report
+
+
+def add_members(admin_account: str, role: str, accounts: typing.Dict[str, str],
+                regions: typing.Union[str, typing.List[str]] = None, disable_email: bool = False, **options) -> typing.Dict:
+    """
+    Fast path to add a few accounts as members in all the regions in parallel. Graphs are not created.
+
+    Args:
+        - admin_account: AccountId for Central AWS Account.
+        - role: Role Name to assume in each account.
+        - accounts: A dictionary where the key is account ID and value is email address.
+        - regions: List or comma separated string of regions. All Detective regions if not provided.
+        - disable_email: Don't send invitation emails to the member accounts.
+        - options: Any other option of the scripts. The fast path has no other option, they are ignored.
+
+    Returns:
+        Report with the accounts created, accepted and failed in each region.
+    """
+    if options:
+        logging.info(f'Options {sorted(options)} are ignored by the fast path.')
+    if not accounts:
+        return helper.new_report()
+    detective_regions = get_detective_regions(regions)
+    admin_session = get_admin_session(admin_account, role)
+
+    report = enableDetectiveMembers.fast_path_enable_members(admin_session, accounts, detective_regions, role, disable_email)
+    invalidate_member_snapshots(admin_session, detective_regions)
+    return report
+
+
+def read_accounts_s3(session: boto3.Session, s3_uri: str) -> typing.Dict[str, str]:
+    """
+    Read the accounts CSV file from S3.
+
+    Args:
+        - session: boto3 session allowed to read the object.
+        - s3_uri: s3://bucket/key of the CSV file.
+
+    Returns:
+        A dictionary where the key is account ID and value is email address.
+    """
+    bucket, _, key = s3_uri[len('s3://'):].partition('/')
+    body = session.client('s3').get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+    return helper.read_accounts_csv(io.StringIO(body))
+
+
+def _event_accounts(event: typing.Dict) -> typing.Dict[str, str]:
+    accounts = event.get('accounts')
+    if isinstance(accounts, list):
+        return {x['AccountId']: x['EmailAddress'] for x in accounts}
+    if accounts:
+        return dict(accounts)
+    s3_uri = event.get('input_s3_uri') or os.environ.get('INPUT_S3_URI')
+    if s3_uri:
+        return read_accounts_s3(boto3.session.Session(), s3_uri)
+    return {}
+
+
+def _created_account(event: typing.Dict) -> typing.Dict[str, str]:
+    # AWS Organizations CreateAccountResult event, delivered by EventBridge from CloudTrail.
+    status = event.get('detail', {}).get('serviceEventDetails', {}).get('createAccountStatus', {})
+    if status.get('state') != 'SUCCEEDED':
+        logging.info(f'Ignoring account creation event with state {status.get("state")}.')
+        return {}
+    account_id = status['accountId']
+    organizations = boto3.session.Session().client('organizations')
+    return {account_id: organizations.describe_account(AccountId=account_id)['Account']['Email']}
+
+
+def lambda_handler(event: typing.Dict, context) -> typing.Dict:
+    """
+    AWS Lambda entry point.
+
+    The event may be an AWS Organizations CreateAccountResult event from EventBridge, in which case the
+    new account is added with the fast path. Otherwise, it may contain:
+        - action: 'enable' (default), 'disable' or 'add' for the fast path.
+        - admin_account, assume_role: default to the ADMIN_ACCOUNT and ASSUME_ROLE environment variables.
+        - regions: list or comma separated string of regions. Defaults to the REGIONS environment variable,
+                   or every Detective region.
+        - accounts: {account ID: email} or [{'AccountId': ..., 'EmailAddress': ...}], or
+        - input_s3_uri: s3://bucket/key of a CSV file. Defaults to the INPUT_S3_URI environment variable.
+        - options: dictionary with any other option of the scripts, e.g. {'disable_email': true}.
+
+    Returns:
+        The report, with the accounts of each outcome and region as sorted lists.
+    """
+    event = event or {}
+    admin_account = event.get('admin_account') or os.environ['ADMIN_ACCOUNT']
+    role = event.get('assume_role') or os.environ['ASSUME_ROLE']
+    regions = event.get('regions') or os.environ.get('REGIONS')
+    options = event.get('options', {})
+
+    if event.get('detail', {}).get('eventName') == 'CreateAccountResult':
+        report = add_members(admin_account, role, _created_account(event), regions, **options)
+    elif event.get('action') == 'add':
+        report = add_members(admin_account, role, _event_accounts(event), regions, **options)
+    elif event.get('action', 'enable') == 'disable':
+        report = disable_members(admin_account, role, _event_accounts(event), regions, **options)
+    else:
+        report = enable_members(admin_account, role, _event_accounts(event), regions, **options)
+
+    return {outcome: {region: sorted(account_ids) for region, account_ids in by_region.items()}
+            for outcome, by_region in report.items()}
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Run deadline and per phase time budgets for the enable and disable scripts.
+
+The scripts check the deadline between calls and before each wait: once the run deadline or the
+budget of a phase is exhausted, the waits are not started, the remaining batches are not sent,
+and the accounts are reported as pending so that the next run can pick up from there. Calls that
+are already in flight are not interrupted.
+
+The phases are discovery (listing the graphs and the members), create, wait (for the invitations
+to propagate), accept and delete. The time of a phase is the wall clock time during which at
+least one thread is in it.
+"""
+__author__ = "Amazon Detective"
+__copyright__ = "Amazon 2020"
+__credits__ = "Amazon Detective"
+__license__ = "Apache"
+__version__ = "1.1.0"
+__maintainer__ = "Amazon Detective"
+__email__ = "detective-demo-requests@amazon.com"
+__status__ = "Production"
+
+import argparse
+import contextlib
+import datetime
+import logging
+import math
+import sys
+import threading
+import time
+import typing
+
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_profile as profiling
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_progress as progress
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_utilities as helper
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=FORMAT)
+
+PHASES = ('discovery', 'create', 'wait', 'accept', 'delete')
+
+
+class DeadlineExceeded(BaseException):
+    """
+    Raised when the run deadline or the budget of a phase is exhausted. Like KeyboardInterrupt, it
+    is not an Exception, so the per region error handling doesn't report it as a failure.
+    """
+
+    def __init__(self, phase: str = None):
+        super().__init__(f'the budget of the {phase} phase is exhausted' if phase else 'the run deadline has passed')
+        self.phase = phase
+
+
+class RunDeadline:
+    """
+    Tracks the run deadline and the time spent in each phase.
+
+    Args:
+        - end_time: Deadline of the run as a POSIX timestamp, or None for no deadline. It is an
+                    absolute time so that the shard processes share the deadline of the run.
+        - budgets: A dictionary where the key is a phase and the value is its budget in seconds.
+    """
+
+    def __init__(self, end_time: float = None, budgets: typing.Dict[str, float] = None):
+        self.end_time = end_time
+        self.budgets = dict(budgets or {})
+        self._lock = threading.Lock()
+        self._spent = {}
+        # phase -> [threads in the phase, monotonic time the first one entered it]
+        self._active = {}
+
+    def spent(self, phase: str) -> float:
+        with self._lock:
+            spent = self._spent.get(phase, 0.0)
+            if phase in self._active:
+                spent += time.monotonic() - self._active[phase][1]
+            return spent
+
+    def remaining(self, phase: str = None) -> float:
+        """
+        Args:
+            - phase: Also take the budget of this phase into account.
+
+        Returns:
+            Seconds left before the deadline or the end of the budget, math.inf if unbounded.
+        """
+        remaining = math.inf if self.end_time is None else self.end_time - time.time()
+        if phase in self.budgets:
+            remaining = min(remaining, self.budgets[phase] - self.spent(phase))
+        return remaining
+
+    def expired(self, phase: str = None) -> bool:
+        return self.remaining(phase) <= 0
+
+    def check(self, phase: str = None) -> typing.NoReturn:
+        """
+        Raises:
+            DeadlineExceeded if the deadline has passed or the budget of the phase is exhausted.
+        """
+        if self.end_time is not None and time.time() >= self.end_time:
+            raise DeadlineExceeded()
+        if phase in self.budgets and self.expired(phase):
+            raise DeadlineExceeded(phase)
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> typing.Iterator[typing.NoReturn]:
+        """
+        Count the time spent in the block in the phase, after checking that there is time left for it.
+        """
+        self.check(name)
+        with self._lock:
+            entry = self._active.setdefault(name, [0, time.monotonic()])
+            entry[0] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                entry[0] -= 1
+                if not entry[0]:
+                    del self._active[name]
+                    self._spent[name] = self._spent.get(name, 0.0) + time.monotonic() - entry[1]
+
+    def sleep(self, seconds: float, phase: str = 'wait') -> typing.NoReturn:
+        """
+        Sleep, unless the deadline or the budget of the phase would be exhausted before the end of the sleep.
+
+        Raises:
+            DeadlineExceeded instead of starting a sleep that can't complete.
+        """
+        if self.remaining(phase) < seconds:
+            self.check(phase)
+            raise DeadlineExceeded(phase if self.remaining() >= seconds else None)
+        with self.phase(phase):
+            time.sleep(seconds)
+
+
+_DEADLINE = RunDeadline()
+
+
+def activate(end_time: float = None, budgets: typing.Dict[str, float] = None) -> RunDeadline:
+    """
+    Set the deadline and the phase budgets of the run.
+
+    Args:
+        - end_time: Deadline of the run as a POSIX timestamp, or None for no deadline.
+        - budgets: A dictionary where the key is a phase and the value is its budget in seconds.
+
+    Returns:
+        The active deadline.
+    """
+    global _DEADLINE
+    _DEADLINE = RunDeadline(end_time, budgets)
+    return _DEADLINE
+
+
+def activate_from_args(args: argparse.Namespace) -> RunDeadline:
+    """
+    Set the deadline and the phase budgets from the --deadline and --phase_budget arguments.
+    """
+    return activate(getattr(args, 'deadline', None), dict(getattr(args, 'phase_budget', None) or []))
+
+
+def deactivate() -> typing.NoReturn:
+    activate()
+
+
+def remaining(phase: str = None) -> float:
+    return _DEADLINE.remaining(phase)
+
+
+def expired(phase: str = None) -> bool:
+    return _DEADLINE.expired(phase)
+
+
+def exhausted(phases: typing.Iterable[str]) -> bool:
+    """
+    Returns:
+        True if the deadline has passed or the budget of any of the phases is exhausted.
+    """
+    return _DEADLINE.expired() or any(_DEADLINE.expired(name) for name in phases)
+
+
+def check(phase: str = None) -> typing.NoReturn:
+    _DEADLINE.check(phase)
+
+
+def phase(name: str) -> typing.ContextManager:
+    return _DEADLINE.phase(name)
+
+
+def sleep(seconds: float, phase: str = 'wait') -> typing.NoReturn:
+    if phase != 'wait':
+        _DEADLINE.sleep(seconds, phase)
+        return
+    progress.start_wait()
+    try:
+        with profiling.timer('wait'):
+            _DEADLINE.sleep(seconds, phase)
+    finally:
+        progress.end_wait()
+
+
+def _deadline_type(val: str) -> float:
+    """
+    A number of minutes from now, or an ISO 8601 time, e.g. 2026-10-19T22:00:00+00:00.
+    """
+    try:
+        return time.time() + float(val) * 60
+    except ValueError:
+        pass
+    try:
+        end = datetime.datetime.fromisoformat(val)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{val} is neither a number of minutes nor an ISO 8601 time')
+    return end.timestamp()
+
+
+def _phase_budget_type(val: str) -> typing.Tuple[str, float]:
+    name, _, minutes = val.partition('=')
+    if name not in PHASES:
+        raise argparse.ArgumentTypeError(f'{name} is not one of the phases {", ".join(PHASES)}')
+    try:
+        return name, float(minutes) * 60
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{minutes} is not a number of minutes')
+
+
+def add_command_line_arguments(parser: argparse.ArgumentParser) -> typing.NoReturn:
+    """
+    Add the --deadline, --phase_budget and --pending_file arguments to a script.
+
+    Args:
+        - parser: The argument parser of the script.
+    """
+    parser.add_argument('--deadline', type=_deadline_type,
+                        help=('Stop starting new work at this time: a number of minutes from now, or an ISO 8601 time. '
+                              'The accounts not done by then are reported as pending.'))
+    parser.add_argument('--phase_budget', type=_phase_budget_type, action='append',
+                        help=('Budget of a phase in minutes, e.g. wait=30. Can be repeated. '
+                              f'The phases are {", ".join(PHASES)}.'))
+    parser.add_argument('--pending_file', type=str,
+                        help=('Path of a CSV file to write the pending accounts to when the deadline or a budget '
+                              'is exhausted, to be used as the input file of the next run.'))
+
+
+def write_pending(report: typing.Optional[typing.Dict], aws_account_dict: typing.Dict[str, str],
+                  output_file: str = None) -> typing.Set[str]:
+    """
+    Log the pending accounts of a report, and write them in the input file format.
+
+    Args:
+        - report: Report returned by the process functions.
+        - aws_account_dict: A dictionary where the key is account ID and value is email address.
+        - output_file: Path of the CSV file to write, if any.
+
+    Returns:
+        The pending accounts.
+    """
+    pending = (report or {}).get('pending', {})
+    accounts = set().union(*pending.values())
+    if not accounts:
+        return accounts
+    for region, region_accounts in sorted(pending.items()):
+        logging.error(f'{len(region_accounts)} accounts are still pending in {region}.')
+    if output_file:
+        helper.write_accounts_csv({account: aws_account_dict[account] for account in accounts}, output_file)
+    return accounts
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Non-blocking logging setup for the scripts.
+
+The worker threads only put the log records in a queue, and a single listener thread formats and
+writes them. The summary verbosity aggregates the lines about single accounts into one line per
+message, listing the accounts, so the output stays small with thousands of accounts.
+"""
+__author__ = "Amazon Detective"
+__copyright__ = "Amazon 2020"
+__credits__ = "Amazon Detective"
+__license__ = "Apache"
+__version__ = "1.1.0"
+__maintainer__ = "Amazon Detective"
+__email__ = "detective-demo-requests@amazon.com"
+__status__ = "Production"
+
+import argparse
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import re
+import sys
+import typing
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=FORMAT)
+
+# Between INFO and WARNING: the lines that are still written with --log_level summary.
+SUMMARY = 25
+logging.addLevelName(SUMMARY, 'SUMMARY')
+
+ACCOUNT_ID = re.compile(r'\b[0-9]{12}\b')
+
+_LISTENER = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats each record as one JSON object per line.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'message': record.getMessage(),
+                 'process': record.process, 'thread': record.threadName}
+        if getattr(record, 'account_ids', None):
+            entry['account_ids'] = record.account_ids
+        if getattr(record, 'progress', None):
+            entry['progress'] = record.progress
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class AccountAggregatingHandler(logging.Handler):
+    """
+    Collects the INFO and DEBUG lines that mention account IDs, grouped by message with the IDs
+    removed, and writes one SUMMARY line per message when flushed. Other lines are passed through.
+    """
+
+    def __init__(self, target: logging.Handler):
+        super().__init__()
+        self.target = target
+        self._messages = {}
+
+    def emit(self, record: logging.LogRecord) -> typing.NoReturn:
+        message = record.getMessage()
+        account_ids = ACCOUNT_ID.findall(message)
+        if record.levelno >= logging.WARNING or not account_ids:
+            if record.levelno >= self.target.level:
+                self.target.handle(record)
+            return
+        # handle() already holds the handler lock
+        self._messages.setdefault(ACCOUNT_ID.sub('<account>', message), set()).update(account_ids)
+
+    def flush(self) -> typing.NoReturn:
+        self.acquire()
+        try:
+            messages, self._messages = self._messages, {}
+        finally:
+            self.release()
+        for message, account_ids in sorted(messages.items()):
+            account_ids = sorted(account_ids)
+            shown = ', '.join(account_ids[:10]) + (', ...' if len(account_ids) > 10 else '')
+            record = logging.LogRecord('summary', SUMMARY, __file__, 0, f'{message} [{len(account_ids)} accounts: {shown}]',
+                                       None, None)
+            record.account_ids = account_ids
+            self.target.handle(record)
+        self.target.flush()
+
+
+def setup_logging(log_level: str = 'info', log_format: str = 'text', fmt: str = FORMAT,
+                  stream: typing.IO = None) -> logging.handlers.QueueListener:
+    """
+    Replace the handlers of the root logger with a queue, written by a listener thread.
+
+    Args:
+        - log_level: debug, info, or summary to aggregate the lines about single accounts.
+        - log_format: text, or json for one JSON object per line.
+        - fmt: Format of the text lines.
+        - stream: Stream to write to. sys.stdout if not provided.
+
+    Returns:
+        The started listener. stop_logging() stops it, and is also called at exit.
+    """
+    global _LISTENER
+    stop_logging()
+
+    target = logging.StreamHandler(stream or sys.stdout)
+    target.setFormatter(JsonFormatter() if log_format == 'json' else logging.Formatter(fmt))
+    if log_level == 'summary':
+        target.setLevel(SUMMARY)
+        handler = AccountAggregatingHandler(target)
+    else:
+        handler = target
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(logging.DEBUG if log_level == 'debug' else logging.INFO)
+
+    _LISTENER = logging.handlers.QueueListener(records, handler)
+    _LISTENER.start()
+    return _LISTENER
+
+
+def setup_logging_from_args(args: argparse.Namespace, fmt: str = FORMAT,
+                            stream: typing.IO = None) -> logging.handlers.QueueListener:
+    """
+    Set up the logging from the --log_level and --log_format arguments.
+
+    Args:
+        - args: An argparse.Namespace object containing parsed arguments.
+        - fmt: Format of the text lines.
+        - stream: Stream to write to. sys.stdout if not provided.
+
+    Returns:
+        The started listener.
+    """
+    return setup_logging(getattr(args, 'log_level', None) or 'info', getattr(args, 'log_format', None) or 'text',
+                         fmt, stream)
+
+
+def stop_logging() -> typing.NoReturn:
+    """
+    Write the pending records and the aggregated lines, and stop the listener.
+    """
+    global _LISTENER
+    if _LISTENER is None:
+        return
+    _LISTENER.stop()
+    for handler in _LISTENER.handlers:
+        handler.flush()
+    _LISTENER = None
+
+
+def add_command_line_arguments(parser: argparse.ArgumentParser) -> typing.NoReturn:
+    """
+    Add the --log_level and --log_format arguments to a script.
+
+    Args:
+        - parser: The argument parser of the script.
+    """
+    parser.add_argument('--log_level', choices=['debug', 'info', 'summary'], default='info',
+                        help=('summary writes one line per message for all the accounts instead of one line '
+                              'per account, plus warnings and errors.'))
+    parser.add_argument('--log_format', choices=['text', 'json'], default='text',
+                        help='Write the log lines as text or as one JSON object per line.')
+
+
+def log_report_summary(report: typing.Optional[typing.Dict]) -> typing.NoReturn:
+    """
+    Log the number of accounts of each outcome of a report, at SUMMARY level.
+
+    Args:
+        - report: Report returned by the process functions.
+    """
+    for outcome, by_region in sorted((report or {}).items()):
+        accounts = set().union(*by_region.values())
+        logging.log(SUMMARY, f'{outcome}: {len(accounts)} accounts in {len(by_region)} regions.')
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Up-front approval plan for the enable and disable scripts.
+
+Instead of asking for confirmation in the middle of the run, once per region, every decision is
+gathered first: which regions are modified, which graphs are created and with which tags, and
+which members or graphs are deleted. The plan is confirmed once, or written to a file to be
+reviewed and applied later, and the regions are then processed in parallel without prompts.
+
+A plan is a JSON serializable dictionary:
+
+    {"operation": "enable", "accounts": 120, "account_ids": ["111122223333", ...],
+     "regions": {"us-east-1": {"graphs": ["arn:..."], "create_graph": false},
+                 "eu-west-1": {"graphs": [], "create_graph": true, "tags": {"Team": "Security"}}}}
+"""
+__author__ = "Amazon Detective"
+__copyright__ = "Amazon 2020"
+__credits__ = "Amazon Detective"
+__license__ = "Apache"
+__version__ = "1.1.0"
+__maintainer__ = "Amazon Detective"
+__email__ = "detective-demo-requests@amazon.com"
+__status__ = "Production"
+
+import argparse
+import json
+import logging
+import sys
+import typing
+
+import boto3
+
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_utilities as helper
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=FORMAT)
+
+# Number of account IDs shown by describe_plan(), the plan file has all of them.
+DESCRIBED_ACCOUNTS = 10
+
+
+def build_plan(operation: str, aws_account_dict: typing.Dict, detective_regions: typing.List[str],
+               admin_session: boto3.Session, args: argparse.Namespace) -> typing.Dict:
+    """
+    Look up the graphs of every region in parallel and decide what the run will do.
+
+    Args:
+        - operation: enable or disable.
+        - aws_account_dict: A dictionary where the key is account ID and value is email address.
+        - detective_regions: A list of the region names to disable/enable Detective from.
+        - admin_session: Detective client in the specified AWS Account and Region
+        - args: An argparse.Namespace object containing parsed arguments.
+
+    Returns:
+        The plan.
+    """
+    clients = helper.regional_clients(admin_session, detective_regions)
+    graphs = helper.run_in_parallel(lambda region: helper.get_graphs(clients[region]), detective_regions)
+
+    plan = {'operation': operation, 'accounts': len(aws_account_dict), 'account_ids': sorted(aws_account_dict),
+            'regions': {}}
+    for region in detective_regions:
+        if region not in graphs:
+            logging.error(f'Could not list the graphs in {region}, it is left out of the plan.')
+            continue
+        if operation == 'enable':
+            entry = {'graphs': graphs[region], 'create_graph': not graphs[region]}
+            if entry['create_graph'] and getattr(args, 'tags', None):
+                entry['tags'] = args.tags
+        elif graphs[region]:
+            entry = {'graphs': graphs[region], 'delete_graph': bool(getattr(args, 'delete_graph', False))}
+        else:
+            continue
+        plan['regions'][region] = entry
+    return plan
+
+
+def describe_plan(plan: typing.Dict) -> typing.List[str]:
+    """
+    Describe what applying the plan will do.
+
+    Args:
+        - plan: Plan returned by build_plan().
+
+    Returns:
+        A line with the accounts, then one line per region.
+    """
+    accounts = plan['accounts']
+    account_ids = plan.get('account_ids', [])
+    more = f' and {len(account_ids) - DESCRIBED_ACCOUNTS} more' if len(account_ids) > DESCRIBED_ACCOUNTS else ''
+    lines = [f'accounts: {", ".join(account_ids[:DESCRIBED_ACCOUNTS])}{more}']
+    for region, entry in sorted(plan['regions'].items()):
+        graphs = ', '.join(entry['graphs'])
+        if plan['operation'] == 'enable' and entry['create_graph']:
+            tags = f' with tags {entry["tags"]}' if entry.get('tags') else ''
+            lines.append(f'{region}: create a behavior graph{tags} and add {accounts} accounts to it')
+        elif plan['operation'] == 'enable':
+            lines.append(f'{region}: add {accounts} accounts to {graphs}')
+        elif entry['delete_graph']:
+            lines.append(f'{region}: delete {graphs}')
+        else:
+            lines.append(f'{region}: remove {accounts} accounts from {graphs}')
+    return lines
+
+
+def confirm_plan(plan: typing.Dict, skip_prompt: bool) -> bool:
+    """
+    Show the plan and ask for a single confirmation.
+
+    Args:
+        - plan: Plan returned by build_plan().
+        - skip_prompt: Customer agree to skip the prompt and agree to make the change
+
+    Returns:
+        True if the plan is approved.
+    """
+    if not plan['regions']:
+        logging.info('The plan is empty, nothing to do.')
+        return False
+    logging.info('Plan:')
+    for line in describe_plan(plan):
+        logging.info(f'  {line}')
+    if skip_prompt:
+        return True
+    confirm = input('Apply this plan? Enter [Y/N]: ')
+    return confirm == 'Y' or confirm == 'y'
+
+
+def write_plan(plan: typing.Dict, output_file: str) -> typing.NoReturn:
+    """
+    Write the plan as JSON, to be reviewed and applied later with read_plan().
+
+    Args:
+        - plan: Plan returned by build_plan().
+        - output_file: Path of the JSON file.
+    """
+    with open(output_file, 'w') as f:
+        json.dump(plan, f, indent=2, sort_keys=True)
+    logging.info(f'Plan written to {output_file}.')
+
+
+def read_plan(input_file: str, operation: str) -> typing.Dict:
+    """
+    Read a plan written by write_plan().
+
+    Args:
+        - input_file: Path of the JSON file.
+        - operation: enable or disable, the operation the plan must be for.
+
+    Returns:
+        The plan.
+
+    Raises:
+        ValueError if the plan is for another operation.
+    """
+    with open(input_file) as f:
+        plan = json.load(f)
+    if plan.get('operation') != operation:
+        raise ValueError(f'{input_file} is a plan to {plan.get("operation")}, not to {operation}.')
+    return plan
+
+
+def check_plan(plan: typing.Dict, aws_account_dict: typing.Dict, graphs: typing.Dict[str, typing.List[str]]) -> typing.NoReturn:
+    """
+    Make sure the plan still describes the accounts and the graphs it is applied to.
+
+    Args:
+        - plan: Approved plan.
+        - aws_account_dict: A dictionary where the key is account ID and value is email address.
+        - graphs: A dictionary where the key is a region of the plan and value is its current graphs.
+
+    Raises:
+        ValueError if the accounts changed, or if the graphs of a region could not be listed or changed
+        since the plan was built. A graph created by the plan may already exist if the plan is applied again.
+    """
+    if 'account_ids' not in plan:
+        raise ValueError('The plan does not list its accounts, it must be built again.')
+    if sorted(aws_account_dict) != plan['account_ids']:
+        raise ValueError(f'The accounts of the input file are not the {plan["accounts"]} accounts of the plan.')
+    changed = [region for region, entry in sorted(plan['regions'].items())
+               if region not in graphs or (sorted(graphs[region]) != sorted(entry['graphs'])
+                                           and not (entry.get('create_graph') and len(graphs[region]) <= 1))]
+    if changed:
+        raise ValueError(f'The graphs of {", ".join(changed)} could not be listed or changed since the plan was built.')
+
+
+def apply_plan(plan: typing.Dict, aws_account_dict: typing.Dict, admin_session: boto3.Session, args: argparse.Namespace,
+               func: typing.Callable[[typing.Dict, typing.List[str], boto3.Session, argparse.Namespace], typing.Dict],
+               parallel: bool = True) -> typing.Dict:
+    """
+    Create the planned graphs, then process the planned regions without prompts.
+
+    Args:
+        - plan: Approved plan.
+        - aws_account_dict: A dictionary where the key is account ID and value is email address.
+        - admin_session: Detective client in the specified AWS Account and Region
+        - args: An argparse.Namespace object containing parsed arguments.
+        - func: process_accounts_enable_detective() or process_accounts_disable_detective().
+        - parallel: Call func once per region in parallel. Otherwise func is called once with all the
+                    regions that share the same decisions, e.g. when it already runs sharded across processes.
+
+    Returns:
+        The merged report of all the regions.
+
+    Raises:
+        ValueError if the plan doesn't match the accounts or the graphs anymore, see check_plan().
+    """
+    session = helper.ThreadSafeSession(admin_session)
+    regions = sorted(plan['regions'])
+    reports = []
+
+    current = helper.run_in_parallel(lambda region: helper.get_graphs(session.client('detective', region_name=region)), regions)
+    check_plan(plan, aws_account_dict, current)
+
+    def _run_args(region: str) -> argparse.Namespace:
+        # every decision was taken when the plan was approved, and is read from the plan
+        entry = plan['regions'][region]
+        return argparse.Namespace(**dict(vars(args), skip_prompt=True, tags=entry.get('tags'),
+                                         delete_graph=entry.get('delete_graph', False)))
+
+    to_create = [region for region in regions if plan['regions'][region].get('create_graph')]
+
+    def _create_graph(region: str) -> str:
+        tags = plan['regions'][region].get('tags')
+        d_client = session.client('detective', region_name=region)
+        # an approved plan may be applied again, after the graph was created
+        if current[region]:
+            return current[region][0]
+        graph = (d_client.create_graph(Tags=tags) if tags else d_client.create_graph())['GraphArn']
+        logging.info(f'Amazon Detective is enabled in region {region}')
+        return graph
+
+    created = helper.run_in_parallel(_create_graph, to_create)
+    for region in to_create:
+        if region not in created:
+            report = helper.new_report()
+            helper.add_to_report(report, 'failed', region, aws_account_dict.keys())
+            reports.append(report)
+            regions.remove(region)
+
+    if not parallel:
+        groups = {}
+        for region in regions:
+            run_args = _run_args(region)
+            groups.setdefault(json.dumps([run_args.tags, run_args.delete_graph], sort_keys=True), (run_args, []))[1].append(region)
+        for run_args, group in groups.values():
+            reports.append(func(aws_account_dict, group, session, run_args))
+        return helper.merge_reports(reports)
+
+    results = helper.run_in_parallel(lambda region: func(aws_account_dict, [region], session, _run_args(region)), regions)
+    for region in regions:
+        if region in results:
+            reports.append(results[region] or helper.new_report())
+        else:
+            report = helper.new_report()
+            helper.add_to_report(report, 'failed', region, aws_account_dict.keys())
+            reports.append(report)
+    return helper.merge_reports(reports)
+
+
+def add_command_line_arguments(parser: argparse.ArgumentParser) -> typing.NoReturn:
+    """
+    Add the --plan, --plan_file and --approved_plan arguments to a script.
+
+    Args:
+        - parser: The argument parser of the script.
+    """
+    parser.add_argument('--plan', action='store_true',
+                        help=('Gather every decision first and ask for a single confirmation of the whole plan '
+                              '(or none with --skip_prompt), then process the regions in parallel.'))
+    parser.add_argument('--plan_file', type=str,
+                        help='With --plan, write the plan to this JSON file and stop instead of applying it.')
+    parser.add_argument('--approved_plan', type=str,
+                        help='Apply a plan written earlier with --plan_file, without any prompt.')
+
+
+def run_with_plan(operation: str, aws_account_dict: typing.Dict, detective_regions: typing.List[str],
+                  admin_session: boto3.Session, args: argparse.Namespace,
+                  func: typing.Callable[[typing.Dict, typing.List[str], boto3.Session, argparse.Namespace], typing.Dict],
+                  parallel: bool = True) -> typing.Optional[typing.Dict]:
+    """
+    Build or read the plan, get it approved, and apply it.
+
+    Args:
+        - operation: enable or disable.
+        - aws_account_dict: A dictionary where the key is account ID and value is email address.
+        - detective_regions: A list of the region names to disable/enable Detective from.
+        - admin_session: Detective client in the specified AWS Account and Region
+        - args: An argparse.Namespace object containing parsed arguments.
+        - func: process_accounts_enable_detective() or process_accounts_disable_detective().
+        - parallel: See apply_plan().
+
+    Returns:
+        The report, or None if the plan was written to a file or not approved.
+    """
+    if args.approved_plan:
+        plan = read_plan(args.approved_plan, operation)
+    else:
+        plan = build_plan(operation, aws_account_dict, detective_regions, admin_session, args)
+        if args.plan_file:
+            write_plan(plan, args.plan_file)
+            for line in describe_plan(plan):
+                logging.info(f'  {line}')
+            return None
+        if not confirm_plan(plan, args.skip_prompt):
+            logging.info('Execution finished without modifying any member.')
+            return None
+    return apply_plan(plan, aws_account_dict, admin_session, args, func, parallel)
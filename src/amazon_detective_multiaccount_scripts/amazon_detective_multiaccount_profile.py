@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Profiling mode of the enable and disable scripts.
+
+With --profile, the run is wrapped in a profiler:
+
+- sampling (the default) samples the stacks of every thread and writes them in the folded format
+  read by flamegraph.pl, speedscope and most flame graph tools, one "frame;frame;frame count" line
+  per stack;
+- deterministic runs cProfile on the main thread and writes a pstats file, read by snakeviz or
+  flameprof.
+
+The orchestration phases also get wall clock and CPU timers, logged at the end of the run. The
+difference between the two is the time spent waiting on the network or sleeping.
+"""
+__author__ = "Amazon Detective"
+__copyright__ = "Amazon 2020"
+__credits__ = "Amazon Detective"
+__license__ = "Apache"
+__version__ = "1.1.0"
+__maintainer__ = "Amazon Detective"
+__email__ = "detective-demo-requests@amazon.com"
+__status__ = "Production"
+
+import argparse
+import atexit
+import collections
+import contextlib
+import cProfile
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+import typing
+
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_logging as logs
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=FORMAT)
+
+
+class PhaseTimers:
+    """
+    Wall clock and CPU time of each phase, summed over the calls and the threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> [calls, wall seconds, cpu seconds]
+        self._timers = {}
+
+    @contextlib.contextmanager
+    def timer(self, name: str) -> typing.Iterator[typing.NoReturn]:
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+            with self._lock:
+                entry = self._timers.setdefault(name, [0, 0.0, 0.0])
+                entry[0] += 1
+                entry[1] += wall
+                entry[2] += cpu
+
+    def summary(self) -> typing.Dict[str, typing.Dict[str, float]]:
+        with self._lock:
+            return {name: {'calls': calls, 'wall': wall, 'cpu': cpu}
+                    for name, (calls, wall, cpu) in sorted(self._timers.items())}
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all the threads every interval seconds, from a daemon thread.
+
+    Args:
+        - interval: Seconds between two samples.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    @staticmethod
+    def _frame_name(frame) -> str:
+        code = frame.f_code
+        return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+    def sample(self) -> typing.NoReturn:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self._thread.ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            # the thread pools name their threads e.g. ThreadPoolExecutor-0_3, grouped by pool
+            stack.append(names.get(ident, 'thread').rsplit('_', 1)[0])
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def _run(self) -> typing.NoReturn:
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def start(self) -> 'SamplingProfiler':
+        self._thread.start()
+        return self
+
+    def stop(self) -> typing.NoReturn:
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def write(self, output_file: str) -> typing.NoReturn:
+        """
+        Write the samples in the folded stacks format.
+        """
+        with open(output_file, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f'{stack} {count}\n')
+
+
+_TIMERS = None
+_PROFILER = None
+_OUTPUT = None
+
+
+def activate(output_file: str, mode: str = 'sampling', interval: float = 0.005) -> PhaseTimers:
+    """
+    Start the profiler and the phase timers. They are stopped and written by finish(), which is
+    also called at exit.
+
+    Args:
+        - output_file: Path of the folded stacks file, or of the pstats file in deterministic mode.
+        - mode: sampling or deterministic.
+        - interval: Seconds between two samples in sampling mode.
+
+    Returns:
+        The phase timers.
+    """
+    global _TIMERS, _PROFILER, _OUTPUT
+    finish()
+    _TIMERS = PhaseTimers()
+    _OUTPUT = output_file
+    if mode == 'deterministic':
+        _PROFILER = cProfile.Profile()
+        _PROFILER.enable()
+    else:
+        _PROFILER = SamplingProfiler(interval).start()
+    return _TIMERS
+
+
+def activate_from_args(args: argparse.Namespace, suffix: str = '') -> typing.NoReturn:
+    """
+    Start profiling from the --profile, --profile_mode and --profile_interval arguments.
+
+    Args:
+        - args: An argparse.Namespace object containing parsed arguments.
+        - suffix: Added to the output file name, e.g. by each shard process.
+    """
+    if getattr(args, 'profile', None):
+        activate(args.profile + suffix, getattr(args, 'profile_mode', 'sampling'),
+                 getattr(args, 'profile_interval', 0.005))
+
+
+def finish() -> typing.Optional[typing.Dict[str, typing.Dict[str, float]]]:
+    """
+    Stop the profiler, write its output and log the phase timers.
+
+    Returns:
+        The phase timers summary, or None if profiling was not active.
+    """
+    global _TIMERS, _PROFILER, _OUTPUT
+    if _TIMERS is None:
+        return None
+    if isinstance(_PROFILER, cProfile.Profile):
+        _PROFILER.disable()
+        _PROFILER.dump_stats(_OUTPUT)
+    else:
+        _PROFILER.stop()
+        _PROFILER.write(_OUTPUT)
+    logging.log(logs.SUMMARY, f'Profile written to {_OUTPUT}.')
+    summary = _TIMERS.summary()
+    for name, entry in summary.items():
+        logging.log(logs.SUMMARY, f'{name}: {entry["calls"]} calls, {entry["wall"]:.3f}s wall clock, '
+                                  f'{entry["cpu"]:.3f}s CPU, {max(entry["wall"] - entry["cpu"], 0):.3f}s waiting.')
+    _TIMERS = _PROFILER = _OUTPUT = None
+    return summary
+
+
+def timer(name: str) -> typing.ContextManager:
+    """
+    Time a block as the given phase, when profiling.
+    """
+    if _TIMERS is None:
+        return contextlib.nullcontext()
+    return _TIMERS.timer(name)
+
+
+def timed(name: str) -> typing.Callable[[typing.Callable], typing.Callable]:
+    """
+    Decorator timing each call of a function as the given phase, when profiling.
+    """
+    def decorator(func: typing.Callable) -> typing.Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _TIMERS is None:
+                return func(*args, **kwargs)
+            with _TIMERS.timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_command_line_arguments(parser: argparse.ArgumentParser) -> typing.NoReturn:
+    """
+    Add the --profile, --profile_mode and --profile_interval arguments to a script.
+
+    Args:
+        - parser: The argument parser of the script.
+    """
+    parser.add_argument('--profile', type=str,
+                        help=('Profile the run and write the profile to this file: folded stacks for flame graph tools, '
+                              'or a pstats file with --profile_mode deterministic. The time of each phase is logged.'))
+    parser.add_argument('--profile_mode', choices=['sampling', 'deterministic'], default='sampling',
+                        help='Sample the stacks of all the threads, or run cProfile on the main thread.')
+    parser.add_argument('--profile_interval', type=float, default=0.005,
+                        help='Seconds between two samples in sampling mode.')
+
+
+atexit.register(finish)
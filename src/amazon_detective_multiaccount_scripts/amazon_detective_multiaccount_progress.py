@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Progress, throughput and ETA of the enable and disable scripts.
+
+The accounts of each region are units of work that go through phases, e.g. create and accept.
+The process functions only increment counters, and a reporter thread periodically writes a
+status line to the terminal or a log record with the progress as structured data.
+
+The ETA is the remaining accounts times the observed time per account, excluding the time spent
+waiting for the invitations to propagate, plus the remaining batches times the observed wait
+per batch.
+"""
+__author__ = "Amazon Detective"
+__copyright__ = "Amazon 2020"
+__credits__ = "Amazon Detective"
+__license__ = "Apache"
+__version__ = "1.1.0"
+__maintainer__ = "Amazon Detective"
+__email__ = "detective-demo-requests@amazon.com"
+__status__ = "Production"
+
+import argparse
+import logging
+import sys
+import threading
+import time
+import typing
+
+import boto3
+
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_logging as logs
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=FORMAT)
+
+
+class ProgressTracker:
+    """
+    Counts the planned and completed accounts of each phase and region, the batches, the API calls
+    and the time spent waiting.
+    """
+
+    def __init__(self, clock: typing.Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.started = clock()
+        # (phase, region) -> [total, completed]
+        self._units = {}
+        self.batches = [0, 0]
+        self.calls = 0
+        self._waited = 0.0
+        # threads waiting, and when the first one started
+        self._waiting = [0, None]
+
+    def plan(self, phase: str, region: str, units: int) -> typing.NoReturn:
+        with self._lock:
+            self._units.setdefault((phase, region), [0, 0])[0] += units
+
+    def advance(self, phase: str, region: str, units: int) -> typing.NoReturn:
+        with self._lock:
+            self._units.setdefault((phase, region), [0, 0])[1] += units
+
+    def plan_batches(self, batches: int) -> typing.NoReturn:
+        with self._lock:
+            self.batches[0] += batches
+
+    def finish_batch(self) -> typing.NoReturn:
+        with self._lock:
+            self.batches[1] += 1
+
+    def count_call(self, **kwargs) -> typing.NoReturn:
+        # botocore after-call handler; a lost increment between threads would be harmless
+        self.calls += 1
+
+    def start_wait(self) -> typing.NoReturn:
+        with self._lock:
+            if not self._waiting[0]:
+                self._waiting[1] = self._clock()
+            self._waiting[0] += 1
+
+    def end_wait(self) -> typing.NoReturn:
+        with self._lock:
+            self._waiting[0] -= 1
+            if not self._waiting[0]:
+                self._waited += self._clock() - self._waiting[1]
+
+    def snapshot(self) -> typing.Dict:
+        """
+        Returns:
+            The progress of each phase and region, the throughput and the ETA in seconds, or None
+            before the first batch is done.
+        """
+        with self._lock:
+            now = self._clock()
+            elapsed = max(now - self.started, 1e-9)
+            waited = self._waited + (now - self._waiting[1] if self._waiting[0] else 0.0)
+            units = {key: list(value) for key, value in self._units.items()}
+            batches, done_batches = self.batches
+        phases = {}
+        for (phase, region), (total, completed) in sorted(units.items()):
+            entry = phases.setdefault(phase, {'total': 0, 'completed': 0, 'regions': {}})
+            entry['total'] += total
+            entry['completed'] += completed
+            entry['regions'][region] = {'completed': completed, 'remaining': max(total - completed, 0)}
+        total = sum(entry['total'] for entry in phases.values())
+        completed = sum(min(entry['completed'], entry['total']) for entry in phases.values())
+        # an account is done once it went through every phase
+        accounts = min((entry['completed'] for entry in phases.values()), default=0)
+
+        eta = None
+        if completed and done_batches:
+            active_per_unit = max(elapsed - waited, 0.0) / completed
+            wait_per_batch = waited / done_batches
+            eta = (total - completed) * active_per_unit + max(batches - done_batches, 0) * wait_per_batch
+        return {'elapsed': round(elapsed, 1), 'phases': phases, 'accounts_per_minute': round(accounts * 60 / elapsed, 1),
+                'calls_per_second': round(self.calls / elapsed, 2), 'waited': round(waited, 1),
+                'eta': None if eta is None else round(eta, 1)}
+
+
+def describe(snapshot: typing.Dict) -> str:
+    """
+    One line describing a snapshot, e.g. create 150/400 | accept 100/400 | 12.5 accounts/min | 3.1 calls/s | ETA 20m05s
+    """
+    parts = [f'{phase} {entry["completed"]}/{entry["total"]}' for phase, entry in snapshot['phases'].items()]
+    parts.append(f'{snapshot["accounts_per_minute"]} accounts/min')
+    parts.append(f'{snapshot["calls_per_second"]} calls/s')
+    if snapshot['eta'] is not None:
+        minutes, seconds = divmod(int(snapshot['eta']), 60)
+        parts.append(f'ETA {minutes}m{seconds:02d}s')
+    return ' | '.join(parts)
+
+
+class ProgressReporter:
+    """
+    Writes the progress of a tracker every interval seconds from a daemon thread.
+
+    Args:
+        - tracker: Progress to report.
+        - mode: tty to rewrite a status line on the stream, log for a SUMMARY record with a
+                progress attribute, which the JSON log format includes.
+        - interval: Seconds between two reports.
+        - stream: Stream of the tty status line. sys.stderr if not provided.
+    """
+
+    def __init__(self, tracker: ProgressTracker, mode: str = 'log', interval: float = 10.0, stream: typing.IO = None):
+        self.tracker = tracker
+        self.mode = mode
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='progress', daemon=True)
+
+    def start(self) -> 'ProgressReporter':
+        self._thread.start()
+        return self
+
+    def report(self) -> typing.NoReturn:
+        snapshot = self.tracker.snapshot()
+        if self.mode == 'tty':
+            self.stream.write('\r\033[K' + describe(snapshot))
+            self.stream.flush()
+        else:
+            logging.log(logs.SUMMARY, f'Progress: {describe(snapshot)}', extra={'progress': snapshot})
+
+    def _run(self) -> typing.NoReturn:
+        while not self._stopped.wait(self.interval):
+            self.report()
+
+    def stop(self) -> typing.NoReturn:
+        """
+        Stop the thread and write the final progress.
+        """
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.report()
+        if self.mode == 'tty':
+            self.stream.write('\n')
+            self.stream.flush()
+
+
+class _NoProgress:
+    """
+    Tracker used when the progress is not reported: every call is a no-op.
+    """
+
+    def __getattr__(self, name: str) -> typing.Callable:
+        return lambda *args, **kwargs: None
+
+
+_TRACKER = _NoProgress()
+_REPORTER = None
+
+
+def activate(mode: str, interval: float = 10.0, stream: typing.IO = None) -> ProgressTracker:
+    """
+    Track the progress of the run and report it.
+
+    Args:
+        - mode: tty or log, see ProgressReporter.
+        - interval: Seconds between two reports.
+        - stream: Stream of the tty status line.
+
+    Returns:
+        The tracker.
+    """
+    global _TRACKER, _REPORTER
+    deactivate()
+    _TRACKER = ProgressTracker()
+    _REPORTER = ProgressReporter(_TRACKER, mode, interval, stream).start()
+    return _TRACKER
+
+
+def activate_from_args(args: argparse.Namespace) -> typing.NoReturn:
+    """
+    Track the progress from the --progress and --progress_interval arguments.
+    """
+    mode = getattr(args, 'progress', None)
+    if mode == 'auto':
+        mode = 'tty' if sys.stderr.isatty() else 'log'
+    if mode in ('tty', 'log'):
+        activate(mode, getattr(args, 'progress_interval', 10.0))
+
+
+def deactivate() -> typing.NoReturn:
+    """
+    Write the final progress and stop tracking.
+    """
+    global _TRACKER, _REPORTER
+    if _REPORTER is not None:
+        _REPORTER.stop()
+    _TRACKER = _NoProgress()
+    _REPORTER = None
+
+
+def instrument(session: boto3.Session) -> boto3.Session:
+    """
+    Count the API calls of the clients created from the session afterwards.
+
+    Args:
+        - session: boto3 session.
+
+    Returns:
+        The session.
+    """
+    if isinstance(_TRACKER, ProgressTracker):
+        session.events.register('after-call', _TRACKER.count_call, unique_id='progress-call')
+    return session
+
+
+class Batch:
+    """
+    A batch of accounts in a region going through phases. The phases the batch did not reach,
+    e.g. after an error, are counted as completed when it is closed, so the remaining work only
+    counts the batches still to be processed.
+
+    Args:
+        - region: Region of the batch.
+        - units: Number of accounts.
+        - phases: Phases of the batch, in order.
+    """
+
+    def __init__(self, region: str, units: int, phases: typing.Iterable[str]):
+        self.region = region
+        self.units = units
+        self.pending = list(phases)
+
+    def done(self, phase: str) -> typing.NoReturn:
+        if phase in self.pending:
+            self.pending.remove(phase)
+            _TRACKER.advance(phase, self.region, self.units)
+
+    def close(self) -> typing.NoReturn:
+        for phase in self.pending:
+            _TRACKER.advance(phase, self.region, self.units)
+        self.pending = []
+        _TRACKER.finish_batch()
+
+
+def batch(region: str, units: int, phases: typing.Iterable[str]) -> Batch:
+    return Batch(region, units, phases)
+
+
+def plan_run(aws_account_dict: typing.Dict, detective_regions: typing.List[str], phases: typing.Iterable[str],
+             batch_size: int = 50) -> typing.NoReturn:
+    """
+    Plan the accounts of every region in every phase, processed in batches of batch_size.
+    """
+    phases = list(phases)
+    for region in detective_regions:
+        for phase in phases:
+            _TRACKER.plan(phase, region, len(aws_account_dict))
+    _TRACKER.plan_batches(len(detective_regions) * -(-len(aws_account_dict) // batch_size))
+
+
+def start_wait() -> typing.NoReturn:
+    _TRACKER.start_wait()
+
+
+def end_wait() -> typing.NoReturn:
+    _TRACKER.end_wait()
+
+
+def add_command_line_arguments(parser: argparse.ArgumentParser) -> typing.NoReturn:
+    """
+    Add the --progress and --progress_interval arguments to a script.
+
+    Args:
+        - parser: The argument parser of the script.
+    """
+    parser.add_argument('--progress', choices=['off', 'auto', 'tty', 'log'], default='off',
+                        help=('Report the completed and remaining accounts, the throughput and the ETA: as a status line '
+                              'on the terminal (tty), as log records (log), or tty when running in a terminal (auto).'))
+    parser.add_argument('--progress_interval', type=float, default=10.0,
+                        help='Seconds between two progress reports.')
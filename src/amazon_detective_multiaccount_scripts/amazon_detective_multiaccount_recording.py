@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Record and replay the API traffic of a run.
+
+--record writes every Detective and STS call of a run, with its parameters, response and timing,
+to a JSON lines file, with the credentials scrubbed. --replay serves the calls of a later run from
+such a file instead of sending them to AWS, at the recorded speed or faster, so that the API calls
+and the wall clock time of two versions of the scripts can be compared offline on real data.
+
+Both are botocore event handlers, registered on the sessions created by the scripts:
+before-parameter-build and after-call to record, and before-call, which short-circuits the
+request when a handler returns a response, to replay.
+
+A recorded call is matched by service, operation, region and parameters, lists being compared
+regardless of their order. When no call with the same parameters is left, the next call of the
+same operation in the same region is used, as the new version may batch the accounts differently.
+"""
+__author__ = "Amazon Detective"
+__copyright__ = "Amazon 2020"
+__credits__ = "Amazon Detective"
+__license__ = "Apache"
+__version__ = "1.1.0"
+__maintainer__ = "Amazon Detective"
+__email__ = "detective-demo-requests@amazon.com"
+__status__ = "Production"
+
+import argparse
+import atexit
+import collections
+import copy
+import datetime
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import typing
+
+import boto3
+import botocore.awsrequest
+import botocore.exceptions
+
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_logging as logs
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=FORMAT)
+
+# Keys whose values are replaced in the recording, wherever they appear.
+SECRET_KEYS = frozenset(['AccessKeyId', 'SecretAccessKey', 'SessionToken', 'Password'])
+REDACTED = 'REDACTED'
+
+FORMAT_VERSION = 1
+
+
+def scrub(value: typing.Any) -> typing.Any:
+    """
+    Copy a request or response, replacing the credentials.
+    """
+    if isinstance(value, dict):
+        return {k: REDACTED if k in SECRET_KEYS else scrub(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [scrub(v) for v in value]
+    return value
+
+
+def _encode(value: typing.Any) -> typing.Any:
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def _decode(value: typing.Dict) -> typing.Any:
+    if '__datetime__' in value:
+        return datetime.datetime.fromisoformat(value['__datetime__'])
+    return value
+
+
+def _canonical(value: typing.Any) -> str:
+    def _sorted(value):
+        if isinstance(value, dict):
+            return {k: _sorted(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return sorted((_sorted(v) for v in value), key=lambda v: json.dumps(v, sort_keys=True, default=str))
+        return value
+    return json.dumps(_sorted(value), sort_keys=True, default=str)
+
+
+class Recorder:
+    """
+    Writes the calls made by the instrumented sessions to a JSON lines file.
+
+    Args:
+        - output_file: Path of the file to write.
+    """
+
+    def __init__(self, output_file: str):
+        self.output_file = output_file
+        self._lock = threading.Lock()
+        # line buffered, so that no pending line is duplicated in forked worker processes
+        self._file = open(output_file, 'w', buffering=1)
+        self._started = time.monotonic()
+        self.calls = 0
+        self._write({'format': FORMAT_VERSION, 'recorded_at': datetime.datetime.now(datetime.timezone.utc).isoformat()})
+
+    def _write(self, entry: typing.Dict) -> typing.NoReturn:
+        line = json.dumps(entry, sort_keys=True, default=_encode)
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def instrument(self, session: boto3.Session) -> typing.NoReturn:
+        session.events.register('before-parameter-build', self._before_parameter_build, unique_id='record-params')
+        session.events.register('after-call', self._after_call, unique_id='record-call')
+        session.events.register('after-call-error', self._after_call_error, unique_id='record-error')
+
+    def _before_parameter_build(self, params: typing.Dict, model, context: typing.Dict, **kwargs) -> typing.NoReturn:
+        context['recording'] = {'service': model.service_model.service_name, 'operation': model.name,
+                                'region': context.get('client_region'), 'params': scrub(params),
+                                'thread': threading.current_thread().name,
+                                'start': time.monotonic()}
+
+    def _finish(self, context: typing.Dict, **result) -> typing.NoReturn:
+        entry = context.pop('recording', None)
+        if entry is None:
+            return
+        now = time.monotonic()
+        entry['duration'] = round(now - entry['start'], 6)
+        entry['start'] = round(entry['start'] - self._started, 6)
+        entry.update(result)
+        with self._lock:
+            self.calls += 1
+        self._write(entry)
+
+    def _after_call(self, http_response, parsed: typing.Dict, context: typing.Dict, **kwargs) -> typing.NoReturn:
+        self._finish(context, status=http_response.status_code, response=scrub(parsed))
+
+    def _after_call_error(self, exception: Exception, context: typing.Dict, **kwargs) -> typing.NoReturn:
+        error = getattr(exception, 'response', None) or {}
+        self._finish(context, error={'type': type(exception).__name__,
+                                     'code': error.get('Error', {}).get('Code') or type(exception).__name__,
+                                     'message': error.get('Error', {}).get('Message') or str(exception)})
+
+    def close(self) -> typing.NoReturn:
+        with self._lock:
+            self._file.close()
+        logging.log(logs.SUMMARY, f'Recorded {self.calls} calls to {self.output_file}.')
+
+
+class ReplayMismatch(Exception):
+    """
+    Raised for a call that is not in the recording.
+    """
+
+
+class Replayer:
+    """
+    Serves the calls of the instrumented sessions from a recording.
+
+    Args:
+        - input_file: Path of a file written by Recorder.
+        - speed: 1 to take as long as the recorded calls, 10 to be ten times faster, 0 not to wait.
+    """
+
+    def __init__(self, input_file: str, speed: float = 1.0):
+        self.input_file = input_file
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        with open(input_file) as f:
+            header = json.loads(f.readline())
+            if header.get('format') != FORMAT_VERSION:
+                raise ValueError(f'{input_file} is not a recording of format {FORMAT_VERSION}.')
+            self.entries = [json.loads(line, object_hook=_decode) for line in f if line.strip()]
+        self._exact = collections.defaultdict(collections.deque)
+        self._loose = collections.defaultdict(collections.deque)
+        for index, entry in enumerate(self.entries):
+            key = (entry['service'], entry['operation'], entry['region'])
+            self._exact[key + (_canonical(entry['params']),)].append(index)
+            self._loose[key].append(index)
+        self._used = set()
+        self.replayed = collections.Counter()
+        self.mismatches = collections.Counter()
+
+    def instrument(self, session: boto3.Session) -> typing.NoReturn:
+        session.events.register('before-parameter-build', self._before_parameter_build, unique_id='replay-params')
+        session.events.register('before-call', self._before_call, unique_id='replay-call')
+
+    def _before_parameter_build(self, params: typing.Dict, context: typing.Dict, **kwargs) -> typing.NoReturn:
+        context['replay_params'] = copy.deepcopy(params)
+
+    def _take(self, queue: typing.Deque[int]) -> typing.Optional[int]:
+        while queue:
+            index = queue.popleft()
+            if index not in self._used:
+                self._used.add(index)
+                return index
+        return None
+
+    def _before_call(self, model, context: typing.Dict, **kwargs) -> typing.Tuple[botocore.awsrequest.AWSResponse, typing.Dict]:
+        key = (model.service_model.service_name, model.name, context.get('client_region'))
+        params = scrub(context.pop('replay_params', {}))
+        with self._lock:
+            index = self._take(self._exact[key + (_canonical(params),)])
+            if index is None:
+                index = self._take(self._loose[key])
+            if index is None:
+                self.mismatches[f'{key[0]}.{key[1]}'] += 1
+            else:
+                self.replayed[f'{key[0]}.{key[1]}'] += 1
+        if index is None:
+            raise ReplayMismatch(f'{key[0]}.{key[1]} in {key[2]} with {params} is not in the recording')
+
+        entry = self.entries[index]
+        if self.speed:
+            time.sleep(entry['duration'] / self.speed)
+        if 'error' in entry:
+            # the scripts handle the errors by their code, whatever the exception that carried it
+            error = entry['error']
+            raise botocore.exceptions.ClientError({'Error': {'Code': error.get('code', error['type']), 'Message': error['message']}},
+                                                  model.name)
+        return botocore.awsrequest.AWSResponse(None, entry['status'], {}, None), copy.deepcopy(entry['response'])
+
+    def summary(self) -> typing.Dict:
+        """
+        Returns:
+            The replayed, recorded and unexpected calls of each operation, and the wall clock time
+            of the recorded run and of the replay.
+        """
+        recorded = collections.Counter(f'{entry["service"]}.{entry["operation"]}' for entry in self.entries)
+        ends = [entry['start'] + entry['duration'] for entry in self.entries]
+        return {'operations': {operation: {'recorded': recorded[operation], 'replayed': self.replayed[operation],
+                                           'mismatched': self.mismatches[operation]}
+                               for operation in sorted(set(recorded) | set(self.mismatches))},
+                'recorded_seconds': round(max(ends, default=0.0), 3),
+                'replay_seconds': round(time.monotonic() - self._started, 3)}
+
+    def close(self) -> typing.NoReturn:
+        summary = self.summary()
+        for operation, counts in summary['operations'].items():
+            logging.log(logs.SUMMARY, f'{operation}: {counts["replayed"]} calls replayed of {counts["recorded"]} recorded, '
+                                      f'{counts["mismatched"]} not in the recording.')
+        logging.log(logs.SUMMARY, f'The recorded calls took {summary["recorded_seconds"]}s, '
+                                  f'the replay {summary["replay_seconds"]}s.')
+
+
+_ACTIVE = None
+# process that activated the recording or the replay, worker processes inherit it when forked
+_ACTIVE_PID = None
+
+
+def record(output_file: str) -> Recorder:
+    """
+    Record the calls of the sessions instrumented from now on.
+    """
+    global _ACTIVE, _ACTIVE_PID
+    finish()
+    _ACTIVE, _ACTIVE_PID = Recorder(output_file), os.getpid()
+    return _ACTIVE
+
+
+def replay(input_file: str, speed: float = 1.0) -> Replayer:
+    """
+    Serve the calls of the sessions instrumented from now on from a recording.
+    """
+    global _ACTIVE, _ACTIVE_PID
+    finish()
+    _ACTIVE, _ACTIVE_PID = Replayer(input_file, speed), os.getpid()
+    return _ACTIVE
+
+
+def activate_from_args(args: argparse.Namespace, suffix: str = '') -> typing.NoReturn:
+    """
+    Record or replay from the --record, --replay and --replay_speed arguments.
+
+    Args:
+        - args: An argparse.Namespace object containing parsed arguments.
+        - suffix: Added to the file name, e.g. by each shard process.
+    """
+    if getattr(args, 'record', None):
+        record(args.record + suffix)
+    elif getattr(args, 'replay', None):
+        replay(args.replay + suffix, getattr(args, 'replay_speed', 1.0))
+
+
+def instrument(session: boto3.Session) -> boto3.Session:
+    """
+    Record or replay the calls of the clients created from the session afterwards.
+
+    Args:
+        - session: boto3 session.
+
+    Returns:
+        The session.
+    """
+    if _ACTIVE is not None:
+        _ACTIVE.instrument(session)
+    return session
+
+
+def finish() -> typing.NoReturn:
+    """
+    Close the recording, or log how the replay compares to it.
+    """
+    global _ACTIVE
+    if _ACTIVE is not None and _ACTIVE_PID == os.getpid():
+        _ACTIVE.close()
+    _ACTIVE = None
+
+
+def add_command_line_arguments(parser: argparse.ArgumentParser) -> typing.NoReturn:
+    """
+    Add the --record, --replay and --replay_speed arguments to a script.
+
+    Args:
+        - parser: The argument parser of the script.
+    """
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--record', type=str,
+                       help='Record the Detective and STS calls of the run to this file, without the credentials.')
+    group.add_argument('--replay', type=str,
+                       help='Serve the calls from a file written with --record instead of calling AWS.')
+    parser.add_argument('--replay_speed', type=float, default=1.0,
+                        help='With --replay, 1 takes as long as the recorded calls, 10 is ten times faster, 0 does not wait.')
+
+
+atexit.register(finish)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Compact registry of the accounts read from the input file.
+
+With 100k accounts, a dictionary of account ID and email strings costs a few hundred bytes per
+account. The registry keeps the account IDs as integers in a sorted array of unsigned 64 bit
+integers, 8 bytes per account, and the emails in a list aligned with it, deduplicated so that the
+accounts sharing a mailbox share the string.
+
+The registry is a read only mapping of the 12 digit account ID strings to the emails, so it can
+be used wherever the dictionary was. Lookups are binary searches, and the difference with another
+registry or sorted array of account IDs is a merge of the two sorted arrays.
+"""
+__author__ = "Amazon Detective"
+__copyright__ = "Amazon 2020"
+__credits__ = "Amazon Detective"
+__license__ = "Apache"
+__version__ = "1.1.0"
+__maintainer__ = "Amazon Detective"
+__email__ = "detective-demo-requests@amazon.com"
+__status__ = "Production"
+
+import array
+import bisect
+import collections.abc
+import itertools
+import logging
+import sys
+import typing
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=FORMAT)
+
+
+class Account:
+    """
+    An account of the registry.
+    """
+    __slots__ = ('account_id', 'email')
+
+    def __init__(self, account_id: str, email: str):
+        self.account_id = account_id
+        self.email = email
+
+    def __repr__(self) -> str:
+        return f'Account({self.account_id!r}, {self.email!r})'
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Account) and (self.account_id, self.email) == (other.account_id, other.email)
+
+
+def account_id_array(account_ids: typing.Iterable[typing.Union[str, int]]) -> array.array:
+    """
+    Args:
+        - account_ids: Account IDs, as strings or integers.
+
+    Returns:
+        The distinct account IDs as a sorted array of integers.
+    """
+    return array.array('Q', sorted({int(x) for x in account_ids}))
+
+
+def _format(account_id: int) -> str:
+    return f'{account_id:012d}'
+
+
+class AccountRegistry(collections.abc.Mapping):
+    """
+    Read only mapping of account ID to email address, stored as a sorted array of integer account
+    IDs and a list of deduplicated emails.
+
+    Args:
+        - ids: Sorted array of distinct account IDs.
+        - emails: Email address of each account ID.
+    """
+    __slots__ = ('_ids', '_emails')
+
+    def __init__(self, ids: array.array = None, emails: typing.List[str] = None):
+        self._ids = ids if ids is not None else array.array('Q')
+        self._emails = emails if emails is not None else []
+
+    @classmethod
+    def from_pairs(cls, pairs: typing.Iterable[typing.Tuple[typing.Union[str, int], str]]) -> 'AccountRegistry':
+        """
+        Build a registry from account ID and email pairs. When an account ID is repeated, the last
+        email wins, as it would in a dictionary.
+        """
+        ids, emails = array.array('Q'), []
+        # unlike sys.intern(), the strings are only shared while building, nothing stays behind
+        shared = {}
+        for account_id, email in pairs:
+            ids.append(int(account_id))
+            emails.append(shared.setdefault(email, email))
+        del shared
+        # the account IDs have at most 40 bits: the input position goes in the low bits of a single
+        # sort key, so that the repeated account IDs are sorted in input order
+        shift = max(1, len(ids).bit_length())
+        keys = array.array('Q', sorted((account_id << shift) | i for i, account_id in enumerate(ids)))
+        del ids
+        mask = (1 << shift) - 1
+        sorted_ids, sorted_emails = array.array('Q'), []
+        for key in keys:
+            if sorted_ids and sorted_ids[-1] == key >> shift:
+                # the last email of a repeated account ID wins
+                sorted_emails[-1] = emails[key & mask]
+            else:
+                sorted_ids.append(key >> shift)
+                sorted_emails.append(emails[key & mask])
+        return cls(sorted_ids, sorted_emails)
+
+    def _index(self, account_id: typing.Union[str, int]) -> int:
+        try:
+            value = int(account_id)
+        except (TypeError, ValueError):
+            return -1
+        # '12345' is not the account 000000012345
+        if isinstance(account_id, str) and len(account_id) != len(_format(value)):
+            return -1
+        index = bisect.bisect_left(self._ids, value)
+        if index < len(self._ids) and self._ids[index] == value:
+            return index
+        return -1
+
+    def __getitem__(self, account_id: str) -> str:
+        index = self._index(account_id)
+        if index < 0:
+            raise KeyError(account_id)
+        return self._emails[index]
+
+    def __contains__(self, account_id) -> bool:
+        return self._index(account_id) >= 0
+
+    def __iter__(self) -> typing.Iterator[str]:
+        return map(_format, self._ids)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __repr__(self) -> str:
+        return f'AccountRegistry({len(self)} accounts)'
+
+    def __reduce__(self):
+        return (AccountRegistry, (self._ids, self._emails))
+
+    def records(self) -> typing.Iterator[Account]:
+        for account_id, email in zip(self._ids, self._emails):
+            yield Account(_format(account_id), email)
+
+    def difference(self, other: typing.Union['AccountRegistry', array.array, typing.Iterable[str]]) -> 'AccountRegistry':
+        """
+        Args:
+            - other: Account IDs, as a registry, a sorted array of integers, or a collection of strings.
+
+        Returns:
+            The accounts of the registry that are not in other.
+        """
+        if isinstance(other, (set, frozenset, collections.abc.KeysView)) and len(other) > 4 * len(self):
+            # a few accounts against e.g. all the members of a graph: lookups are cheaper than sorting
+            keep = [i for i, account_id in enumerate(self._ids) if _format(account_id) not in other]
+            return AccountRegistry(array.array('Q', (self._ids[i] for i in keep)), [self._emails[i] for i in keep])
+        if isinstance(other, AccountRegistry):
+            other = other._ids
+        elif not isinstance(other, array.array):
+            other = account_id_array(other)
+
+        ids, emails = array.array('Q'), []
+        j, count = 0, len(other)
+        for i, account_id in enumerate(self._ids):
+            while j < count and other[j] < account_id:
+                j += 1
+            if j < count and other[j] == account_id:
+                continue
+            ids.append(account_id)
+            emails.append(self._emails[i])
+        return AccountRegistry(ids, emails)
+
+    def chunks(self, size: int) -> typing.Iterator['AccountRegistry']:
+        """
+        Split the registry in registries of at most size accounts, sharing the emails.
+        """
+        for start in range(0, len(self._ids), size):
+            yield AccountRegistry(self._ids[start:start + size], self._emails[start:start + size])
+
+
+def chunks(aws_account_dict: typing.Mapping[str, str], size: int) -> typing.Iterator[typing.Mapping[str, str]]:
+    """
+    Split the accounts in mappings of at most size accounts: registries for a registry, and
+    dictionaries otherwise.
+    """
+    if isinstance(aws_account_dict, AccountRegistry):
+        yield from aws_account_dict.chunks(size)
+        return
+    items = iter(aws_account_dict.items())
+    while True:
+        chunk = dict(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def difference(aws_account_dict: typing.Mapping[str, str], account_ids: typing.Iterable[str]) -> typing.Collection[str]:
+    """
+    Returns:
+        The account IDs of aws_account_dict that are not in account_ids.
+    """
+    if isinstance(aws_account_dict, AccountRegistry):
+        return aws_account_dict.difference(account_ids)
+    return aws_account_dict.keys() - account_ids
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = "Amazon Detective"
+__copyright__ = "Amazon 2020"
+__credits__ = "Amazon Detective"
+__license__ = "Apache"
+__version__ = "1.1.0"
+__maintainer__ = "Amazon Detective"
+__email__ = "detective-demo-requests@amazon.com"
+__status__ = "Production"
+
+import argparse
+import concurrent.futures
+import functools
+import io
+import logging
+import sys
+import typing
+import zlib
+
+import boto3
+
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_deadline as deadline
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_logging as logs
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_profile as profiling
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_progress as progress
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_recording as recording
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_state as state
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_utilities as helper
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=FORMAT)
+
+
+def shard_for_account(account_id: str, shard_count: int) -> int:
+    """
+    Get the shard an account belongs to.
+
+    crc32 is used instead of hash() because string hashing is randomized per process,
+    and every process must agree on the shard of an account.
+
+    Args:
+        - account_id: AWS account ID.
+        - shard_count: Total number of shards.
+
+    Returns:
+        Shard index between 0 and shard_count - 1.
+    """
+    return zlib.crc32(account_id.encode()) % shard_count
+
+
+def shard_accounts(aws_account_dict: typing.Dict, shard_count: int) -> typing.List[typing.Dict]:
+    """
+    Split the accounts read from the CSV file into shards by hash of the account ID.
+
+    Args:
+        - aws_account_dict: A dictionary where the key is account ID and value is email address.
+        - shard_count: Total number of shards.
+
+    Returns:
+        List of shard_count dictionaries with the same format as aws_account_dict.
+    """
+    shards = [{} for _ in range(shard_count)]
+    for account_id, email in aws_account_dict.items():
+        shards[shard_for_account(account_id, shard_count)][account_id] = email
+    return shards
+
+
+def _picklable_args(args: argparse.Namespace) -> argparse.Namespace:
+    # Open files (i.e. --input_file) can't be sent to the worker processes, and the
+    # accounts have already been read from them anyway.
+    if args is None:
+        return None
+    return argparse.Namespace(**{k: v for k, v in vars(args).items() if not isinstance(v, io.IOBase)})
+
+
+def _refresh_admin_credentials(args: argparse.Namespace, role_session_name: str) -> typing.Optional[typing.Callable]:
+    # A worker can outlive the admin credentials it was handed, so it assumes the admin role
+    # itself when they near expiry.
+    if not getattr(args, 'admin_account', None) or not getattr(args, 'assume_role', None):
+        return None
+
+    def _refresh() -> typing.Dict[str, str]:
+        logging.info(f'Refreshing the admin credentials of {role_session_name}.')
+        return helper.get_session_credentials(helper.assume_role(args.admin_account, args.assume_role, role_session_name))
+
+    return _refresh
+
+
+def _run_shard(func: typing.Callable, shard_index: int, shard: typing.Dict, detective_regions: typing.List[str],
+               credentials: typing.Dict[str, str], args: argparse.Namespace) -> typing.Dict:
+    """
+    Process one shard of accounts in all the regions. Runs inside a worker process.
+
+    Args:
+        - func: process_accounts_enable_detective() or process_accounts_disable_detective().
+        - shard_index: Index of the shard, used to tag the log lines.
+        - shard: Accounts of the shard.
+        - detective_regions: A list of the region names to disable/enable Detective from.
+        - credentials: Admin session credentials from helper.get_session_credentials(). The admin
+                       role is assumed again when they near expiry.
+        - args: An argparse.Namespace object containing parsed arguments.
+
+    Returns:
+        The report of the shard.
+    """
+    logs.setup_logging_from_args(args, fmt=f'%(asctime)s - %(levelname)s - [shard {shard_index}] %(message)s')
+    profiling.activate_from_args(args, f'.shard{shard_index}')
+    recording.activate_from_args(args, f'.shard{shard_index}')
+    admin_session = helper.session_from_credentials(
+        credentials, _refresh_admin_credentials(args, f'AmazonDetectiveMultiAccountScripts_Shard{shard_index}'))
+    state.activate_from_args(args)
+    helper.use_regional_sts_endpoints(getattr(args, 'sts_regional_endpoints', False))
+    if getattr(args, 'hedge_percentile', None):
+        helper.enable_hedged_reads(args.hedge_percentile)
+    deadline.activate_from_args(args)
+    if getattr(args, 'progress', 'off') != 'off':
+        # the status lines of several processes would overwrite each other
+        progress.activate('log', getattr(args, 'progress_interval', 10.0))
+        progress.instrument(admin_session)
+    if getattr(args, 'circuit_breaker_failures', 0):
+        helper.enable_circuit_breakers(args.circuit_breaker_failures, args.circuit_breaker_reset)
+    try:
+        return func(shard, detective_regions, admin_session, args) or helper.new_report()
+    except SystemExit as e:
+        # a shard exiting must not take the other shards down, so it is reported as aborted instead
+        logging.error(f'shard {shard_index} aborted with exit code {e.code}')
+        report = helper.new_report()
+        for region in detective_regions:
+            helper.add_to_report(report, 'aborted', region, shard.keys())
+        return report
+    finally:
+        progress.deactivate()
+        profiling.finish()
+        recording.finish()
+        helper.log_hedge_stats()
+        helper.log_circuit_breakers()
+        # worker processes don't run the exit handlers, so the pending lines are written now
+        logs.stop_logging()
+
+
+def run_sharded(func: typing.Callable, shard_count: int, aws_account_dict: typing.Dict,
+                detective_regions: typing.List[str], admin_session: boto3.Session,
+                args: argparse.Namespace, prepare: typing.Callable = None) -> typing.Dict:
+    """
+    Process the accounts in a pool of processes, one shard of accounts per process.
+
+    Each worker owns its shard across all the regions. The admin role is assumed by the calling
+    process, and its credentials are handed to the workers, which only assume it again when the
+    credentials near expiry.
+
+    Args:
+        - func: process_accounts_enable_detective() or process_accounts_disable_detective().
+        - shard_count: Number of shards (and worker processes).
+        - aws_account_dict: A dictionary where the key is account ID and value is email address.
+        - detective_regions: A list of the region names to disable/enable Detective from.
+        - admin_session: Assumed session in the admin account.
+        - args: An argparse.Namespace object containing parsed arguments.
+        - prepare: Called with the same arguments as func before the workers are started, e.g. to
+                   create the graphs once instead of once per shard. It returns the regions left to
+                   process and a report of the accounts it settled. (Optional)
+
+    Returns:
+        The merged report of all the shards.
+    """
+    reports = []
+    if prepare is not None:
+        detective_regions, report = prepare(aws_account_dict, detective_regions, admin_session, args)
+        reports.append(report)
+        if not detective_regions:
+            return helper.merge_reports(reports)
+    credentials = helper.get_session_credentials(admin_session)
+    worker_args = _picklable_args(args)
+    shards = [shard for shard in shard_accounts(aws_account_dict, shard_count) if shard]
+    logging.info(f'Processing {len(aws_account_dict)} accounts in {len(shards)} shards.')
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(shards) or 1) as executor:
+        futures = {executor.submit(_run_shard, func, index, shard, detective_regions, credentials, worker_args): shard
+                   for index, shard in enumerate(shards)}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                reports.append(future.result())
+            except Exception as e:
+                logging.exception(f'error processing shard: {e}')
+                report = helper.new_report()
+                for region in detective_regions:
+                    helper.add_to_report(report, 'aborted', region, futures[future].keys())
+                reports.append(report)
+
+    return helper.merge_reports(reports)
+
+
+def sharded(func: typing.Callable, shard_count: int, prepare: typing.Callable = None) -> typing.Callable:
+    """
+    Wrap a process_accounts_* function so it runs sharded across a process pool.
+
+    The returned callable has the same signature as func, so it can be passed to
+    helper.check_region_existence_and_modify().
+
+    Args:
+        - func: process_accounts_enable_detective() or process_accounts_disable_detective().
+        - shard_count: Number of shards (and worker processes).
+        - prepare: Called before the workers are started, see run_sharded(). (Optional)
+
+    Returns:
+        The wrapped function.
+    """
+    return functools.partial(run_sharded, func, shard_count, prepare=prepare)
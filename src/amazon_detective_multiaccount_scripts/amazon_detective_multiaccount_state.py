@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Local SQLite store of the membership of the behavior graphs and of the history of the operations.
+
+The store is disabled unless activate() is called (--state_file in the scripts). Once active, the
+member lookups and the create, accept and delete operations record their results in it, and
+get_members() can read a recent full sweep from it instead of listing the members again.
+"""
+__author__ = "Amazon Detective"
+__copyright__ = "Amazon 2020"
+__credits__ = "Amazon Detective"
+__license__ = "Apache"
+__version__ = "1.1.0"
+__maintainer__ = "Amazon Detective"
+__email__ = "detective-demo-requests@amazon.com"
+__status__ = "Production"
+
+import argparse
+import contextlib
+import logging
+import sqlite3
+import sys
+import threading
+import time
+import typing
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=FORMAT)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS members (
+    region TEXT NOT NULL,
+    graph TEXT NOT NULL,
+    account_id TEXT NOT NULL,
+    email TEXT,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (graph, account_id)
+);
+CREATE INDEX IF NOT EXISTS members_region_status ON members (region, status);
+CREATE INDEX IF NOT EXISTS members_account ON members (account_id);
+CREATE TABLE IF NOT EXISTS sweeps (
+    graph TEXT PRIMARY KEY,
+    region TEXT NOT NULL,
+    swept_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS operations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    at REAL NOT NULL,
+    region TEXT NOT NULL,
+    graph TEXT,
+    account_id TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    reason TEXT
+);
+CREATE INDEX IF NOT EXISTS operations_account ON operations (account_id, at);
+CREATE INDEX IF NOT EXISTS operations_outcome ON operations (operation, outcome, at);
+"""
+
+# Member status after a successful operation. None removes the member.
+_STATUS_AFTER = {
+    ('create_members', 'created'): 'VERIFICATION_IN_PROGRESS',
+    ('accept_invitation', 'accepted'): 'ENABLED',
+    ('delete_members', 'deleted'): None,
+    ('disassociate_membership', 'disassociated'): None,
+    ('reject_invitation', 'rejected'): None,
+}
+
+# Operations recorded by the scripts, in the order they were added.
+OPERATIONS = tuple(dict.fromkeys(operation for operation, outcome in _STATUS_AFTER))
+
+
+class StateStore:
+    """
+    SQLite store of the members and operations. Safe to use from several threads and processes.
+    """
+
+    def __init__(self, path: str, max_age: float = 0):
+        """
+        Args:
+            - path: Path of the SQLite file. It is created if needed.
+            - max_age: Seconds during which a full sweep of a graph is used instead of listing its members again.
+                       0 to always list the members.
+        """
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(SCHEMA)
+
+    def close(self) -> typing.NoReturn:
+        self._conn.close()
+
+    @contextlib.contextmanager
+    def _transaction(self) -> typing.Iterator[sqlite3.Connection]:
+        # a failed write must not leave the shared connection inside its transaction
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def record_members(self, region: str, graph: str, member_details: typing.List[typing.Dict],
+                       full_sweep: bool = False) -> typing.NoReturn:
+        """
+        Store the members returned by the ListMembers or GetMembers APIs.
+
+        Args:
+            - region: Region of the graph.
+            - graph: Graph arn.
+            - member_details: Member details returned by the API.
+            - full_sweep: The details are all the members of the graph, so members that aren't in them are removed.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            if full_sweep:
+                conn.execute('DELETE FROM members WHERE graph = ?', (graph,))
+                conn.execute('INSERT OR REPLACE INTO sweeps (graph, region, swept_at) VALUES (?, ?, ?)',
+                             (graph, region, now))
+            conn.executemany(
+                'INSERT OR REPLACE INTO members (region, graph, account_id, email, status, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                [(region, graph, x['AccountId'], x.get('EmailAddress'), x['Status'], now) for x in member_details])
+
+    def record_operation(self, region: str, graph: str, operation: str, outcome: str, account_ids: typing.Iterable[str],
+                         reasons: typing.Dict[str, str] = None, emails: typing.Dict[str, str] = None) -> typing.NoReturn:
+        """
+        Store the outcome of an operation for some accounts, and update their member status accordingly.
+
+        Args:
+            - region: Region of the graph.
+            - graph: Graph arn.
+            - operation: create_members, accept_invitation, delete_members, disassociate_membership or reject_invitation.
+            - outcome: created, accepted, deleted, disassociated, rejected or failed.
+            - account_ids: Accounts the outcome applies to.
+            - reasons: Optional dictionary with the failure reason of each account.
+            - emails: Optional dictionary with the email address of each account.
+        """
+        now = time.time()
+        account_ids = list(account_ids)
+        reasons, emails = reasons or {}, emails or {}
+        with self._transaction() as conn:
+            conn.executemany(
+                'INSERT INTO operations (at, region, graph, account_id, operation, outcome, reason) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(now, region, graph, x, operation, outcome, reasons.get(x)) for x in account_ids])
+            if (operation, outcome) in _STATUS_AFTER:
+                status = _STATUS_AFTER[(operation, outcome)]
+                if status is None:
+                    conn.executemany('DELETE FROM members WHERE graph = ? AND account_id = ?',
+                                     [(graph, x) for x in account_ids])
+                else:
+                    conn.executemany(
+                        'INSERT INTO members (region, graph, account_id, email, status, updated_at) VALUES (?, ?, ?, ?, ?, ?) '
+                        'ON CONFLICT (graph, account_id) DO UPDATE SET status = excluded.status, '
+                        'email = COALESCE(excluded.email, email), updated_at = excluded.updated_at',
+                        [(region, graph, x, emails.get(x), status, now) for x in account_ids])
+
+    def cached_members(self, graph: str) -> typing.Optional[typing.List[typing.Dict]]:
+        """
+        Get the members of a graph from the store, if it was fully swept less than max_age seconds ago.
+
+        Args:
+            - graph: Graph arn.
+
+        Returns:
+            Member details with the same keys as the ListMembers API, or None if there is no recent sweep.
+        """
+        if self.max_age <= 0:
+            return None
+        with self._lock:
+            sweep = self._conn.execute('SELECT swept_at FROM sweeps WHERE graph = ?', (graph,)).fetchone()
+            if sweep is None or time.time() - sweep['swept_at'] > self.max_age:
+                return None
+            rows = self._conn.execute('SELECT account_id, email, status FROM members WHERE graph = ?', (graph,)).fetchall()
+        return [{'AccountId': x['account_id'], 'EmailAddress': x['email'], 'Status': x['status']} for x in rows]
+
+    def members(self, region: str = None, status: str = None, account_id: str = None) -> typing.List[typing.Dict]:
+        """
+        Query the members.
+
+        Args:
+            - region: Only the members of this region. (Optional)
+            - status: Only the members with this status. (Optional)
+            - account_id: Only this account. (Optional)
+
+        Returns:
+            List of dictionaries with the columns of the members table.
+        """
+        return self._query('SELECT * FROM members', {'region': region, 'status': status, 'account_id': account_id},
+                           'ORDER BY region, graph, account_id')
+
+    def history(self, account_id: str = None, region: str = None, operation: str = None, outcome: str = None,
+                limit: int = 100) -> typing.List[typing.Dict]:
+        """
+        Query the operations, most recent first.
+
+        Args:
+            - account_id: Only this account. (Optional)
+            - region: Only this region. (Optional)
+            - operation: Only this operation. (Optional)
+            - outcome: Only this outcome. (Optional)
+            - limit: Maximum number of operations.
+
+        Returns:
+            List of dictionaries with the columns of the operations table.
+        """
+        return self._query('SELECT * FROM operations',
+                           {'account_id': account_id, 'region': region, 'operation': operation, 'outcome': outcome},
+                           f'ORDER BY at DESC, id DESC LIMIT {int(limit)}')
+
+    def _query(self, select: str, filters: typing.Dict[str, typing.Optional[str]], suffix: str) -> typing.List[typing.Dict]:
+        filters = {k: v for k, v in filters.items() if v is not None}
+        where = ' WHERE ' + ' AND '.join(f'{k} = ?' for k in filters) if filters else ''
+        with self._lock:
+            return [dict(x) for x in self._conn.execute(f'{select}{where} {suffix}', tuple(filters.values()))]
+
+
+_STORE = None
+
+
+def activate(path: str, max_age: float = 0) -> StateStore:
+    """
+    Activate the store for this process.
+
+    Args:
+        - path: Path of the SQLite file.
+        - max_age: Seconds during which a full sweep of a graph is used instead of listing its members again.
+
+    Returns:
+        The active store.
+    """
+    global _STORE
+    deactivate()
+    _STORE = StateStore(path, max_age)
+    return _STORE
+
+
+def activate_from_args(args: argparse.Namespace) -> typing.Optional[StateStore]:
+    """
+    Activate the store if the --state_file argument was provided.
+
+    Args:
+        - args: An argparse.Namespace object containing parsed arguments.
+
+    Returns:
+        The active store, or None.
+    """
+    if getattr(args, 'state_file', None):
+        return activate(args.state_file, getattr(args, 'state_max_age', 0) or 0)
+    return None
+
+
+def deactivate() -> typing.NoReturn:
+    """
+    Close and deactivate the store.
+    """
+    global _STORE
+    if _STORE is not None:
+        _STORE.close()
+        _STORE = None
+
+
+def region_of(d_client, graph: str) -> str:
+    """
+    Get the region of a graph from its arn, or from the client that accesses it.
+
+    Args:
+        - d_client: Detective boto3 client generated from the admin session.
+        - graph: Graph arn.
+
+    Returns:
+        Region name.
+    """
+    parts = graph.split(':')
+    if len(parts) > 3 and parts[0] == 'arn':
+        return parts[3]
+    return d_client.meta.region_name
+
+
+# The functions below are the hooks called by the scripts. They do nothing unless the store is active,
+# and a failure to record is logged without interrupting the operation.
+
+def record_members(d_client, graph: str, member_details: typing.List[typing.Dict], full_sweep: bool = False) -> typing.NoReturn:
+    if _STORE is None:
+        return
+    try:
+        _STORE.record_members(region_of(d_client, graph), graph, member_details, full_sweep)
+    except Exception as e:
+        logging.exception(f'error recording members of graph {graph}: {e}')
+
+
+def record_operation(region: str, graph: str, operation: str, outcome: str, account_ids: typing.Iterable[str],
+                     reasons: typing.Dict[str, str] = None, emails: typing.Dict[str, str] = None) -> typing.NoReturn:
+    if _STORE is None or not account_ids:
+        return
+    try:
+        _STORE.record_operation(region, graph, operation, outcome, account_ids, reasons, emails)
+    except Exception as e:
+        logging.exception(f'error recording {operation} in graph {graph}: {e}')
+
+
+def cached_members(graph: str) -> typing.Optional[typing.List[typing.Dict]]:
+    if _STORE is None:
+        return None
+    try:
+        return _STORE.cached_members(graph)
+    except Exception as e:
+        logging.exception(f'error reading members of graph {graph}: {e}')
+        return None
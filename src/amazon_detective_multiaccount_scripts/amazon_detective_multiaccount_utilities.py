@@ -11,20 +11,33 @@ __email__ = "detective-demo-requests@amazon.com"
 __status__ = "Production"
 
 import argparse
+import concurrent.futures
 import itertools
+import json
 import logging
 import re
 import sys
+import threading
+import time
 import typing
+import weakref
 
 import boto3
+import botocore.credentials
 import botocore.exceptions
+import botocore.session
+
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_profile as profiling
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_progress as progress
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_recording as recording
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_registry as registry
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_state as state
 
 FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=FORMAT)
 
 
-def read_accounts_csv(input_file: typing.IO) -> typing.Dict:
+def read_accounts_csv(input_file: typing.IO) -> registry.AccountRegistry:
     """
     Parses contents from the CSV file containing the accounts and email addreses.
 
@@ -32,32 +45,33 @@ def read_accounts_csv(input_file: typing.IO) -> typing.Dict:
         input_file: A file object to read CSV data from.
 
     Returns:
-        A dictionary where the key is account ID and value is email address.
+        A registry mapping the account ID to the email address.
     """
     account_re = re.compile(r'[0-9]{12}')
-    aws_account_dict = {}
 
     if not input_file:
-        return aws_account_dict
+        return registry.AccountRegistry()
 
-    for acct in input_file.readlines():
-        split_line = acct.strip().split(',')
+    def pairs():
+        for acct in input_file:
+            split_line = acct.strip().split(',')
 
-        if len(split_line) != 2:
-            logging.exception(f'Unable to process line: {acct}.')
-            continue
+            if len(split_line) != 2:
+                logging.exception(f'Unable to process line: {acct}.')
+                continue
 
-        account_number, email = split_line
-        if not account_re.match(account_number):
-            logging.error(
-                f'Invalid account number {account_number}, skipping. Account number should be 12 digits long and should contain only digits.')
-            continue
+            account_number, email = split_line
+            if not account_re.fullmatch(account_number.strip()):
+                logging.error(
+                    f'Invalid account number {account_number}, skipping. Account number should be 12 digits long and should contain only digits.')
+                continue
 
-        aws_account_dict[account_number.strip()] = email.strip()
+            yield account_number.strip(), email.strip()
 
-    return aws_account_dict
+    return registry.AccountRegistry.from_pairs(pairs())
 
 
+@profiling.timed('get_regions')
 def get_regions(session: boto3.Session, skip_prompt: bool, user_regions=None) -> typing.List[str]:
     """
     Get AWS regions to disable/enable Detective from.
@@ -92,24 +106,143 @@ def get_regions(session: boto3.Session, skip_prompt: bool, user_regions=None) ->
     return detective_regions
 
 
-def assume_role(aws_account_number: str, role_name: str, role_session_name: str) -> boto3.Session:
+class LatencyStats:
+    """
+    Thread-safe latency samples grouped by key, e.g. by region.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def record(self, key: typing.Hashable, seconds: float) -> typing.NoReturn:
+        with self._lock:
+            self._samples.setdefault(key, []).append(seconds)
+
+    def count(self, key: typing.Hashable) -> int:
+        with self._lock:
+            return len(self._samples.get(key, []))
+
+    def percentile(self, key: typing.Hashable, q: float) -> typing.Optional[float]:
+        """
+        Args:
+            - key: Key of the samples.
+            - q: Percentile between 0 and 1, e.g. 0.9.
+
+        Returns:
+            The percentile of the samples of the key in seconds, or None if there is no sample.
+        """
+        with self._lock:
+            samples = sorted(self._samples.get(key, []))
+        if not samples:
+            return None
+        return samples[int(round(q * (len(samples) - 1)))]
+
+    def summary(self) -> typing.Dict[typing.Hashable, typing.Dict[str, float]]:
+        """
+        Returns:
+            A dictionary where the key is a key of the samples and value is a dictionary with the count,
+            and the mean, p50, p90 and max latency in seconds.
+        """
+        with self._lock:
+            samples = {key: sorted(values) for key, values in self._samples.items()}
+        return {key: {'count': len(values), 'mean': sum(values) / len(values), 'p50': values[int(round(0.5 * (len(values) - 1)))],
+                      'p90': values[int(round(0.9 * (len(values) - 1)))], 'max': values[-1]}
+                for key, values in samples.items()}
+
+    def clear(self) -> typing.NoReturn:
+        with self._lock:
+            self._samples.clear()
+
+
+# Latency of the AssumeRole calls, by (region, endpoint) where endpoint is regional or global.
+STS_LATENCY = LatencyStats()
+
+_STS_REGIONAL_ENDPOINTS = False
+# Partition of the credentials the scripts run with. It is the same for every call, so it is only looked up once.
+_PARTITION = None
+# Expiration of the credentials of the sessions returned by assume_role()
+_SESSION_EXPIRY = weakref.WeakKeyDictionary()
+_PARTITION_LOCK = threading.Lock()
+
+
+def use_regional_sts_endpoints(enabled: bool = True) -> typing.NoReturn:
+    """
+    Assume the roles through the STS endpoint of the region being worked on, instead of the global endpoint.
+
+    Args:
+        - enabled: Whether regional endpoints are used.
+    """
+    global _STS_REGIONAL_ENDPOINTS
+    _STS_REGIONAL_ENDPOINTS = enabled
+
+
+def instrument_session(session: boto3.Session) -> boto3.Session:
+    """
+    Apply the progress counters and the recording or replay of the API calls to a new session,
+    before any client is created from it.
+
+    Args:
+        - session: boto3 session.
+
+    Returns:
+        The session.
+    """
+    progress.instrument(session)
+    recording.instrument(session)
+    return session
+
+
+def _sts_client(region: str = None) -> (botocore.client.BaseClient, str):
+    # a new session per call, so that roles can be assumed from several threads
+    if region and _STS_REGIONAL_ENDPOINTS:
+        botocore_session = botocore.session.get_session()
+        botocore_session.set_config_variable('sts_regional_endpoints', 'regional')
+        session = instrument_session(boto3.session.Session(botocore_session=botocore_session))
+        return session.client('sts', region_name=region), 'regional'
+    return instrument_session(boto3.session.Session()).client('sts'), 'global'
+
+
+def get_partition(sts_client: botocore.client.BaseClient) -> str:
+    """
+    Get the partition of the credentials the scripts run with, e.g. aws or aws-us-gov.
+
+    Args:
+        - sts_client: STS client.
+
+    Returns:
+        The partition.
+    """
+    global _PARTITION
+    with _PARTITION_LOCK:
+        if _PARTITION is None:
+            _PARTITION = sts_client.get_caller_identity()['Arn'].split(":")[1]
+        return _PARTITION
+
+
+@profiling.timed('assume_role')
+def assume_role(aws_account_number: str, role_name: str, role_session_name: str, region: str = None) -> boto3.Session:
     """
     Assumes the provided role in each account and returns a Detective client.
 
     Args:
         - aws_account_number: AWS Account Number
         - role_name: Role to assume in target account
+        - role_session_name: String that use in assume_role to indicate calling script
+        - region: Region the session is used in. With use_regional_sts_endpoints(), the role is
+                  assumed through the STS endpoint of this region. (Optional)
 
     Returns:
         Detective client in the specified AWS Account and Region
     """
     try:
         # Beginning the assume role process for account
-        sts_client = boto3.client('sts')
+        sts_client, endpoint = _sts_client(region)
 
         # Get the current partition
-        partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
+        partition = get_partition(sts_client)
 
+        start = time.monotonic()
         response = sts_client.assume_role(
             RoleArn='arn:{}:iam::{}:role/{}'.format(
                 partition,
@@ -118,12 +251,16 @@ def assume_role(aws_account_number: str, role_name: str, role_session_name: str)
             ),
             RoleSessionName=role_session_name
         )
+        STS_LATENCY.record((region or 'default', endpoint), time.monotonic() - start)
         # Storing STS credentials
         session = boto3.Session(
             aws_access_key_id=response['Credentials']['AccessKeyId'],
             aws_secret_access_key=response['Credentials']['SecretAccessKey'],
             aws_session_token=response['Credentials']['SessionToken']
         )
+        if response['Credentials'].get('Expiration'):
+            _SESSION_EXPIRY[session] = response['Credentials']['Expiration']
+        instrument_session(session)
     except Exception as e:
         logging.exception(f'exception: {e}')
 
@@ -132,6 +269,137 @@ def assume_role(aws_account_number: str, role_name: str, role_session_name: str)
     return session
 
 
+def log_sts_latency() -> typing.NoReturn:
+    """
+    Log the latency of the AssumeRole calls in each region.
+    """
+    for (region, endpoint), stats in sorted(STS_LATENCY.summary().items()):
+        logging.info(f'AssumeRole latency in {region} through the {endpoint} STS endpoint: {stats["count"]} calls, '
+                     f'mean {stats["mean"] * 1000:.0f} ms, p50 {stats["p50"] * 1000:.0f} ms, '
+                     f'p90 {stats["p90"] * 1000:.0f} ms, max {stats["max"] * 1000:.0f} ms.')
+
+
+# Latency of the idempotent read calls, by (operation, region). The hedging deadlines are computed from it.
+READ_LATENCY = LatencyStats()
+
+_HEDGING = None
+_HEDGE_COUNTERS = {'issued': 0, 'won': 0}
+_HEDGE_LOCK = threading.Lock()
+_HEDGE_EXECUTOR = None
+
+
+def enable_hedged_reads(percentile: float = 0.95, warmup: int = 10, min_deadline: float = 0.05) -> typing.NoReturn:
+    """
+    Hedge the idempotent read calls: when a call hasn't returned by the given percentile of the latency
+    of its operation in its region, a duplicate call is issued and the first one to return is used.
+
+    Args:
+        - percentile: Percentile of the observed latency after which a call is hedged, between 0 and 1.
+        - warmup: Number of calls of an operation in a region before they are hedged.
+        - min_deadline: Minimum deadline in seconds.
+    """
+    global _HEDGING, _HEDGE_EXECUTOR
+    _HEDGING = {'percentile': percentile, 'warmup': warmup, 'min_deadline': min_deadline}
+    if _HEDGE_EXECUTOR is None:
+        _HEDGE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=32, thread_name_prefix='hedge')
+
+
+def disable_hedged_reads() -> typing.NoReturn:
+    global _HEDGING
+    _HEDGING = None
+
+
+def hedge_stats() -> typing.Dict[str, int]:
+    """
+    Returns:
+        The number of hedges issued, and the number of them that returned before the original call.
+    """
+    with _HEDGE_LOCK:
+        return dict(_HEDGE_COUNTERS)
+
+
+def _count_hedge(counter: str) -> typing.NoReturn:
+    with _HEDGE_LOCK:
+        _HEDGE_COUNTERS[counter] += 1
+
+
+def hedged_call(client: botocore.client.BaseClient, operation: str, **kwargs) -> typing.Dict:
+    """
+    Call an idempotent read operation of a client, hedged if enable_hedged_reads() was called.
+
+    Args:
+        - client: boto3 client.
+        - operation: Name of the client method, e.g. list_members.
+        - kwargs: Arguments of the call.
+
+    Returns:
+        The response of the call.
+    """
+    method = getattr(client, operation)
+    if _HEDGING is None:
+        return method(**kwargs)
+
+    key = (operation, client.meta.region_name)
+    start = time.monotonic()
+    if READ_LATENCY.count(key) < _HEDGING['warmup']:
+        response = method(**kwargs)
+        READ_LATENCY.record(key, time.monotonic() - start)
+        return response
+
+    deadline = max(READ_LATENCY.percentile(key, _HEDGING['percentile']), _HEDGING['min_deadline'])
+    primary = _HEDGE_EXECUTOR.submit(method, **kwargs)
+    done, pending = concurrent.futures.wait([primary], timeout=deadline)
+    if done:
+        READ_LATENCY.record(key, time.monotonic() - start)
+        return primary.result()
+
+    _count_hedge('issued')
+    hedge = _HEDGE_EXECUTOR.submit(method, **kwargs)
+    pending = {primary, hedge}
+    while True:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        # a failed call only matters if the other one fails too
+        succeeded = [x for x in (primary, hedge) if x in done and x.exception() is None]
+        if succeeded or not pending:
+            future = succeeded[0] if succeeded else done.pop()
+            if future is hedge and succeeded:
+                _count_hedge('won')
+            READ_LATENCY.record(key, time.monotonic() - start)
+            return future.result()
+
+
+def log_hedge_stats() -> typing.NoReturn:
+    """
+    Log the number of hedges issued and won, if the reads were hedged.
+    """
+    if _HEDGING is not None:
+        stats = hedge_stats()
+        logging.info(f'Hedged reads: {stats["issued"]} hedges issued, {stats["won"]} returned first.')
+
+
+def iter_graphs(d_client: botocore.client.BaseClient) -> typing.Iterator[typing.Dict]:
+    """
+    Iterate over the graphs of a region, following NextToken.
+
+    Args:
+        - d_client: Detective boto3 client generated from the admin session.
+
+    Returns:
+        Iterator over the graph details as returned by the ListGraphs API.
+    """
+    token_tracker = {}
+    while True:
+        response = hedged_call(d_client, 'list_graphs', **token_tracker)
+        # use .get function to avoid KeyErrors when a dictionary key doesn't exist
+        # it returns an empty list instead.
+        yield from response.get('GraphList', [])
+        if 'NextToken' in response:
+            token_tracker['NextToken'] = response['NextToken']
+        else:
+            break
+
+
+@profiling.timed('get_graphs')
 def get_graphs(d_client: botocore.client.BaseClient) -> typing.List[str]:
     """
     Get graphs in a specified region.
@@ -143,19 +411,70 @@ def get_graphs(d_client: botocore.client.BaseClient) -> typing.List[str]:
         List of graph Arns.
     """
     try:
-        response = d_client.list_graphs()
+        # the element 'Arn' is extracted from the dictionary of each graph
+        return [x['Arn'] for x in iter_graphs(d_client)]
     except botocore.exceptions.EndpointConnectionError as e:
         logging.exception(f'exception: {e}')
         return []
 
-    # use .get function to avoid KeyErrors when a dictionary key doesn't exist
-    # it returns an empty list instead.
-    # map iterates over all elements under a list and applied a function to them,
-    # in this specific case, the element 'Arn' is extracted from the dictionary
-    # (graphlist is a list of dictionaries)
-    return [x['Arn'] for x in response.get('GraphList', [])]
 
+def iter_member_pages(d_client: botocore.client.BaseClient, graph: str) -> typing.Iterator[typing.List[typing.Dict]]:
+    """
+    Iterate over the pages of members of a behaviour graph, following NextToken.
+
+    Args:
+        - d_client: Detective boto3 client generated from the admin session.
+        - graph: Graph arn.
+
+    Returns:
+        Iterator over lists of member details as returned by the ListMembers API.
+    """
+    # create a dictionary for the nextToken from each call
+    token_tracker = {}
+    # loop through list_members call results and take action for each returned result
+    while True:
+        # list_members of the graph and return the first 100 results
+        members = hedged_call(d_client, 'list_members', GraphArn=graph, MaxResults=100, **token_tracker)
+        yield members['MemberDetails']
+        # if the returned results have a "NextToken" key then use it to query again
+        if 'NextToken' in members:
+            token_tracker['NextToken'] = members['NextToken']
+        # if the returned results do not have a "NextToken" key then exit the loop
+        else:
+            break
+
+
+def list_graph_members(d_client: botocore.client.BaseClient, graph: str) -> typing.List[typing.Dict]:
+    """
+    List all the members of a behaviour graph, following NextToken.
 
+    Args:
+        - d_client: Detective boto3 client generated from the admin session.
+        - graph: Graph arn.
+
+    Returns:
+        List of member details as returned by the ListMembers API.
+    """
+    # create a list to append the member accounts
+    member_accounts = []
+    for page in iter_member_pages(d_client, graph):
+        # add the returned list members to the list
+        member_accounts.extend(page)
+    state.record_members(d_client, graph, member_accounts, full_sweep=True)
+    # return members list.
+    # The return statement doesn't need ()
+    return member_accounts
+
+
+def _planning_members(d_client: botocore.client.BaseClient, graph: str) -> typing.List[typing.Dict]:
+    # A recent full sweep from the state store saves listing every member of the graph again.
+    members = state.cached_members(graph)
+    if members is None:
+        members = list_graph_members(d_client, graph)
+    return members
+
+
+@profiling.timed('get_members')
 def get_members(d_client: botocore.client.BaseClient, graphs: typing.List[str]) -> \
         (typing.Dict[str, typing.Set[str]], typing.Dict[str, typing.Set[str]], typing.Dict[str, typing.Set[str]]):
     """
@@ -174,31 +493,9 @@ def get_members(d_client: botocore.client.BaseClient, graphs: typing.List[str])
     # we can iterate the iterator twice: one to return all elements and other to return
     # the ones pending to be invited.
     ####
-    # check the value of NextToken in the response. if it is non-null, pass it back into a subsequent list_members call (and keep doing this until a null token is returned)
-    def _admin_member_list(g: str) -> typing.List[typing.Dict]:
-        # create a list to append the member accounts
-        member_accounts = []
-        # create a dictionary for the nextToken from each call
-        token_tracker = {}
-        # loop through list_members call results and take action for each returned result
-        while True:
-            # list_members of graph "g" and return the first 100 results
-            members = d_client.list_members(GraphArn=g, MaxResults=100, **token_tracker)
-            # add the returned list members to the list
-            member_accounts.extend(members['MemberDetails'])
-            # if the returned results have a "NextToken" key then use it to query again
-            if 'NextToken' in members:
-                token_tracker['NextToken'] = members['NextToken']
-            # if the returned results do not have a "NextToken" key then exit the loop
-            else:
-                break
-        # return members list.
-        # The return statement doesn't need ()
-        return member_accounts
-
     # iterate through each list and return results
     try:
-        all_ac, pending, verification_fail = itertools.tee(((g, _admin_member_list(g)) for g in graphs), 3)
+        all_ac, pending, verification_fail = itertools.tee(((g, _planning_members(d_client, g)) for g in graphs), 3)
     except Exception as e:
         logging.exception(f'exception when getting members: {e}')
 
@@ -207,6 +504,74 @@ def get_members(d_client: botocore.client.BaseClient, graphs: typing.List[str])
             {g: {x['AccountId'] for x in v if x['Status'] == 'VERIFICATION_FAILED'} for g, v in verification_fail})
 
 
+def get_verified_member_emails(d_client: botocore.client.BaseClient, graphs: typing.List[str]) -> typing.Dict[str, str]:
+    """
+    Get the email addresses the members of the behaviour graphs were successfully verified with.
+
+    Args:
+        - d_client: Detective boto3 client generated from the admin session.
+        - graphs: List of graphs arns
+
+    Returns:
+        A dictionary where the key is account ID and value is email address.
+    """
+    return {x['AccountId']: x['EmailAddress']
+            for g in graphs for x in list_graph_members(d_client, g)
+            if x['Status'] != 'VERIFICATION_FAILED' and x.get('EmailAddress')}
+
+
+def get_organization_account_emails(session: boto3.Session) -> typing.Dict[str, str]:
+    """
+    Get the email addresses of the accounts of the AWS Organization, when available.
+
+    Args:
+        - session: boto3 session of an account allowed to list the organization accounts.
+
+    Returns:
+        A dictionary where the key is account ID and value is email address. Empty if the
+        organization accounts can't be listed.
+    """
+    try:
+        paginator = session.client('organizations').get_paginator('list_accounts')
+        return {x['Id']: x['Email'] for page in paginator.paginate() for x in page['Accounts']}
+    except botocore.exceptions.ClientError as e:
+        # Not in an organization, or not allowed to list it. This is expected and not an error.
+        logging.info(f'Organization accounts are not available: {e}')
+        return {}
+
+
+def get_members_by_ids(d_client: botocore.client.BaseClient, graph: str, account_ids: typing.Iterable[str]) -> \
+        (typing.Dict[str, typing.Set[str]], typing.Dict[str, typing.Set[str]], typing.Dict[str, typing.Set[str]]):
+    """
+    Get the status of specific member accounts of a behaviour graph.
+
+    Unlike get_members(), this uses the batch GetMembers API and only fetches the given accounts,
+    so the cost depends on the number of accounts and not on the size of the graph.
+
+    Args:
+        - d_client: Detective boto3 client generated from the admin session.
+        - graph: Graph arn.
+        - account_ids: Account ids to look up.
+
+    Returns:
+        Three dictionaries with the same format as get_members(): the accounts found in the graph,
+        the ones pending to accept the invitation and the ones that failed verification.
+    """
+    member_details = []
+    try:
+        # GetMembers accepts up to 50 account ids per call
+        for batch in chunked(sorted(account_ids), 50):
+            response = d_client.get_members(GraphArn=graph, AccountIds=list(batch))
+            member_details.extend(response['MemberDetails'])
+    except Exception as e:
+        logging.exception(f'exception when getting members by id: {e}')
+    state.record_members(d_client, graph, member_details)
+
+    return ({graph: {x['AccountId'] for x in member_details}},
+            {graph: {x['AccountId'] for x in member_details if x['Status'] == 'INVITED'}},
+            {graph: {x['AccountId'] for x in member_details if x['Status'] == 'VERIFICATION_FAILED'}})
+
+
 def chunked(it, size):
     """
     Chunk iterable data according to specified size
@@ -225,6 +590,404 @@ def chunked(it, size):
         yield p
 
 
+class ThreadSafeSession:
+    """
+    Wraps a boto3 session so that clients can be requested from several threads.
+
+    Each client is created once per service and region, under a lock, and then shared.
+    """
+
+    def __init__(self, session: boto3.Session):
+        self._session = session
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    def client(self, service_name: str, region_name: str = None, **kwargs):
+        with self._lock:
+            if kwargs:
+                return self._session.client(service_name, region_name=region_name, **kwargs)
+            key = (service_name, region_name)
+            if key not in self._clients:
+                self._clients[key] = self._session.client(service_name, region_name=region_name)
+            return self._clients[key]
+
+    def __getattr__(self, name: str):
+        return getattr(self._session, name)
+
+
+def regional_clients(session: boto3.Session, regions: typing.Iterable[str],
+                     service_name: str = 'detective') -> typing.Dict[str, botocore.client.BaseClient]:
+    """
+    Create the clients of a session in each region, to be used by the functions run with run_in_parallel().
+
+    Args:
+        - session: boto3 session.
+        - regions: Region names.
+        - service_name: Service of the clients.
+
+    Returns:
+        A dictionary where the key is the region and value is its client.
+    """
+    return {region: session.client(service_name, region_name=region) for region in regions}
+
+
+def run_in_parallel(func: typing.Callable[[typing.Any], typing.Any], items: typing.Iterable,
+                    max_workers: int = 10) -> typing.Dict:
+    """
+    Call a function for each item concurrently in a thread pool.
+
+    boto3 clients are thread safe but sessions are not, so func should only use clients
+    that were created before calling this function.
+
+    Args:
+        - func: Function to call with each item.
+        - items: Items to process, e.g. regions. They must be hashable.
+        - max_workers: Maximum number of concurrent calls.
+
+    Returns:
+        A dictionary where the key is the item and value is what func returned for it.
+        Items for which func raised an exception are logged and left out.
+    """
+    results = {}
+    items = list(items)
+    if not items:
+        return results
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        futures = {executor.submit(func, item): item for item in items}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                logging.exception(f'error processing {futures[future]}: {e}')
+    return results
+
+
+# UnprocessedAccounts reasons that are worth retrying, as opposed to e.g. invalid or already existing accounts.
+RETRYABLE_REASON = re.compile(r'throttl|rate exceeded|internal|try again|timed? ?out|unavailable', re.IGNORECASE)
+
+
+def is_retryable_reason(reason: str) -> bool:
+    """
+    Check whether an UnprocessedAccounts entry returned by create_members or delete_members can be retried.
+
+    Args:
+        - reason: Reason returned for the unprocessed account.
+
+    Returns:
+        True if the same request may succeed later.
+    """
+    return bool(RETRYABLE_REASON.search(reason or ''))
+
+
+class CircuitBreaker:
+    """
+    Stops sending work to a failing region. After failure_threshold consecutive failures the
+    breaker opens, and the work is shed without calling the region. Once reset_timeout seconds
+    have passed it is half open: a single probe is let through, and its success closes the
+    breaker while its failure opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 60.0,
+                 clock: typing.Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if self._clock() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def allow(self) -> bool:
+        """
+        Returns:
+            True if the work can be sent: the breaker is closed, or it is half open and no other
+            probe is in flight.
+        """
+        with self._lock:
+            state = self._state()
+            if state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return state == self.CLOSED
+
+    def record_success(self) -> typing.NoReturn:
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> typing.NoReturn:
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self._opened_at = self._clock()
+            self._probing = False
+
+
+_BREAKERS = None
+_BREAKERS_LOCK = threading.Lock()
+
+
+def enable_circuit_breakers(failure_threshold: int = 3, reset_timeout: float = 60.0) -> typing.NoReturn:
+    """
+    Use one circuit breaker per region and operation in the process functions.
+
+    Args:
+        - failure_threshold: Consecutive failures after which the breaker opens.
+        - reset_timeout: Seconds after which an open breaker lets a probe through.
+    """
+    global _BREAKERS
+    with _BREAKERS_LOCK:
+        _BREAKERS = {'failure_threshold': failure_threshold, 'reset_timeout': reset_timeout, 'breakers': {}}
+
+
+def disable_circuit_breakers() -> typing.NoReturn:
+    global _BREAKERS
+    with _BREAKERS_LOCK:
+        _BREAKERS = None
+
+
+def circuit_breaker(region: str, operation: str) -> typing.Optional[CircuitBreaker]:
+    """
+    Get the circuit breaker of an operation in a region.
+
+    Args:
+        - region: Region name.
+        - operation: Operation name, e.g. 'enable' or 'disable'.
+
+    Returns:
+        The breaker, or None if the circuit breakers are not enabled.
+    """
+    with _BREAKERS_LOCK:
+        if _BREAKERS is None:
+            return None
+        key = (region, operation)
+        if key not in _BREAKERS['breakers']:
+            _BREAKERS['breakers'][key] = CircuitBreaker(_BREAKERS['failure_threshold'], _BREAKERS['reset_timeout'])
+        return _BREAKERS['breakers'][key]
+
+
+def log_circuit_breakers() -> typing.NoReturn:
+    """
+    Log the breakers that are not closed at the end of a run.
+    """
+    with _BREAKERS_LOCK:
+        breakers = dict(_BREAKERS['breakers']) if _BREAKERS else {}
+    for (region, operation), breaker in sorted(breakers.items()):
+        if breaker.state != CircuitBreaker.CLOSED:
+            logging.warning(f'The circuit breaker of {operation} in {region} is {breaker.state} '
+                            f'after {breaker.failures} consecutive failures.')
+
+
+def write_accounts_csv(aws_account_dict: typing.Dict[str, str], output_file: str) -> typing.NoReturn:
+    """
+    Write accounts in the format read by read_accounts_csv(), e.g. the accounts to process in a follow-up run.
+
+    Args:
+        - aws_account_dict: A dictionary where the key is account ID and value is email address.
+        - output_file: Path of the CSV file to write.
+    """
+    with open(output_file, 'w') as f:
+        for account_id, email in sorted(aws_account_dict.items()):
+            f.write(f'{account_id},{email}\n')
+    logging.info(f'{len(aws_account_dict)} accounts written to {output_file}.')
+
+
+def new_report() -> typing.Dict[str, typing.Dict[str, typing.Set[str]]]:
+    """
+    Create an empty run report.
+
+    A report maps an outcome (for example 'created', 'accepted' or 'failed') to a dictionary
+    where the key is a region and the value is the set of account IDs with that outcome.
+
+    Returns:
+        An empty report dictionary.
+    """
+    return {}
+
+
+def remove_from_report(report: typing.Dict[str, typing.Dict[str, typing.Set[str]]], outcome: str, region: str,
+                       account_ids: typing.Iterable[str]) -> typing.NoReturn:
+    """
+    Remove accounts from an outcome of a region, e.g. once they have been repaired.
+
+    Args:
+        - report: Report created by new_report().
+        - outcome: Outcome name.
+        - region: Region the outcome happened in.
+        - account_ids: Account IDs to remove.
+    """
+    regions = report.get(outcome, {})
+    if region in regions:
+        regions[region].difference_update(account_ids)
+        if not regions[region]:
+            del regions[region]
+    if outcome in report and not report[outcome]:
+        del report[outcome]
+
+
+def add_to_report(report: typing.Dict[str, typing.Dict[str, typing.Set[str]]], outcome: str, region: str,
+                  account_ids: typing.Iterable[str]) -> typing.NoReturn:
+    """
+    Record the outcome for a group of accounts in a region.
+
+    Args:
+        - report: Report created by new_report().
+        - outcome: Outcome name, e.g. 'created', 'accepted', 'deleted' or 'failed'.
+        - region: Region the outcome happened in.
+        - account_ids: Account IDs with that outcome.
+    """
+    account_ids = set(account_ids)
+    if account_ids:
+        report.setdefault(outcome, {}).setdefault(region, set()).update(account_ids)
+
+
+def merge_reports(reports: typing.Iterable[typing.Dict[str, typing.Dict[str, typing.Set[str]]]]) -> \
+        typing.Dict[str, typing.Dict[str, typing.Set[str]]]:
+    """
+    Merge several run reports (e.g. one per shard) into a single report.
+
+    Args:
+        - reports: Iterable of reports created by new_report().
+
+    Returns:
+        A report with the union of all the accounts per outcome and region.
+    """
+    merged = new_report()
+    for report in reports:
+        for outcome, regions in report.items():
+            for region, account_ids in regions.items():
+                add_to_report(merged, outcome, region, account_ids)
+    return merged
+
+
+def write_report(report: typing.Dict[str, typing.Dict[str, typing.Set[str]]], output_file: str) -> typing.NoReturn:
+    """
+    Write a run report as JSON.
+
+    Args:
+        - report: Report created by new_report().
+        - output_file: Path of the JSON file to write.
+    """
+    with open(output_file, 'w') as f:
+        json.dump({outcome: {region: sorted(account_ids) for region, account_ids in regions.items()}
+                   for outcome, regions in report.items()}, f, indent=2, sort_keys=True)
+    logging.info(f'Report written to {output_file}.')
+
+
+def get_session_credentials(session: boto3.Session) -> typing.Dict[str, str]:
+    """
+    Extract the frozen credentials of a session so they can be handed to other processes.
+
+    Args:
+        - session: boto3 session, usually the assumed admin session.
+
+    Returns:
+        A dictionary with the keyword arguments needed to rebuild the session with session_from_credentials(),
+        and the expiry_time of the credentials when it is known.
+    """
+    credentials = session.get_credentials().get_frozen_credentials()
+    result = {'aws_access_key_id': credentials.access_key,
+              'aws_secret_access_key': credentials.secret_key,
+              'aws_session_token': credentials.token}
+    expiry = _SESSION_EXPIRY.get(session)
+    if expiry is not None:
+        result['expiry_time'] = expiry.isoformat()
+    return result
+
+
+def session_from_credentials(credentials: typing.Dict[str, str],
+                             refresh: typing.Callable[[], typing.Dict[str, str]] = None) -> boto3.Session:
+    """
+    Build a boto3 session from credentials returned by get_session_credentials().
+
+    Args:
+        - credentials: Dictionary with the access key, secret key and session token.
+        - refresh: Returns new credentials in the same format, e.g. by assuming the role again. When
+                   given and the expiry of the credentials is known, the session calls it before the
+                   credentials expire. (Optional)
+
+    Returns:
+        boto3 session using those credentials.
+    """
+    keys = ('aws_access_key_id', 'aws_secret_access_key', 'aws_session_token')
+    if refresh is None or not credentials.get('expiry_time'):
+        return instrument_session(boto3.Session(**{key: credentials[key] for key in keys}))
+
+    def _metadata(values: typing.Dict[str, str]) -> typing.Dict[str, str]:
+        return {'access_key': values['aws_access_key_id'], 'secret_key': values['aws_secret_access_key'],
+                'token': values['aws_session_token'], 'expiry_time': values['expiry_time']}
+
+    # botocore refreshes the credentials 15 minutes before they expire
+    botocore_session = botocore.session.get_session()
+    botocore_session._credentials = botocore.credentials.RefreshableCredentials.create_from_metadata(
+        _metadata(credentials), lambda: _metadata(refresh()), 'assume-role')
+    return instrument_session(boto3.Session(botocore_session=botocore_session))
+
+
+class TTLCache:
+    """
+    Thread safe cache whose entries expire a fixed number of seconds after being loaded.
+
+    It is meant to be kept at module level, so that warm processes (e.g. Lambda containers)
+    can reuse sessions, clients and lookups between invocations.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: typing.Hashable, loader: typing.Callable[[], typing.Any]) -> typing.Any:
+        """
+        Get the value of a key, calling loader to load it if it is missing or expired.
+
+        Args:
+            - key: Cache key.
+            - loader: Function without arguments returning the value of the key.
+
+        Returns:
+            The cached or loaded value.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        value = loader()
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+        return value
+
+    def invalidate(self, key: typing.Hashable = None) -> typing.NoReturn:
+        """
+        Remove a key from the cache, or every key if none is given.
+
+        Args:
+            - key: Cache key. (Optional)
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+@profiling.timed('collect_session_and_regions')
 def collect_session_and_regions(admin_account: str, role: str, regions: str, role_session_name: str, skip_prompt: bool) -> \
         (typing.List[str], boto3.Session):
     """
@@ -242,7 +1005,7 @@ def collect_session_and_regions(admin_account: str, role: str, regions: str, rol
         admin_session: Detective client in the specified AWS Account and Region
     """
     try:
-        session = boto3.session.Session()
+        session = instrument_session(boto3.session.Session())
         detective_regions = get_regions(session, skip_prompt, regions)
         admin_session = assume_role(admin_account, role, role_session_name)
 
@@ -264,8 +1027,8 @@ def collect_session_and_regions(admin_account: str, role: str, regions: str, rol
 
 def check_region_existence_and_modify(args: argparse.Namespace, detective_regions: typing.List[str],
                                       aws_account_dict: typing.Dict, admin_session: boto3.Session,
-                                      func: typing.Callable[[typing.Dict, typing.List[str], boto3.Session, argparse.Namespace], typing.NoReturn])\
-        -> typing.NoReturn:
+                                      func: typing.Callable[[typing.Dict, typing.List[str], boto3.Session, argparse.Namespace], typing.Dict])\
+        -> typing.Optional[typing.Dict]:
     """
     Check the regions return from collect_session_and_regions function, and process modification of members accordingly.
 
@@ -276,8 +1039,11 @@ def check_region_existence_and_modify(args: argparse.Namespace, detective_region
         - aws_account_dict: A dictionary where the key is account ID and value is email address.
         - func: A callable function: process_accounts_disable_detective() for disable script
                                      and process_accounts_enable_detective() for enable script
+
+    Returns:
+        The report returned by func, or None if no region was modified.
     """
     if not detective_regions:
         logging.info("Execution finished without modifying any member.")
     else:
-        func(aws_account_dict, detective_regions, admin_session, args)
+        return func(aws_account_dict, detective_regions, admin_session, args)
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Work queue for the Detective member operations.
+
+A producer turns the accounts and regions into independent work items, and executors consume them.
+A work item is a JSON serializable dictionary:
+
+    {"region": "us-east-1", "graph": "arn:...", "operation": "create_members", "accounts": {"111122223333": "a@example.com"}}
+
+where operation is one of OPERATIONS. Items are kept in a durable SQLite queue, so a failed item can be
+retried on its own, and more workers can be added at any time. Other executors can be registered in
+EXECUTORS, consuming the same item format.
+"""
+__author__ = "Amazon Detective"
+__copyright__ = "Amazon 2020"
+__credits__ = "Amazon Detective"
+__license__ = "Apache"
+__version__ = "1.1.0"
+__maintainer__ = "Amazon Detective"
+__email__ = "detective-demo-requests@amazon.com"
+__status__ = "Production"
+
+import argparse
+import json
+import logging
+import multiprocessing
+import sqlite3
+import sys
+import time
+import typing
+
+import boto3
+
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_logging as logs
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_sharding as sharding
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_state as state
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_utilities as helper
+from amazon_detective_multiaccount_scripts import disableDetective
+from amazon_detective_multiaccount_scripts import enableDetective
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=FORMAT)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS work_items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    region TEXT NOT NULL,
+    graph TEXT,
+    operation TEXT NOT NULL,
+    accounts TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    leased_until REAL,
+    last_error TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS work_items_status ON work_items (status, available_at);
+"""
+
+
+class RetryLater(Exception):
+    """
+    Raised by an operation when the item is not done yet and should be retried after a delay,
+    e.g. while waiting for invitations to propagate.
+    """
+
+
+class SqliteWorkQueue:
+    """
+    Durable work queue stored in a SQLite database, safe to share between processes.
+
+    Items are leased by a worker for a limited time. An item whose lease expired, because its
+    worker died, becomes available again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(SCHEMA)
+
+    def close(self) -> typing.NoReturn:
+        self._conn.close()
+
+    @staticmethod
+    def _item(row: sqlite3.Row) -> typing.Dict:
+        return {'id': row['id'], 'region': row['region'], 'graph': row['graph'], 'operation': row['operation'],
+                'accounts': json.loads(row['accounts']), 'attempts': row['attempts']}
+
+    def put(self, region: str, graph: typing.Optional[str], operation: str, accounts: typing.Dict[str, str],
+            delay: float = 0) -> int:
+        """
+        Add a work item.
+
+        Args:
+            - region: Region of the item.
+            - graph: Graph arn of the item.
+            - operation: One of OPERATIONS.
+            - accounts: A dictionary where the key is account ID and value is email address.
+            - delay: Seconds before the item becomes available.
+
+        Returns:
+            The id of the item.
+        """
+        now = time.time()
+        cursor = self._conn.execute(
+            'INSERT INTO work_items (region, graph, operation, accounts, available_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (region, graph, operation, json.dumps(accounts, sort_keys=True), now + delay, now))
+        return cursor.lastrowid
+
+    def lease(self, lease_seconds: float = 600) -> typing.Optional[typing.Dict]:
+        """
+        Take the next available item.
+
+        Args:
+            - lease_seconds: Seconds after which the item is given to another worker if it isn't completed.
+
+        Returns:
+            The work item, or None if no item is available right now.
+        """
+        now = time.time()
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self._conn.execute(
+                "SELECT * FROM work_items WHERE (status = 'queued' AND available_at <= ?) "
+                "OR (status = 'leased' AND leased_until < ?) ORDER BY available_at LIMIT 1", (now, now)).fetchone()
+            if row is None:
+                self._conn.execute('COMMIT')
+                return None
+            self._conn.execute("UPDATE work_items SET status = 'leased', attempts = attempts + 1, leased_until = ?, "
+                               "updated_at = ? WHERE id = ?", (now + lease_seconds, now, row['id']))
+            self._conn.execute('COMMIT')
+        except Exception:
+            self._conn.execute('ROLLBACK')
+            raise
+        item = self._item(row)
+        item['attempts'] += 1
+        return item
+
+    def complete(self, item_id: int) -> typing.NoReturn:
+        """
+        Mark an item as done.
+
+        Args:
+            - item_id: Id of the item.
+        """
+        self._conn.execute("UPDATE work_items SET status = 'done', leased_until = NULL, updated_at = ? WHERE id = ?",
+                           (time.time(), item_id))
+
+    def fail(self, item_id: int, error: str, retry_delay: float = 30, max_attempts: int = 5) -> bool:
+        """
+        Record a failed attempt, making the item available again after retry_delay unless it ran out of attempts.
+
+        Args:
+            - item_id: Id of the item.
+            - error: Error message.
+            - retry_delay: Seconds before the item becomes available again.
+            - max_attempts: Maximum number of attempts of an item.
+
+        Returns:
+            True if the item will be retried.
+        """
+        now = time.time()
+        attempts = self._conn.execute('SELECT attempts FROM work_items WHERE id = ?', (item_id,)).fetchone()['attempts']
+        retry = attempts < max_attempts
+        self._conn.execute('UPDATE work_items SET status = ?, available_at = ?, leased_until = NULL, last_error = ?, '
+                           'updated_at = ? WHERE id = ?',
+                           ('queued' if retry else 'failed', now + retry_delay, error, now, item_id))
+        return retry
+
+    def update_accounts(self, item_id: int, accounts: typing.Dict[str, str]) -> typing.NoReturn:
+        """
+        Replace the accounts of an item, e.g. to only retry the accounts that are left.
+
+        Args:
+            - item_id: Id of the item.
+            - accounts: A dictionary where the key is account ID and value is email address.
+        """
+        self._conn.execute('UPDATE work_items SET accounts = ?, updated_at = ? WHERE id = ?',
+                           (json.dumps(accounts, sort_keys=True), time.time(), item_id))
+
+    def retry_failed(self, item_ids: typing.Iterable[int] = None) -> int:
+        """
+        Queue failed items again, with their attempts reset.
+
+        Args:
+            - item_ids: Ids of the items to retry. Every failed item if not provided.
+
+        Returns:
+            Number of items queued again.
+        """
+        now = time.time()
+        if item_ids is None:
+            cursor = self._conn.execute("UPDATE work_items SET status = 'queued', attempts = 0, available_at = ?, "
+                                        "updated_at = ? WHERE status = 'failed'", (now, now))
+            return cursor.rowcount
+        count = 0
+        for item_id in item_ids:
+            count += self._conn.execute("UPDATE work_items SET status = 'queued', attempts = 0, available_at = ?, "
+                                        "updated_at = ? WHERE id = ? AND status = 'failed'", (now, now, item_id)).rowcount
+        return count
+
+    def counts(self) -> typing.Dict[str, int]:
+        """
+        Returns:
+            A dictionary where the key is an item status and value is the number of items with that status.
+        """
+        return {row['status']: row['count'] for row in
+                self._conn.execute('SELECT status, COUNT(*) AS count FROM work_items GROUP BY status')}
+
+    def failed_items(self) -> typing.List[typing.Dict]:
+        """
+        Returns:
+            The failed items, with their last error.
+        """
+        return [dict(self._item(row), last_error=row['last_error']) for row in
+                self._conn.execute("SELECT * FROM work_items WHERE status = 'failed' ORDER BY id")]
+
+    def unfinished(self) -> int:
+        """
+        Returns:
+            Number of items that are queued or leased.
+        """
+        return self._conn.execute("SELECT COUNT(*) FROM work_items WHERE status IN ('queued', 'leased')").fetchone()[0]
+
+
+def produce_work_items(queue: SqliteWorkQueue, aws_account_dict: typing.Dict, detective_regions: typing.List[str],
+                       admin_session: boto3.Session, args: argparse.Namespace) -> int:
+    """
+    Emit the work items needed to enable or disable the accounts in every region.
+
+    For enable, graphs are created as in enableDetective.py, and a create_members item is emitted per
+    batch of up to 50 accounts that aren't members yet. Members that are still pending get an
+    accept_invitations item. For disable, a delete_members or delete_graph item is emitted instead.
+
+    Args:
+        - queue: Work queue.
+        - aws_account_dict: A dictionary where the key is account ID and value is email address.
+        - detective_regions: A list of the region names to disable/enable Detective from.
+        - admin_session: Detective client in the specified AWS Account and Region
+        - args: An argparse.Namespace object containing parsed arguments.
+
+    Returns:
+        Number of items emitted.
+    """
+    count = 0
+    for region in detective_regions:
+        try:
+            d_client = admin_session.client('detective', region_name=region)
+            if args.operation == 'disable':
+                for graph in helper.get_graphs(d_client):
+                    if args.delete_graph:
+                        queue.put(region, graph, 'delete_graph', {})
+                        count += 1
+                        continue
+                    for chunk in helper.chunked(aws_account_dict.items(), 50):
+                        queue.put(region, graph, 'delete_members', dict(chunk))
+                        count += 1
+                continue
+
+            graphs = enableDetective.enable_detective(d_client, region, args.skip_prompt, getattr(args, 'tags', None))
+            if graphs is None:
+                continue
+            all_members, pending, verification_fail = helper.get_members(d_client, graphs)
+            for graph, members in all_members.items():
+                for chunk in helper.chunked(sorted(aws_account_dict.keys() - members), 50):
+                    queue.put(region, graph, 'create_members', {x: aws_account_dict[x] for x in chunk})
+                    count += 1
+                for chunk in helper.chunked(sorted(pending[graph] & aws_account_dict.keys()), 50):
+                    queue.put(region, graph, 'accept_invitations', {x: aws_account_dict[x] for x in chunk})
+                    count += 1
+        except Exception as e:
+            logging.exception(f'error with region {region}: {e}')
+    logging.info(f'Queued {count} work items.')
+    return count
+
+
+def _create_members(item: typing.Dict, admin_session: boto3.Session, queue: SqliteWorkQueue, args: argparse.Namespace):
+    d_client = admin_session.client('detective', region_name=item['region'])
+    unprocessed = {}
+    created = enableDetective.create_members(d_client, item['graph'], args.disable_email, set(), item['accounts'], unprocessed)
+    if created:
+        # give the invitations time to propagate before trying to accept them
+        queue.put(item['region'], item['graph'], 'accept_invitations', {x: item['accounts'][x] for x in created}, delay=10)
+    retryable = {x: item['accounts'][x] for x, reason in unprocessed.items() if helper.is_retryable_reason(reason)}
+    if retryable:
+        queue.put(item['region'], item['graph'], 'create_members', retryable, delay=30)
+
+
+def _accept_invitations(item: typing.Dict, admin_session: boto3.Session, queue: SqliteWorkQueue, args: argparse.Namespace):
+    d_client = admin_session.client('detective', region_name=item['region'])
+    graph = item['graph']
+    invited, verification_failed, remaining = enableDetective.wait_for_invitations(d_client, graph, item['accounts'].keys(), 1, 0)
+    failed = set()
+    if invited:
+        failed = enableDetective.accept_invitations(args.assume_role, invited, graph, item['region'])
+    if verification_failed:
+        logging.error(f'Please verify account information for {verification_failed} accounts')
+        # retrying doesn't fix an email address, so these accounts get a failed item of their own,
+        # that retry_failed() queues again once the input file is corrected
+        queue.fail(queue.put(item['region'], graph, 'accept_invitations', {x: item['accounts'][x] for x in verification_failed}),
+                   f'accounts {sorted(verification_failed)} failed the email verification', max_attempts=0)
+    retry = set(remaining) | set(failed)
+    if retry:
+        # only the accounts that are not invited yet, or whose acceptance failed, are retried
+        queue.update_accounts(item['id'], {x: item['accounts'][x] for x in retry})
+        raise RetryLater(f'accounts {sorted(retry)} are not invited or accepted yet')
+
+
+def _delete_members(item: typing.Dict, admin_session: boto3.Session, queue: SqliteWorkQueue, args: argparse.Namespace):
+    d_client = admin_session.client('detective', region_name=item['region'])
+    unprocessed = {}
+    disableDetective.delete_members(d_client, item['graph'], list(item['accounts']), unprocessed)
+    retryable = {x: item['accounts'][x] for x, reason in unprocessed.items() if helper.is_retryable_reason(reason)}
+    if retryable:
+        raise RetryLater(f'accounts {sorted(retryable)} could not be deleted')
+
+
+def _delete_graph(item: typing.Dict, admin_session: boto3.Session, queue: SqliteWorkQueue, args: argparse.Namespace):
+    admin_session.client('detective', region_name=item['region']).delete_graph(GraphArn=item['graph'])
+
+
+OPERATIONS = {
+    'create_members': _create_members,
+    'accept_invitations': _accept_invitations,
+    'delete_members': _delete_members,
+    'delete_graph': _delete_graph,
+}
+
+
+def execute_item(item: typing.Dict, admin_session: boto3.Session, queue: SqliteWorkQueue, args: argparse.Namespace) -> typing.NoReturn:
+    """
+    Execute a work item, completing it or recording the failure so it gets retried.
+
+    Args:
+        - item: Work item leased from the queue.
+        - admin_session: Detective client in the specified AWS Account and Region
+        - queue: Work queue the item was leased from. Follow-up items are added to it.
+        - args: An argparse.Namespace object containing parsed arguments.
+    """
+    logging.info(f'Executing {item["operation"]} in {item["region"]} for accounts {sorted(item["accounts"])} '
+                 f'(item {item["id"]}, attempt {item["attempts"]}).')
+    try:
+        OPERATIONS[item['operation']](item, admin_session, queue, args)
+        queue.complete(item['id'])
+    except RetryLater as e:
+        if not queue.fail(item['id'], str(e), retry_delay=30, max_attempts=args.max_attempts):
+            logging.error(f'Giving up on item {item["id"]}: {e}')
+    except Exception as e:
+        logging.exception(f'error executing item {item["id"]}: {e}')
+        if not queue.fail(item['id'], repr(e), retry_delay=2 ** item['attempts'], max_attempts=args.max_attempts):
+            logging.error(f'Giving up on item {item["id"]}: {e}')
+
+
+def run_worker(queue_path: str, credentials: typing.Dict[str, str], args: argparse.Namespace,
+               poll_interval: float = 1) -> typing.NoReturn:
+    """
+    Consume work items until the queue has no unfinished item left. Runs in a worker process.
+
+    Args:
+        - queue_path: Path of the SQLite queue.
+        - credentials: Admin session credentials from helper.get_session_credentials(). The admin
+                       role is assumed again when they near expiry.
+        - args: An argparse.Namespace object containing parsed arguments.
+        - poll_interval: Seconds to wait when no item is available yet.
+    """
+    logs.setup_logging_from_args(args, fmt=f'%(asctime)s - %(levelname)s - [%(processName)s] %(message)s')
+    queue = SqliteWorkQueue(queue_path)
+    admin_session = helper.session_from_credentials(
+        credentials, sharding._refresh_admin_credentials(args, 'AmazonDetectiveMultiAccountScripts_QueueWorker'))
+    state.activate_from_args(args)
+    try:
+        while True:
+            item = queue.lease()
+            if item is not None:
+                execute_item(item, admin_session, queue, args)
+            elif queue.unfinished():
+                time.sleep(poll_interval)
+            else:
+                break
+    finally:
+        queue.close()
+        logs.stop_logging()
+
+
+def run_local_workers(queue_path: str, admin_session: boto3.Session, args: argparse.Namespace) -> typing.NoReturn:
+    """
+    Consume the queue with a pool of local worker processes.
+
+    Args:
+        - queue_path: Path of the SQLite queue.
+        - admin_session: Assumed session in the admin account. Its credentials are handed to the workers.
+        - args: An argparse.Namespace object containing parsed arguments.
+    """
+    credentials = helper.get_session_credentials(admin_session)
+    worker_args = sharding._picklable_args(args)
+    workers = [multiprocessing.Process(target=run_worker, args=(queue_path, credentials, worker_args))
+               for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+# Executors consume the queue. A distributed runner can be added here with the same signature.
+EXECUTORS = {
+    'local': run_local_workers,
+}
@@ -12,6 +12,7 @@ __email__ = "detective-demo-requests@amazon.com"
 __status__ = "Production"
 
 import argparse
+import csv
 import logging
 import re
 import sys
@@ -20,11 +21,27 @@ import typing
 import boto3
 import botocore.exceptions
 
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_deadline as deadline
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_logging as logs
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_plan as planning
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_profile as profiling
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_progress as progress
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_recording as recording
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_sharding as sharding
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_state as state
 from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_utilities as helper
 
 FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=FORMAT)
 
+# Sessions in the member accounts, by account and role. Assumed role credentials last one hour.
+_MEMBER_SESSIONS = helper.TTLCache(ttl=45 * 60)
+
+# Invitation statuses of the member accounts that are removed by disassociating from the graph.
+# The other ones, e.g. INVITED, were never accepted and are rejected.
+ASSOCIATED_STATUSES = ('ENABLED', 'ACCEPTED_BUT_DISABLED')
+MEMBER_RESULTS_COLUMNS = ['account_id', 'region', 'graph', 'status', 'action', 'outcome', 'error']
+
 
 def setup_command_line(args=None) -> argparse.Namespace:
     """
@@ -65,15 +82,53 @@ def setup_command_line(args=None) -> argparse.Namespace:
                               'and answer YES to the possible prompt.'
                               'Possible prompt including:'
                               '1.Should Amazon Detective be enabled/disabled in all regions?'))
+    parser.add_argument('--repair_attempts', type=int, default=0,
+                        help='Retry deleting the members that could not be deleted for a retryable reason at most this many times.')
+    parser.add_argument('--shards', type=int, default=1,
+                        help=('Number of worker processes. The accounts are split by hash into this many '
+                              'shards, and each process handles one shard in all the regions.'))
+    parser.add_argument('--state_file', type=str,
+                        help=('Path of a SQLite file recording the members and the history of the operations. '
+                              'Query it with queryDetectiveState.py.'))
+    parser.add_argument('--circuit_breaker_failures', type=int, default=0,
+                        help=('Stop sending work to a region after this many consecutive failures in it, '
+                              'and probe it again after --circuit_breaker_reset seconds. Disabled if 0.'))
+    parser.add_argument('--circuit_breaker_reset', type=float, default=60.0,
+                        help='Seconds before an open circuit breaker lets a probe through.')
+    parser.add_argument('--skipped_file', type=str,
+                        help=('Path of a CSV file to write the accounts skipped by an open circuit breaker to, '
+                              'to be used as the input file of a follow-up run.'))
+    parser.add_argument('--report_file', type=str,
+                        help='Path of a JSON file to write the per region outcome of each account to.')
+    parser.add_argument('--member_side', action='store_true',
+                        help=('Remove the accounts from the member side instead: assume the role in each member account once, '
+                              'then disassociate it from the graphs of the admin account, or reject the invitations it never '
+                              'accepted, in all the regions concurrently.'))
+    parser.add_argument('--member_results_file', type=str,
+                        help='With --member_side, path of a CSV file to write the result of each invitation of each account to.')
+    planning.add_command_line_arguments(parser)
+    deadline.add_command_line_arguments(parser)
+    progress.add_command_line_arguments(parser)
+    profiling.add_command_line_arguments(parser)
+    recording.add_command_line_arguments(parser)
+    parser.add_argument('--hedge_percentile', type=float,
+                        help=('Hedge the list calls: when a call has not returned after this percentile of the latency '
+                              'observed in its region (e.g. 0.95), issue a duplicate and use the first response.'))
+    logs.add_command_line_arguments(parser)
     args = parser.parse_args(args)
     if not args.delete_graph and not args.input_file:
         raise parser.error("Either an input file or the delete_graph flag should be provided.")
+    if args.member_side and (args.delete_graph or args.plan or args.approved_plan or not args.input_file):
+        raise parser.error("--member_side requires an input file, and can't be used with delete_graph or a plan.")
+    if args.member_results_file and args.shards > 1:
+        raise parser.error("--member_results_file can't be used with shards.")
 
     return args
 
 
+@profiling.timed('delete_members')
 def delete_members(d_client: botocore.client.BaseClient, graph_arn: str,
-                   account_ids: typing.List[str]) -> typing.Set[str]:
+                   account_ids: typing.List[str], unprocessed: typing.Dict[str, str] = None) -> typing.Set[str]:
     """
     delete member accounts for all accounts in the csv that are not present in the graph member set.
 
@@ -81,6 +136,7 @@ def delete_members(d_client: botocore.client.BaseClient, graph_arn: str,
         - d_client: Detective boto3 client generated from the admin session.
         - graph_arn: Graph to add members to.
         - account_dict: Accounts read from the CSV input file.
+        - unprocessed: Optional dictionary filled with the account ID and reason of each unprocessed account.
 
     Returns:
         Set with the IDs of the successfully deleted accounts.
@@ -91,13 +147,62 @@ def delete_members(d_client: botocore.client.BaseClient, graph_arn: str,
         for error in response['UnprocessedAccounts']:
             logging.exception(f'Could not delete member for account {error["AccountId"]} in '
                               f'graph {graph_arn}: {error["Reason"]}')
+            if unprocessed is not None:
+                unprocessed[error["AccountId"]] = error["Reason"]
+        region = state.region_of(d_client, graph_arn)
+        state.record_operation(region, graph_arn, 'delete_members', 'deleted', response.get('AccountIds', []))
+        state.record_operation(region, graph_arn, 'delete_members', 'failed',
+                               [x['AccountId'] for x in response['UnprocessedAccounts']],
+                               reasons={x['AccountId']: x['Reason'] for x in response['UnprocessedAccounts']})
     except Exception as e:
         logging.error(f'error when deleting member: {e}')
+        return set()
+    return set(response.get('AccountIds', []))
+
+
+def retry_delete_members(admin_session: boto3.Session, report: typing.Dict, attempts: int) -> typing.Dict:
+    """
+    Retry deleting the members that delete_members could not process with a retryable reason.
+
+    Args:
+        - admin_session: Detective client in the specified AWS Account and Region
+        - report: Report returned by process_accounts_disable_detective(). It is updated in place.
+        - attempts: Maximum number of attempts.
+
+    Returns:
+        The updated report.
+    """
+    for attempt in range(attempts):
+        if not report.get('unprocessed_delete'):
+            break
+        # back off before retrying, the accounts were most likely throttled
+        try:
+            deadline.sleep(2 ** attempt, 'delete')
+        except deadline.DeadlineExceeded as e:
+            logging.error(f'Stopping the retries, {e}.')
+            for region, accounts in report['unprocessed_delete'].items():
+                helper.add_to_report(report, 'pending', region, accounts)
+            break
+        for region, accounts in list(report['unprocessed_delete'].items()):
+            logging.info(f'Retrying to delete members {sorted(accounts)} in region {region}, attempt {attempt + 1} of {attempts}.')
+            try:
+                d_client = admin_session.client('detective', region_name=region)
+                for graph in helper.get_graphs(d_client):
+                    for batch in helper.chunked(sorted(accounts), 50):
+                        unprocessed = {}
+                        deleted = delete_members(d_client, graph, list(batch), unprocessed)
+                        helper.remove_from_report(report, 'unprocessed_delete', region, batch)
+                        helper.add_to_report(report, 'deleted', region, deleted)
+                        helper.add_to_report(report, 'unprocessed_delete', region,
+                                             [k for k, v in unprocessed.items() if helper.is_retryable_reason(v)])
+            except Exception as e:
+                logging.exception(f'error retrying to delete members in region {region}: {e}')
+    return report
 
 
 def process_accounts_disable_detective(aws_account_dict: typing.Dict,
                                        detective_regions: typing.List[str], admin_session: boto3.Session,
-                                       args: argparse.Namespace) -> typing.NoReturn:
+                                       args: argparse.Namespace) -> typing.Dict:
     """
     Process disabling in the given regions
 
@@ -106,14 +211,33 @@ def process_accounts_disable_detective(aws_account_dict: typing.Dict,
         - detective_regions: A list of the region names to disable/enable Detective from, otherwise None.
         - admin_session: Detective client in the specified AWS Account and Region
         - args: An argparse.Namespace object containing parsed arguments.
+
+    Returns:
+        Report with the accounts deleted and failed in each region.
     """
+    report = helper.new_report()
+    progress.plan_run(aws_account_dict, detective_regions, ('delete',))
     # Chunk the list of accounts in the .csv into batches of 50 due to the API limitation of 50 accounts per invocation
     for chunk in helper.chunked(aws_account_dict.items(), 50):
 
         for region in detective_regions:
+            progress_batch = progress.batch(region, len(chunk), ('delete',))
+            breaker = helper.circuit_breaker(region, 'disable')
+            # the deadline is checked first, so that a half open breaker doesn't let a probe through that never runs
+            if deadline.exhausted(['discovery', 'delete']):
+                helper.add_to_report(report, 'pending', region, [account_id for account_id, email in chunk])
+                progress_batch.close()
+                continue
+            if breaker and not breaker.allow():
+                logging.warning(f'The circuit breaker of {region} is open, skipping {len(chunk)} accounts.')
+                helper.add_to_report(report, 'circuit_open', region, [account_id for account_id, email in chunk])
+                progress_batch.close()
+                continue
+            failed = False
             try:
                 d_client = admin_session.client('detective', region_name=region)
-                graphs = helper.get_graphs(d_client)
+                with deadline.phase('discovery'):
+                    graphs = helper.get_graphs(d_client)
                 if not graphs:
                     logging.info(f'Amazon Detective has already been disabled in {region}')
                 else:
@@ -121,24 +245,204 @@ def process_accounts_disable_detective(aws_account_dict: typing.Dict,
 
                 try:
                     for graph in graphs:
-                        if not args.delete_graph:
-                            account_ids = [account_id for account_id, email in chunk]
-                            delete_members(d_client, graph, account_ids)
-                        else:
-                            d_client.delete_graph(GraphArn=graph)
+                        with deadline.phase('delete'):
+                            if not args.delete_graph:
+                                account_ids = [account_id for account_id, email in chunk]
+                                unprocessed = {}
+                                helper.add_to_report(report, 'deleted', region,
+                                                     delete_members(d_client, graph, account_ids, unprocessed))
+                                helper.add_to_report(report, 'unprocessed_delete', region,
+                                                     [k for k, v in unprocessed.items() if helper.is_retryable_reason(v)])
+                            else:
+                                d_client.delete_graph(GraphArn=graph)
+                                helper.add_to_report(report, 'graph_deleted', region, [graph])
                 except NameError as e:
                     logging.error(f'account is not defined: {e}')
+                    failed = True
+                    helper.add_to_report(report, 'failed', region, [account_id for account_id, email in chunk])
                 except Exception as e:
                     logging.exception(f'{e}')
+                    failed = True
+                    helper.add_to_report(report, 'failed', region, [account_id for account_id, email in chunk])
 
+            except deadline.DeadlineExceeded as e:
+                logging.error(f'Stopping in region {region}, {e}.')
+                helper.add_to_report(report, 'pending', region, [account_id for account_id, email in chunk])
             except NameError as e:
                 logging.error(f'account is not defined: {e}')
+                failed = True
+                helper.add_to_report(report, 'failed', region, [account_id for account_id, email in chunk])
             except Exception as e:
                 logging.exception(f'error with region {region}: {e}')
+                failed = True
+                helper.add_to_report(report, 'failed', region, [account_id for account_id, email in chunk])
+            finally:
+                progress_batch.close()
+                if breaker and failed:
+                    breaker.record_failure()
+                elif breaker:
+                    breaker.record_success()
+
+    if getattr(args, 'repair_attempts', 0) and report.get('unprocessed_delete'):
+        retry_delete_members(admin_session, report, args.repair_attempts)
+
+    return report
+
+
+
+def member_session(account: str, role: str, region: str = None) -> boto3.Session:
+    """
+    Get a session in a member account, assuming its role only once while the credentials are valid.
+
+    Args:
+        - account: Member account ID.
+        - role: Role to assume in the member account.
+        - region: Region whose STS endpoint is used with use_regional_sts_endpoints(). (Optional)
+
+    Returns:
+        boto3 session in the member account.
+    """
+    def _assume() -> boto3.Session:
+        session = helper.assume_role(account, role, "AmazonDetectiveMultiAccountScripts_DisableMembership", region)
+        if session is None:
+            raise RuntimeError(f'could not assume role {role} in account {account}')
+        return session
+    return _MEMBER_SESSIONS.get((account, role), _assume)
+
+
+def get_invitations(d_client: botocore.client.BaseClient, admin_account: str) -> typing.List[typing.Dict]:
+    """
+    Get the invitations of a member account to the graphs of the admin account, whatever their status.
+
+    Args:
+        - d_client: Detective boto3 client generated from the member session.
+        - admin_account: AccountId for Central AWS Account.
+
+    Returns:
+        List of the invitations, as returned by the ListInvitations API.
+    """
+    invitations = []
+    kwargs = {}
+    while True:
+        response = d_client.list_invitations(**kwargs)
+        # arn:partition:detective:region:admin_account:graph:id
+        invitations.extend(x for x in response.get('Invitations', []) if x['GraphArn'].split(':')[4] == admin_account)
+        if not response.get('NextToken'):
+            return invitations
+        kwargs['NextToken'] = response['NextToken']
+
+
+def remove_membership(account: str, role: str, admin_account: str,
+                      detective_regions: typing.List[str]) -> typing.List[typing.Dict]:
+    """
+    Remove a member account from the graphs of the admin account, from the member side: disassociate
+    from the graphs it is a member of, and reject the invitations it did not accept. The role is
+    assumed once, and the regions are processed concurrently.
+
+    Args:
+        - account: Member account ID.
+        - role: Role to assume in the member account.
+        - admin_account: AccountId for Central AWS Account.
+        - detective_regions: A list of the region names to remove the account from.
+
+    Returns:
+        One row with the MEMBER_RESULTS_COLUMNS keys for each invitation, or for each region
+        without any invitation or that could not be processed.
+    """
+    try:
+        session = member_session(account, role, min(detective_regions))
+        clients = helper.regional_clients(session, detective_regions)
+    except Exception as e:
+        logging.exception(f'error assuming the role in account {account}: {e}')
+        return [{'account_id': account, 'region': region, 'graph': None, 'status': None, 'action': None,
+                 'outcome': 'failed', 'error': str(e)} for region in detective_regions]
+
+    def _remove(region: str) -> typing.List[typing.Dict]:
+        rows = []
+        try:
+            invitations = get_invitations(clients[region], admin_account)
+        except Exception as e:
+            logging.exception(f'error listing the invitations of account {account} in {region}: {e}')
+            return [{'account_id': account, 'region': region, 'graph': None, 'status': None, 'action': None,
+                     'outcome': 'failed', 'error': str(e)}]
+        if not invitations:
+            return [{'account_id': account, 'region': region, 'graph': None, 'status': None, 'action': None,
+                     'outcome': 'not_member', 'error': None}]
+        for invitation in invitations:
+            graph, status = invitation['GraphArn'], invitation.get('Status')
+            row = {'account_id': account, 'region': region, 'graph': graph, 'status': status, 'error': None}
+            try:
+                if status in ASSOCIATED_STATUSES:
+                    row['action'] = 'disassociate_membership'
+                    clients[region].disassociate_membership(GraphArn=graph)
+                    row['outcome'] = 'disassociated'
+                else:
+                    row['action'] = 'reject_invitation'
+                    clients[region].reject_invitation(GraphArn=graph)
+                    row['outcome'] = 'rejected'
+            except Exception as e:
+                logging.exception(f'error removing account {account} from graph {graph}: {e}')
+                row.update(outcome='failed', error=str(e))
+            state.record_operation(region, graph, row['action'], row['outcome'], [account])
+            rows.append(row)
+        return rows
+
+    results = helper.run_in_parallel(_remove, detective_regions)
+    return [row for region in detective_regions for row in results.get(region, [])]
+
+
+def process_accounts_member_side(aws_account_dict: typing.Dict, detective_regions: typing.List[str],
+                                 admin_session: boto3.Session, args: argparse.Namespace) -> typing.Dict:
+    """
+    Remove the accounts from the graphs of the admin account from the member side, one account at a time.
+
+    Args:
+        - aws_account_dict: A dictionary where the key is account ID and value is email address.
+        - detective_regions: A list of the region names to remove the accounts from.
+        - admin_session: Detective client in the specified AWS Account and Region, not used.
+        - args: An argparse.Namespace object containing parsed arguments.
+
+    Returns:
+        Report with the accounts disassociated, rejected, not member and failed in each region. With
+        args.member_results_file, the result of each invitation is also written to that CSV file.
+    """
+    report = helper.new_report()
+    rows = []
+    progress.plan_run(aws_account_dict, detective_regions, ('delete',), batch_size=1)
+    for account in aws_account_dict:
+        if deadline.exhausted(['delete']):
+            account_rows = [{'account_id': account, 'region': region, 'graph': None, 'status': None, 'action': None,
+                             'outcome': 'pending', 'error': None} for region in detective_regions]
+        else:
+            with deadline.phase('delete'):
+                account_rows = remove_membership(account, args.assume_role, args.admin_account, detective_regions)
+            logging.info(f'Account {account}: {", ".join(sorted({row["outcome"] for row in account_rows}))}.')
+        rows.extend(account_rows)
+        for row in account_rows:
+            helper.add_to_report(report, row['outcome'], row['region'], [account])
+        for region in detective_regions:
+            progress.batch(region, 1, ('delete',)).close()
+
+    if getattr(args, 'member_results_file', None):
+        with open(args.member_results_file, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=MEMBER_RESULTS_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+        logging.info(f'The results of {len(aws_account_dict)} accounts written to {args.member_results_file}.')
+    return report
 
 
 if __name__ == '__main__':
     args = setup_command_line()
+    logs.setup_logging_from_args(args)
+    profiling.activate_from_args(args)
+    recording.activate_from_args(args)
+    if args.hedge_percentile:
+        helper.enable_hedged_reads(args.hedge_percentile)
+    state.activate_from_args(args)
+    deadline.activate_from_args(args)
+    if args.circuit_breaker_failures:
+        helper.enable_circuit_breakers(args.circuit_breaker_failures, args.circuit_breaker_reset)
     role_session_name = "AmazonDetectiveMultiAccountScripts_DisableDetective"
     aws_account_dict = helper.read_accounts_csv(args.input_file)
 
@@ -149,7 +453,37 @@ if __name__ == '__main__':
         exit(1)
 
     detective_regions, admin_session = helper.collect_session_and_regions(args.admin_account, args.assume_role,
-                                                                          args.disabled_regions, role_session_name, args.skip_prompt)
+                                                                          args.disabled_regions, role_session_name,
+                                                                          args.skip_prompt or args.plan or bool(args.approved_plan))
+
+    # with shards, each worker process reports its own progress
+    if admin_session is not None and args.shards <= 1:
+        progress.activate_from_args(args)
+        progress.instrument(admin_session)
+
+    process_func = process_accounts_member_side if args.member_side else process_accounts_disable_detective
+    if args.shards > 1:
+        process_func = sharding.sharded(process_func, args.shards)
+
+    if args.plan or args.approved_plan:
+        report = planning.run_with_plan('disable', aws_account_dict, detective_regions, admin_session, args,
+                                        process_func, parallel=args.shards <= 1)
+    else:
+        report = helper.check_region_existence_and_modify(args, detective_regions, aws_account_dict,
+                                                          admin_session, process_func)
 
-    helper.check_region_existence_and_modify(args, detective_regions, aws_account_dict,
-                                             admin_session, process_accounts_disable_detective)
+    progress.deactivate()
+    profiling.finish()
+    recording.finish()
+    helper.log_hedge_stats()
+    helper.log_circuit_breakers()
+    logs.log_report_summary(report)
+    skipped = set().union(*report.get('circuit_open', {}).values()) if report else set()
+    if skipped and args.skipped_file:
+        helper.write_accounts_csv({account: aws_account_dict[account] for account in skipped}, args.skipped_file)
+    pending = deadline.write_pending(report, aws_account_dict, args.pending_file)
+    if report is not None and args.report_file:
+        helper.write_report(report, args.report_file)
+    if pending or report and (report.get('aborted') or report.get('unprocessed_delete') or report.get('circuit_open')
+                              or args.member_side and report.get('failed')):
+        sys.exit(1)
@@ -12,20 +12,37 @@ __email__ = "detective-demo-requests@amazon.com"
 __status__ = "Production"
 
 import argparse
+import csv
+import datetime
 import logging
 import re
 import sys
-import time
 import typing
 
 import boto3
 import botocore.exceptions
 
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_deadline as deadline
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_logging as logs
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_plan as planning
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_profile as profiling
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_progress as progress
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_recording as recording
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_registry as registry
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_sharding as sharding
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_state as state
 from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_utilities as helper
 
 FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=FORMAT)
 
+# Phases of deadline budgets that adding a batch of members goes through.
+ENABLE_PHASES = ('discovery', 'create', 'wait', 'accept')
+
+# Optional datasource packages of a behavior graph. DETECTIVE_CORE is always enabled and cannot be updated.
+DATASOURCE_PACKAGES = ('EKS_AUDIT', 'ASFF_SECURITYHUB_FINDING')
+DATASOURCE_REPORT_COLUMNS = ['region', 'graph', 'account_id', 'datasource_package', 'ingest_state', 'updated_time']
+
 
 def setup_command_line(args=None) -> argparse.Namespace:
     """
@@ -43,6 +60,15 @@ def setup_command_line(args=None) -> argparse.Namespace:
             raise argparse.ArgumentTypeError
         return val
 
+    def _datasource_packages_type(val: str) -> typing.List[str]:
+        packages = [x.strip() for x in val.split(',') if x.strip()]
+        for package in packages:
+            if package == 'DETECTIVE_CORE':
+                raise argparse.ArgumentTypeError('DETECTIVE_CORE is always enabled')
+            if package not in DATASOURCE_PACKAGES:
+                raise argparse.ArgumentTypeError(f'{package} is not one of {", ".join(DATASOURCE_PACKAGES)}')
+        return packages
+
     class ParseCommaSeparatedKeyValuePairsAction(argparse.Action):
         def __call__(self, parser, namespace, values, option_string=None):
             setattr(namespace, self.dest, dict())
@@ -80,11 +106,78 @@ def setup_command_line(args=None) -> argparse.Namespace:
                         help='Comma-separated list of tag key-value pairs to be added '
                              'to any newly enabled Detective graphs. Values are optional '
                              'and are separated from keys by the equal sign (i.e. \'=\')')
-    return parser.parse_args(args)
+    parser.add_argument('--verify_emails', choices=['flag', 'exclude'],
+                        help=('Before creating members, compare the email addresses in the CSV file with the ones '
+                              'known from AWS Organizations and from existing behavior graph members. '
+                              '"flag" logs the mismatches, "exclude" also leaves those accounts out of the run.'))
+    parser.add_argument('--repair_attempts', type=int, default=0,
+                        help=('Delete the members that fail verification and create them again with the email '
+                              'address from AWS Organizations when it differs from the input file, and retry the '
+                              'accounts that could not be created, at most this many times.'))
+    parser.add_argument('--account_major_acceptance', action='store_true',
+                        help=('Gather the pending invitations of every member account in all the regions first, '
+                              'then assume the role in each member account once and accept all of its '
+                              'invitations with parallel regional calls.'))
+    parser.add_argument('--organization', action='store_true',
+                        help=('Enable the accounts of the AWS Organization without invitations: designate the admin account '
+                              'as the Detective administrator account, turn on auto-enable for new organization accounts, '
+                              'and enable the organization accounts in all the regions in parallel. Other accounts are invited. '
+                              'Must run with the credentials of the organization management account.'))
+    parser.add_argument('--sts_regional_endpoints', action='store_true',
+                        help=('Assume the roles of the member accounts through the STS endpoint of the region being '
+                              'worked on instead of the global endpoint, and log the latency of each region.'))
+    parser.add_argument('--shards', type=int, default=1,
+                        help=('Number of worker processes. The accounts are split by hash into this many '
+                              'shards, and each process handles one shard in all the regions.'))
+    parser.add_argument('--state_file', type=str,
+                        help=('Path of a SQLite file recording the members and the history of the operations. '
+                              'Query it with queryDetectiveState.py.'))
+    parser.add_argument('--state_max_age', type=int, default=0,
+                        help=('Use the members recorded in the state file instead of listing them again, when they '
+                              'were listed less than this many seconds ago. Requires --state_file.'))
+    parser.add_argument('--circuit_breaker_failures', type=int, default=0,
+                        help=('Stop sending work to a region after this many consecutive failures in it, '
+                              'and probe it again after --circuit_breaker_reset seconds. Disabled if 0.'))
+    parser.add_argument('--circuit_breaker_reset', type=float, default=60.0,
+                        help='Seconds before an open circuit breaker lets a probe through.')
+    parser.add_argument('--skipped_file', type=str,
+                        help=('Path of a CSV file to write the accounts skipped by an open circuit breaker to, '
+                              'to be used as the input file of a follow-up run.'))
+    parser.add_argument('--report_file', type=str,
+                        help='Path of a JSON file to write the per region outcome of each account to.')
+    parser.add_argument('--datasource_packages', type=_datasource_packages_type,
+                        help=('Comma-separated list of datasource packages to enable in the behavior graphs of every '
+                              f'region before adding the members: {", ".join(DATASOURCE_PACKAGES)}. Not compatible with --plan.'))
+    parser.add_argument('--datasource_report', type=str,
+                        help=('Path of a CSV file to write the ingest state of each datasource package of each '
+                              'member account to, at the end of the run.'))
+    planning.add_command_line_arguments(parser)
+    deadline.add_command_line_arguments(parser)
+    progress.add_command_line_arguments(parser)
+    profiling.add_command_line_arguments(parser)
+    recording.add_command_line_arguments(parser)
+    parser.add_argument('--hedge_percentile', type=float,
+                        help=('Hedge the list calls: when a call has not returned after this percentile of the latency '
+                              'observed in its region (e.g. 0.95), issue a duplicate and use the first response.'))
+    parser.add_argument('--reconcile_tags', choices=['add', 'exact'],
+                        help=('Also apply --tags to the existing behavior graphs of every region: add adds the missing tags '
+                              'and updates the values that differ, exact also removes the tags that are not in --tags. '
+                              'Not compatible with --plan.'))
+    logs.add_command_line_arguments(parser)
+    parsed = parser.parse_args(args)
+    if parsed.reconcile_tags and parsed.tags is None:
+        parser.error('--reconcile_tags requires --tags')
+    # the plan only covers the graphs to create and the members
+    if parsed.datasource_packages and parsed.plan:
+        parser.error('--datasource_packages is not compatible with --plan')
+    if parsed.reconcile_tags and parsed.plan:
+        parser.error('--reconcile_tags is not compatible with --plan')
+    return parsed
 
 
+@profiling.timed('create_members')
 def create_members(d_client: botocore.client.BaseClient, graph_arn: str, disable_email: bool, account_ids: typing.Set[str],
-                   account_csv: typing.Dict[str, str]) -> typing.Set[str]:
+                   account_csv: typing.Dict[str, str], unprocessed: typing.Dict[str, str] = None) -> typing.Set[str]:
     """
     Creates member accounts for all accounts in the csv that are not present in the graph member set.
 
@@ -93,6 +186,7 @@ def create_members(d_client: botocore.client.BaseClient, graph_arn: str, disable
         - graph_arn: Graph to add members to.
         - account_ids: Already present account ids in the graph.
         - account_csv: Accounts read from the CSV input file.
+        - unprocessed: Optional dictionary filled with the account ID and reason of each unprocessed account.
 
     Returns:
         Set with the IDs of the successfully created accounts.
@@ -100,7 +194,7 @@ def create_members(d_client: botocore.client.BaseClient, graph_arn: str, disable
     try:
         # I'm calculating set difference: the elements that are present in the CSV and that are not
         # present in the account_ids set.
-        set_difference = account_csv.keys() - account_ids
+        set_difference = registry.difference(account_csv, account_ids)
         if not set_difference:
             logging.info(f'No new members to create in graph {graph_arn}.')
             return set()
@@ -117,12 +211,174 @@ def create_members(d_client: botocore.client.BaseClient, graph_arn: str, disable
         for error in response['UnprocessedAccounts']:
             logging.exception(f'Could not create member for account {error["AccountId"]} in '
                               f'graph {graph_arn}: {error["Reason"]}')
+            if unprocessed is not None:
+                unprocessed[error["AccountId"]] = error["Reason"]
+        region = state.region_of(d_client, graph_arn)
+        state.record_operation(region, graph_arn, 'create_members', 'created',
+                               [x['AccountId'] for x in response['Members']], emails=account_csv)
+        state.record_operation(region, graph_arn, 'create_members', 'failed',
+                               [x['AccountId'] for x in response['UnprocessedAccounts']],
+                               reasons={x['AccountId']: x['Reason'] for x in response['UnprocessedAccounts']})
     except Exception as e:
         logging.exception(f'exception when getting memebers: {e}')
     return {x['AccountId'] for x in response['Members']}
 
 
-def accept_invitations(role: str, accounts: typing.Set[str], graph: str, region: str) -> typing.NoReturn:
+def wait_for_invitations(d_client: botocore.client.BaseClient, graph: str, account_ids: typing.Set[str],
+                         wait_loop_count: int = 6, interval: int = 30) -> (typing.Set[str], typing.Set[str], typing.Set[str]):
+    """
+    Wait for newly created members to be invited, looking up only those members.
+
+    Args:
+        - d_client: Detective boto3 client generated from the admin session.
+        - graph: Graph the accounts were added to.
+        - account_ids: Accounts to wait for.
+        - wait_loop_count: Maximum number of lookups.
+        - interval: Seconds to wait before each lookup.
+
+    Returns:
+        Three sets: the invited accounts, the accounts that failed verification and the
+        accounts that are still not invited.
+    """
+    invited, verification_failed, remaining = set(), set(), set(account_ids)
+    while remaining and wait_loop_count > 0:
+        deadline.sleep(interval)
+        wait_loop_count = wait_loop_count - 1
+        all_members, pending, verification_fail = helper.get_members_by_ids(d_client, graph, remaining)
+        invited.update(pending[graph])
+        verification_failed.update(verification_fail[graph])
+        remaining.difference_update(pending[graph], verification_fail[graph])
+    return invited, verification_failed, remaining
+
+
+def repair_members(admin_session: boto3.Session, report: typing.Dict, aws_account_dict: typing.Dict,
+                   args: argparse.Namespace) -> typing.Dict:
+    """
+    Repair the members that failed verification or that create_members could not process.
+
+    Members that failed verification are deleted and created again once, when AWS Organizations
+    has another email address for the account than the CSV file. The others would fail the same
+    way, so they are left in the verification_failed outcome. Unprocessed accounts are created
+    again. Everything is done in batches of 50 accounts, only looking up the repaired accounts,
+    for at most args.repair_attempts attempts.
+
+    Args:
+        - admin_session: Detective client in the specified AWS Account and Region
+        - report: Report returned by process_accounts_enable_detective(). It is updated in place.
+        - aws_account_dict: A dictionary where the key is account ID and value is email address.
+        - args: An argparse.Namespace object containing parsed arguments.
+
+    Returns:
+        The updated report.
+    """
+    changed_emails = {k: v for k, v in helper.get_organization_account_emails(admin_session).items()
+                      if k in aws_account_dict and v.lower() != aws_account_dict[k].lower()}
+    corrected_emails = dict(aws_account_dict)
+    corrected_emails.update(changed_emails)
+    # region -> accounts already created again with the email from AWS Organizations
+    recreated = {}
+
+    stopped = False
+    for attempt in range(args.repair_attempts):
+        if stopped:
+            break
+        verification_failed = {region: {x for x in accounts if x in changed_emails and x not in recreated.get(region, set())}
+                               for region, accounts in report.get('verification_failed', {}).items()}
+        unprocessed_create = report.get('unprocessed_create', {})
+        regions = {region for region, accounts in verification_failed.items() if accounts} | set(unprocessed_create)
+        if not regions:
+            break
+        logging.info(f'Repairing members in regions {sorted(regions)}, attempt {attempt + 1} of {args.repair_attempts}.')
+
+        for region in sorted(regions):
+            to_delete = set(verification_failed.get(region, set()))
+            recreated.setdefault(region, set()).update(to_delete)
+            to_create = to_delete | unprocessed_create.get(region, set())
+            batch, batch_accepted = (), set()
+            try:
+                d_client = admin_session.client('detective', region_name=region)
+                for graph in helper.get_graphs(d_client):
+                    for batch in helper.chunked(sorted(to_create), 50):
+                        batch_delete = [x for x in batch if x in to_delete]
+                        if batch_delete:
+                            d_client.delete_members(GraphArn=graph, AccountIds=batch_delete)
+                        unprocessed = {}
+                        created = create_members(d_client, graph, args.disable_email, set(),
+                                                 {x: corrected_emails[x] for x in batch}, unprocessed)
+                        helper.remove_from_report(report, 'verification_failed', region, batch)
+                        helper.remove_from_report(report, 'unprocessed_create', region, batch)
+                        helper.add_to_report(report, 'unprocessed_create', region,
+                                             [k for k, v in unprocessed.items() if helper.is_retryable_reason(v)])
+
+                        invited, failed, remaining = wait_for_invitations(d_client, graph, created, interval=10)
+                        batch_accepted = set()
+                        not_accepted = accept_invitations(args.assume_role, invited, graph, region, batch_accepted)
+                        accepted = {x for x in invited if x not in not_accepted}
+                        helper.add_to_report(report, 'repaired', region, accepted)
+                        helper.add_to_report(report, 'accepted', region, accepted)
+                        helper.add_to_report(report, 'failed', region, not_accepted)
+                        helper.add_to_report(report, 'verification_failed', region, failed)
+                        helper.add_to_report(report, 'recheck', region, remaining)
+            except deadline.DeadlineExceeded as e:
+                logging.error(f'Stopping the repair in region {region}, {e}.')
+                # the batch was taken out of the report when it was created again
+                helper.add_to_report(report, 'repaired', region, batch_accepted)
+                helper.add_to_report(report, 'accepted', region, batch_accepted)
+                helper.add_to_report(report, 'pending', region, [x for x in batch if x not in batch_accepted])
+                stopped = True
+                break
+            except Exception as e:
+                logging.exception(f'error repairing members in region {region}: {e}')
+
+    for outcome in ('verification_failed', 'unprocessed_create'):
+        for region, accounts in report.get(outcome, {}).items():
+            logging.error(f'Could not repair accounts {sorted(accounts)} in region {region} ({outcome}).')
+    return report
+
+
+def verify_account_emails(aws_account_dict: typing.Dict, admin_session: boto3.Session,
+                          detective_regions: typing.List[str], exclude: bool) -> (typing.Dict, typing.Dict[str, typing.Tuple[str, str]]):
+    """
+    Find the accounts whose email address in the CSV doesn't match the email address AWS already knows.
+
+    Such accounts would only show up as VERIFICATION_FAILED after the members are created, so they are
+    detected before create_members. Emails from AWS Organizations take precedence over the emails of
+    existing members of the behavior graphs.
+
+    Args:
+        - aws_account_dict: A dictionary where the key is account ID and value is email address.
+        - admin_session: Detective client in the specified AWS Account and Region
+        - detective_regions: A list of the region names to read the existing members from.
+        - exclude: Leave the mismatching accounts out of the returned accounts.
+
+    Returns:
+        The accounts to process, and a dictionary where the key is account ID and value is
+        a (CSV email, known email) tuple for each mismatch.
+    """
+    clients = helper.regional_clients(admin_session, detective_regions)
+
+    def _member_emails(region: str) -> typing.Dict[str, str]:
+        return helper.get_verified_member_emails(clients[region], helper.get_graphs(clients[region]))
+
+    known_emails = {}
+    for emails in helper.run_in_parallel(_member_emails, detective_regions).values():
+        known_emails.update(emails)
+    known_emails.update(helper.get_organization_account_emails(admin_session))
+
+    mismatches = {account: (email, known_emails[account]) for account, email in aws_account_dict.items()
+                  if account in known_emails and email.lower() != known_emails[account].lower()}
+    for account, (email, known_email) in mismatches.items():
+        logging.warning(f'Email address {email} of account {account} does not match the known email address {known_email}'
+                        + (', skipping.' if exclude else '.'))
+
+    if exclude:
+        return {k: v for k, v in aws_account_dict.items() if k not in mismatches}, mismatches
+    return aws_account_dict, mismatches
+
+
+@profiling.timed('accept_invitations')
+def accept_invitations(role: str, accounts: typing.Set[str], graph: str, region: str,
+                       accepted: typing.Set[str] = None) -> typing.Set[str]:
     """
     Accept invitation for a list of accounts in a given graph.
 
@@ -131,20 +387,77 @@ def accept_invitations(role: str, accounts: typing.Set[str], graph: str, region:
         - accounts: Set of accounts pending to accept.
         - graph: Graph the accounts are being invited to.
         - region: Region for the client
+        - accepted: Optional set the accounts are added to as soon as their invitation is accepted,
+                    so that they are known when the deadline stops the acceptance halfway.
+
+    Returns:
+        The accounts whose invitation could not be accepted.
     """
     role_session_name = "AmazonDetectiveMultiAccountScripts_AcceptInvitations"
-    try:
-        for account in accounts:
+    failed = set()
+    for account in accounts:
+        deadline.check('accept')
+        try:
             logging.info(
                 f'Accepting invitation for account {account} in graph {graph}.')
-            session = helper.assume_role(account, role, role_session_name)
+            session = helper.assume_role(account, role, role_session_name, region)
             local_client = session.client('detective', region_name=region)
             local_client.accept_invitation(GraphArn=graph)
-    except Exception as e:
-        logging.exception(f'error accepting invitation {e.args}')
+            state.record_operation(region, graph, 'accept_invitation', 'accepted', [account])
+            if accepted is not None:
+                accepted.add(account)
+        except Exception as e:
+            logging.exception(f'error accepting invitation {e.args}')
+            state.record_operation(region, graph, 'accept_invitation', 'failed', [account], reasons={account: repr(e)})
+            failed.add(account)
+    return failed
 
 
-def enable_detective(d_client: botocore.client.BaseClient, region: str, skip_prompt: bool, tags: dict = {}):
+@profiling.timed('accept_invitations')
+def accept_invitations_by_account(role: str, invitations: typing.Dict[str, typing.Set[typing.Tuple[str, str]]]) -> \
+        typing.Dict[str, typing.Set[str]]:
+    """
+    Accept all the pending invitations of each member account, assuming its role only once.
+
+    Args:
+        - role: Role to assume when accepting the invitations.
+        - invitations: A dictionary where the key is the member account ID and value is
+                       the set of (region, graph) pending invitations of that account.
+
+    Returns:
+        A dictionary where the key is a region and value is the set of accounts that accepted
+        the invitation in that region.
+    """
+    role_session_name = "AmazonDetectiveMultiAccountScripts_AcceptInvitations"
+    accepted = {}
+    for account, account_invitations in invitations.items():
+        if deadline.exhausted(['accept']):
+            logging.error('No time left to accept the remaining invitations.')
+            break
+        try:
+            logging.info(f'Accepting {len(account_invitations)} invitations for account {account}.')
+            # the role is assumed once for all the regions, through the endpoint of the first one
+            session = helper.assume_role(account, role, role_session_name, min(region for region, graph in account_invitations))
+            clients = helper.regional_clients(session, {region for region, graph in account_invitations})
+
+            def _accept(invitation: typing.Tuple[str, str]) -> str:
+                region, graph = invitation
+                clients[region].accept_invitation(GraphArn=graph)
+                return region
+
+            results = helper.run_in_parallel(_accept, account_invitations)
+            for region, graph in account_invitations:
+                outcome = 'accepted' if (region, graph) in results else 'failed'
+                state.record_operation(region, graph, 'accept_invitation', outcome, [account])
+            for region in results.values():
+                accepted.setdefault(region, set()).add(account)
+        except Exception as e:
+            logging.exception(f'error accepting invitations for account {account}: {e}')
+    return accepted
+
+
+def enable_detective(d_client: botocore.client.BaseClient, region: str, skip_prompt: bool, tags: dict = {},
+                     datasource_packages: typing.List[str] = None):
     """
     Enabling Amazon Detective in the given region
 
@@ -153,6 +466,7 @@ def enable_detective(d_client: botocore.client.BaseClient, region: str, skip_pro
         - region: A region string that is going to be enabled
         - skip_prompt: Customer agree to skip the prompt and agree to make the change
         - tags: A list of tag key-value pairs to be added to the newly enabled Detective graphs
+        - datasource_packages: Optional datasource packages to enable in the graphs, e.g. EKS_AUDIT
     """
     # Initialize the confirm variable
     confirm = 'N'
@@ -171,12 +485,367 @@ def enable_detective(d_client: botocore.client.BaseClient, region: str, skip_pro
             logging.info(f'Skipping {region}')
             return None
         logging.info(f'Amazon Detective is enabled in region {region}')
+    if datasource_packages:
+        update_datasource_packages(d_client, graphs, datasource_packages)
     return graphs
 
 
+def update_datasource_packages(d_client: botocore.client.BaseClient, graphs: typing.List[str],
+                               datasource_packages: typing.List[str]) -> typing.Set[str]:
+    """
+    Enable datasource packages in behavior graphs. The packages already enabled are left as they are.
+
+    Args:
+        - d_client: Detective boto3 client generated from the admin session.
+        - graphs: Graph arns.
+        - datasource_packages: Datasource packages to enable, see DATASOURCE_PACKAGES.
+
+    Returns:
+        Set of the graphs that were updated.
+    """
+    updated = set()
+    for graph in graphs:
+        try:
+            d_client.update_datasource_packages(GraphArn=graph, DatasourcePackages=list(datasource_packages))
+            logging.info(f'Datasource packages {", ".join(datasource_packages)} are enabled in graph {graph}.')
+            updated.add(graph)
+        except Exception as e:
+            logging.exception(f'error updating the datasource packages of graph {graph}: {e}')
+    return updated
+
+
+def enable_datasource_packages(admin_session: boto3.Session, detective_regions: typing.List[str], skip_prompt: bool,
+                               tags: dict, datasource_packages: typing.List[str]) -> typing.Dict[str, str]:
+    """
+    Enable Detective and the datasource packages in every region concurrently, before the members
+    are added.
+
+    Args:
+        - admin_session: Session in the admin account.
+        - detective_regions: A list of the region names to enable the packages in.
+        - skip_prompt: Customer agree to skip the prompt and agree to make the change
+        - tags: Tags of the graphs that are created.
+        - datasource_packages: Datasource packages to enable, see DATASOURCE_PACKAGES.
+
+    Returns:
+        A dictionary where the key is a graph and the value is updated or failed. A region whose
+        graphs could not be listed or created is failed as a whole, with the region as the key.
+    """
+    clients = helper.regional_clients(admin_session, detective_regions)
+
+    def _enable(region: str) -> typing.Dict[str, str]:
+        graphs = enable_detective(clients[region], region, skip_prompt, tags) or []
+        updated = update_datasource_packages(clients[region], graphs, datasource_packages)
+        return {graph: 'updated' if graph in updated else 'failed' for graph in graphs}
+
+    # one region at a time when the user may be asked to enable Detective
+    results = helper.run_in_parallel(_enable, detective_regions, max_workers=10 if skip_prompt else 1)
+    return {key: outcome for region in detective_regions
+            for key, outcome in results.get(region, {region: 'failed'}).items()}
+
+
+def create_graphs(aws_account_dict: typing.Dict, detective_regions: typing.List[str], admin_session: boto3.Session,
+                  args: argparse.Namespace) -> typing.Tuple[typing.List[str], typing.Dict]:
+    """
+    Enable Detective in every region before the accounts are split in shards, so that the graph of
+    a region is created once instead of once by each shard.
+
+    Args:
+        - aws_account_dict: A dictionary where the key is account ID and value is email address.
+        - detective_regions: A list of the region names to enable Detective in.
+        - admin_session: Session in the admin account.
+        - args: An argparse.Namespace object containing parsed arguments.
+
+    Returns:
+        The regions that have a graph, and a report where the accounts are failed in the regions
+        whose graphs could not be listed or created.
+    """
+    clients = helper.regional_clients(admin_session, detective_regions)
+
+    # one region at a time when the user may be asked to enable Detective
+    results = helper.run_in_parallel(lambda region: enable_detective(clients[region], region, args.skip_prompt, args.tags),
+                                     detective_regions, max_workers=10 if args.skip_prompt else 1)
+    report = helper.new_report()
+    for region in detective_regions:
+        if region not in results:
+            helper.add_to_report(report, 'failed', region, aws_account_dict.keys())
+    return [region for region in detective_regions if results.get(region)], report
+
+
+def tag_changes(current: typing.Dict[str, str], desired: typing.Dict[str, str],
+                remove_others: bool = False) -> typing.Tuple[typing.Dict[str, str], typing.List[str]]:
+    """
+    Compute the minimal changes turning the current tags of a graph into the desired ones.
+
+    Args:
+        - current: Current tags of the graph.
+        - desired: Tags the graph should have.
+        - remove_others: Also remove the current tags that are not desired, except the aws: tags
+                         that belong to AWS and cannot be removed.
+
+    Returns:
+        The tags to set, with their values, and the keys of the tags to remove.
+    """
+    to_tag = {key: value for key, value in desired.items() if current.get(key) != value}
+    to_untag = sorted(key for key in current.keys() - desired.keys() if not key.startswith('aws:')) if remove_others else []
+    return to_tag, to_untag
+
+
+def reconcile_graph_tags(admin_session: boto3.Session, detective_regions: typing.List[str], tags: typing.Dict[str, str],
+                         remove_others: bool = False) -> typing.Dict[str, str]:
+    """
+    Apply tags to the existing behavior graphs. The current tags of the graphs are read in every
+    region concurrently, and only the graphs whose tags differ are updated, concurrently.
+
+    Args:
+        - admin_session: Session in the admin account.
+        - detective_regions: A list of the region names to reconcile the graphs of.
+        - tags: Tags the graphs should have.
+        - remove_others: Also remove the tags that are not in tags.
+
+    Returns:
+        A dictionary where the key is a graph and the value is unchanged, updated or failed. A region
+        whose graphs could not be listed is failed as a whole, with the region as the key.
+    """
+    clients = helper.regional_clients(admin_session, detective_regions)
+
+    def _read(region: str) -> typing.Dict[str, typing.Optional[typing.Dict[str, str]]]:
+        graph_tags = {}
+        for graph in helper.get_graphs(clients[region]):
+            try:
+                graph_tags[graph] = clients[region].list_tags_for_resource(ResourceArn=graph).get('Tags', {})
+            except Exception as e:
+                logging.exception(f'error reading the tags of graph {graph}: {e}')
+                graph_tags[graph] = None
+        return graph_tags
+
+    read = helper.run_in_parallel(_read, detective_regions)
+    results, changes = {region: 'failed' for region in detective_regions if region not in read}, {}
+    for region, graph_tags in read.items():
+        for graph, current in graph_tags.items():
+            if current is None:
+                results[graph] = 'failed'
+            else:
+                changes[graph] = (region, *tag_changes(current, tags, remove_others))
+    results.update({graph: 'unchanged' for graph, (_, to_tag, to_untag) in changes.items() if not to_tag and not to_untag})
+    to_update = [graph for graph in changes if graph not in results]
+    if not to_update:
+        logging.info(f'The tags of the {len(changes)} behavior graphs already match.')
+        return results
+
+    def _apply(graph: str) -> str:
+        region, to_tag, to_untag = changes[graph]
+        if to_tag:
+            clients[region].tag_resource(ResourceArn=graph, Tags=to_tag)
+        if to_untag:
+            clients[region].untag_resource(ResourceArn=graph, TagKeys=to_untag)
+        logging.info(f'Tags of graph {graph} updated' + (f', set {to_tag}' if to_tag else '') +
+                     (f', removed {", ".join(to_untag)}' if to_untag else '') + '.')
+        return 'updated'
+
+    applied = helper.run_in_parallel(_apply, to_update)
+    results.update({graph: applied.get(graph, 'failed') for graph in to_update})
+    return results
+
+
+def latest_ingest_state(history: typing.Dict[str, typing.Dict]) -> typing.Tuple[typing.Optional[str], typing.Any]:
+    """
+    Args:
+        - history: Ingest history of a datasource package, mapping each ingest state to when it was entered.
+
+    Returns:
+        The current ingest state of the package, and when it was entered.
+    """
+    if not history:
+        return None, None
+    current = max(history, key=lambda x: history[x].get('Timestamp') or datetime.datetime.min.replace(tzinfo=datetime.timezone.utc))
+    return current, history[current].get('Timestamp')
+
+
+def get_member_datasources(d_client: botocore.client.BaseClient, graph: str,
+                           account_ids: typing.Iterable[str]) -> typing.Iterator[typing.Dict]:
+    """
+    Get the datasource package ingest history of members of a graph, 50 accounts per call.
+
+    Args:
+        - d_client: Detective boto3 client generated from the admin session.
+        - graph: Graph arn.
+        - account_ids: IDs of the member accounts.
+
+    Returns:
+        Iterator over the MemberDatasources returned by the BatchGetGraphMemberDatasources API.
+    """
+    for batch in helper.chunked(sorted(account_ids), 50):
+        response = d_client.batch_get_graph_member_datasources(GraphArn=graph, AccountIds=list(batch))
+        for error in response.get('UnprocessedAccounts', []):
+            logging.error(f'Could not get the datasources of account {error["AccountId"]} in graph {graph}: {error["Reason"]}')
+        yield from response.get('MemberDatasources', [])
+
+
+def datasource_report(admin_session: boto3.Session, detective_regions: typing.List[str],
+                      account_ids: typing.Iterable[str]) -> typing.List[typing.Dict]:
+    """
+    Report the current ingest state of each datasource package of each member account, the
+    regions being queried concurrently.
+
+    Args:
+        - admin_session: Session in the admin account.
+        - detective_regions: A list of the region names to report on.
+        - account_ids: IDs of the member accounts.
+
+    Returns:
+        List of rows with the DATASOURCE_REPORT_COLUMNS keys.
+    """
+    account_ids = list(account_ids)
+    clients = helper.regional_clients(admin_session, detective_regions)
+
+    def _report(region: str) -> typing.List[typing.Dict]:
+        rows = []
+        for graph in helper.get_graphs(clients[region]):
+            for member in get_member_datasources(clients[region], graph, account_ids):
+                for package, history in sorted(member.get('DatasourcePackageIngestHistory', {}).items()):
+                    ingest_state, updated = latest_ingest_state(history)
+                    rows.append({'region': region, 'graph': graph, 'account_id': member['AccountId'],
+                                 'datasource_package': package, 'ingest_state': ingest_state,
+                                 'updated_time': updated.isoformat() if isinstance(updated, datetime.datetime) else updated})
+        return rows
+
+    results = helper.run_in_parallel(_report, detective_regions)
+    return [row for region in detective_regions for row in results.get(region, [])]
+
+
+def write_datasource_report(rows: typing.List[typing.Dict], output_file: str) -> typing.NoReturn:
+    """
+    Write the rows returned by datasource_report() to a CSV file.
+    """
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=DATASOURCE_REPORT_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    logging.info(f'The datasource packages of {len({(x["region"], x["account_id"]) for x in rows})} members '
+                 f'written to {output_file}.')
+
+
+def enable_organization_admin(management_session: boto3.Session, admin_account: str,
+                              detective_regions: typing.List[str]) -> typing.Set[str]:
+    """
+    Designate the admin account as the Detective administrator account of the AWS Organization.
+
+    Args:
+        - management_session: Session in the organization management account.
+        - admin_account: AccountId for Central AWS Account.
+        - detective_regions: A list of the region names to designate the administrator account in.
+
+    Returns:
+        Set of the regions where the admin account is the administrator account.
+    """
+    clients = helper.regional_clients(management_session, detective_regions)
+
+    def _enable(region: str) -> bool:
+        administrators = clients[region].list_organization_admin_accounts().get('Administrators', [])
+        if any(x['AccountId'] == admin_account for x in administrators):
+            return True
+        clients[region].enable_organization_admin_account(AccountId=admin_account)
+        logging.info(f'Account {admin_account} is now the Detective administrator account of the organization in {region}.')
+        return True
+
+    return set(helper.run_in_parallel(_enable, detective_regions))
+
+
+def enable_organization_members(d_client: botocore.client.BaseClient, region: str, graph: str,
+                                org_accounts: typing.Dict[str, str]) -> typing.Dict:
+    """
+    Turn on auto-enable for new organization accounts and enable the existing ones as members.
+
+    Organization accounts are enabled directly by CreateMembers, without any invitation to accept.
+
+    Args:
+        - d_client: Detective boto3 client generated from the admin session.
+        - region: Region of the client.
+        - graph: Organization behavior graph of the region.
+        - org_accounts: Organization accounts, a dictionary where the key is account ID and value is email address.
+
+    Returns:
+        Report with the accounts enabled and failed in the region.
+    """
+    report = helper.new_report()
+    d_client.update_organization_configuration(GraphArn=graph, AutoEnable=True)
+    existing, pending, verification_fail = helper.get_members_by_ids(d_client, graph, org_accounts.keys())
+    for chunk_tuple in helper.chunked(sorted(org_accounts.keys() - existing[graph]), 50):
+        chunk = {x: org_accounts[x] for x in chunk_tuple}
+        unprocessed = {}
+        helper.add_to_report(report, 'enabled', region, create_members(d_client, graph, True, set(), chunk, unprocessed))
+        helper.add_to_report(report, 'unprocessed_create', region,
+                             [k for k, v in unprocessed.items() if helper.is_retryable_reason(v)])
+        helper.add_to_report(report, 'failed', region,
+                             [k for k, v in unprocessed.items() if not helper.is_retryable_reason(v)])
+    return report
+
+
+def process_accounts_organization_enable_detective(aws_account_dict: typing.Dict,
+                                                   detective_regions: typing.List[str], admin_session: boto3.Session,
+                                                   args: argparse.Namespace) -> typing.Dict:
+    """
+    Process enabling in the given regions through AWS Organizations.
+
+    The admin account is designated as the Detective administrator account of the organization, and
+    the organization accounts are enabled as members in all the regions in parallel, without invitations.
+    The accounts that are not in the organization are invited with process_accounts_enable_detective().
+    Must run with the credentials of the organization management account.
+
+    Args:
+        - aws_account_dict: A dictionary where the key is account ID and value is email address.
+        - detective_regions: A list of the region names to enable Detective in.
+        - admin_session: Detective client in the specified AWS Account and Region
+        - args: An argparse.Namespace object containing parsed arguments.
+
+    Returns:
+        Report with the accounts enabled, created, accepted and failed in each region.
+    """
+    management_session = helper.instrument_session(boto3.session.Session())
+    org_emails = helper.get_organization_account_emails(management_session)
+    org_accounts = {k: v for k, v in aws_account_dict.items() if k in org_emails}
+    other_accounts = {k: v for k, v in aws_account_dict.items() if k not in org_emails}
+    reports = []
+
+    admin_regions = enable_organization_admin(management_session, args.admin_account, detective_regions) if org_accounts else set()
+    graphs = {}
+    for region in detective_regions:
+        if region not in admin_regions:
+            if org_accounts:
+                logging.error(f'Could not designate the administrator account in {region}.')
+            continue
+        region_graphs = enable_detective(admin_session.client('detective', region_name=region), region,
+                                         args.skip_prompt, args.tags)
+        if region_graphs:
+            graphs[region] = region_graphs[0]
+
+    for region in detective_regions:
+        if org_accounts and region not in graphs:
+            report = helper.new_report()
+            helper.add_to_report(report, 'failed', region, org_accounts.keys())
+            reports.append(report)
+
+    clients = helper.regional_clients(admin_session, graphs)
+    results = helper.run_in_parallel(lambda region: enable_organization_members(clients[region], region, graphs[region], org_accounts),
+                                     graphs)
+    for region in graphs:
+        if region in results:
+            reports.append(results[region])
+        else:
+            report = helper.new_report()
+            helper.add_to_report(report, 'failed', region, org_accounts.keys())
+            reports.append(report)
+
+    if other_accounts:
+        logging.info(f'{len(other_accounts)} accounts are not in the organization, inviting them instead.')
+        reports.append(process_accounts_enable_detective(other_accounts, detective_regions, admin_session, args))
+    return helper.merge_reports(reports)
+
+
 def process_accounts_enable_detective(aws_account_dict: typing.Dict,
                                       detective_regions: typing.List[str], admin_session: boto3.Session,
-                                      args: argparse.Namespace) -> typing.NoReturn:
+                                      args: argparse.Namespace) -> typing.Dict:
     """
     Process enabling in the given regions
 
@@ -185,30 +854,61 @@ def process_accounts_enable_detective(aws_account_dict: typing.Dict,
         - detective_regions: A list of the region names to disable/enable Detective from, otherwise None.
         - admin_session: Detective client in the specified AWS Account and Region
         - args: An argparse.Namespace object containing parsed arguments.
+
+    Returns:
+        Report with the accounts created, accepted and failed in each region.
     """
+    report = helper.new_report()
+    # With account major acceptance, the invitations are gathered here and accepted at the end
+    # of the run: account -> {(region, graph)}
+    invitations = {}
+    progress.plan_run(aws_account_dict, detective_regions, ('create', 'accept'))
     # Chunk the list of accounts in the .csv into batches of 50 due to the API limitation of 50 accounts per invocation
-    for chunk_tuple in helper.chunked(aws_account_dict.items(), 50):
-        chunk = {x: y for x, y in chunk_tuple}
+    for chunk in registry.chunks(aws_account_dict, 50):
 
         for region in detective_regions:
+            progress_batch = progress.batch(region, len(chunk), ('create', 'accept'))
+            breaker = helper.circuit_breaker(region, 'enable')
+            # the deadline is checked first, so that a half open breaker doesn't let a probe through that never runs
+            if deadline.exhausted(ENABLE_PHASES):
+                helper.add_to_report(report, 'pending', region, chunk.keys())
+                progress_batch.close()
+                continue
+            if breaker and not breaker.allow():
+                logging.warning(f'The circuit breaker of {region} is open, skipping {len(chunk)} accounts.')
+                helper.add_to_report(report, 'circuit_open', region, chunk.keys())
+                progress_batch.close()
+                continue
+            failed = False
+            # filled by accept_invitations() as the invitations of the chunk are accepted
+            chunk_accepted = set()
             try:
                 d_client = admin_session.client('detective', region_name=region)
-                graphs = enable_detective(d_client, region, args.skip_prompt, args.tags)
+                with deadline.phase('discovery'):
+                    graphs = enable_detective(d_client, region, args.skip_prompt, args.tags)
 
                 if graphs is None:
                     continue
 
                 try:
-                    all_members, pending, verification_fail = helper.get_members(d_client, graphs)
+                    with deadline.phase('discovery'):
+                        all_members, pending, verification_fail = helper.get_members(d_client, graphs)
                     for graph, members in all_members.items():
-                        new_accounts = create_members(
-                            d_client, graph, args.disable_email, members, chunk)
+                        unprocessed = {}
+                        with deadline.phase('create'):
+                            new_accounts = create_members(
+                                d_client, graph, args.disable_email, members, chunk, unprocessed)
+                        progress_batch.done('create')
+                        helper.add_to_report(report, 'created', region, new_accounts)
+                        helper.add_to_report(report, 'unprocessed_create', region,
+                                             [k for k, v in unprocessed.items() if helper.is_retryable_reason(v)])
                         logging.info("Sleeping for 10s to allow new members' invitations to propagate.")
-                        time.sleep(10)
+                        deadline.sleep(10)
 
-                        # get all updated pending members from get_members()
-                        updated_all_members, updated_pending, updated_verification_fail = helper.get_members(d_client, [graph])
+                        # get the updated status of the new members only, instead of listing the whole graph again
+                        updated_all_members, updated_pending, updated_verification_fail = helper.get_members_by_ids(d_client, graph, new_accounts)
                         recheck_set, verification_pending_set = set(), set()
+                        invited_set = set(updated_pending[graph])
 
                         if updated_pending:
                             for account in new_accounts:
@@ -220,10 +920,11 @@ def process_accounts_enable_detective(aws_account_dict: typing.Dict,
                         while wait_loop_count > 0:
                             if len(recheck_set) > 0:
                                 logging.info(f'Not invited accounts found: Waiting for 30 seconds for {recheck_set} accounts')
-                                time.sleep(30)
+                                deadline.sleep(30)
                                 wait_loop_count = wait_loop_count - 1
-                                updated_all_members, updated_pending, updated_verification_fail = helper.get_members(d_client, [graph])
+                                updated_all_members, updated_pending, updated_verification_fail = helper.get_members_by_ids(d_client, graph, recheck_set)
 
+                                invited_set.update(updated_pending[graph])
                                 for account in updated_pending[graph]:
                                     recheck_set.discard(account)
 
@@ -245,30 +946,145 @@ def process_accounts_enable_detective(aws_account_dict: typing.Dict,
                         if len(verification_pending_set) > 0:
                             logging.info(f'Please verify account information for {verification_pending_set} accounts')
 
-                        if len(recheck_set) > 0 or len(verification_pending_set) > 0:
+                        # accounts that were already pending before this run, plus the new members that got invited
+                        updated_pending[graph] = pending.get(graph, set()) | invited_set
+
+                        helper.add_to_report(report, 'recheck', region, recheck_set)
+                        helper.add_to_report(report, 'verification_failed', region, verification_pending_set)
+
+                        # with repair attempts, the accounts are repaired at the end of the run instead. Otherwise the
+                        # invitations of the graph are not accepted, and the script exits with an error at the end
+                        if (len(recheck_set) > 0 or len(verification_pending_set) > 0) and not getattr(args, 'repair_attempts', 0):
                             logging.info('Please verify provided information for above listed accounts '
                                          'and run the script again with all accounts for invitation acceptance')
-                            sys.exit(1)
+                        elif getattr(args, 'account_major_acceptance', False):
+                            for account in updated_pending[graph]:
+                                invitations.setdefault(account, set()).add((region, graph))
                         else:
-                            accept_invitations(args.assume_role, updated_pending[graph], graph, region)
+                            with deadline.phase('accept'):
+                                not_accepted = accept_invitations(args.assume_role, updated_pending[graph], graph, region,
+                                                                  chunk_accepted)
+                            progress_batch.done('accept')
+                            helper.add_to_report(report, 'accepted', region,
+                                                 [x for x in updated_pending[graph] if x not in not_accepted])
+                            helper.add_to_report(report, 'failed', region, not_accepted)
 
                 except NameError as e:
                     logging.error(f'account is not defined: {e}')
+                    failed = True
+                    helper.add_to_report(report, 'failed', region, chunk.keys())
                 except Exception as e:
                     logging.exception(f'unable to accept invitiation: {e}')
+                    failed = True
+                    helper.add_to_report(report, 'failed', region, chunk.keys())
 
+            except deadline.DeadlineExceeded as e:
+                logging.error(f'Stopping in region {region}, {e}.')
+                # the invitations accepted before the deadline don't need another run
+                helper.add_to_report(report, 'accepted', region, chunk_accepted)
+                helper.add_to_report(report, 'pending', region, [x for x in chunk.keys() if x not in chunk_accepted])
             except NameError as e:
                 logging.error(f'account is not defined: {e}')
+                failed = True
+                helper.add_to_report(report, 'failed', region, chunk.keys())
             except Exception as e:
                 logging.exception(f'error with region {region}: {e}')
+                failed = True
+                helper.add_to_report(report, 'failed', region, chunk.keys())
+            finally:
+                progress_batch.close()
+                if breaker and failed:
+                    breaker.record_failure()
+                elif breaker:
+                    breaker.record_success()
+
+    if invitations:
+        accepted = {}
+        if not deadline.exhausted(['accept']):
+            with deadline.phase('accept'):
+                accepted = accept_invitations_by_account(args.assume_role, invitations)
+        for region, accounts in accepted.items():
+            helper.add_to_report(report, 'accepted', region, accounts)
+        # as in the region major acceptance, the invitations that could not be accepted are failed,
+        # unless the deadline stopped the acceptance
+        outcome = 'pending' if deadline.exhausted(['accept']) else 'failed'
+        for account, account_invitations in invitations.items():
+            for region, graph in account_invitations:
+                if account not in accepted.get(region, set()):
+                    helper.add_to_report(report, outcome, region, [account])
+
+    if getattr(args, 'repair_attempts', 0) and (report.get('verification_failed') or report.get('unprocessed_create')):
+        if deadline.exhausted(ENABLE_PHASES):
+            logging.error('No time left to repair the members.')
+        else:
+            repair_members(admin_session, report, aws_account_dict, args)
+
+    return report
 
 
 if __name__ == '__main__':
     args = setup_command_line()
+    logs.setup_logging_from_args(args)
+    profiling.activate_from_args(args)
+    recording.activate_from_args(args)
+    if args.hedge_percentile:
+        helper.enable_hedged_reads(args.hedge_percentile)
+    state.activate_from_args(args)
+    deadline.activate_from_args(args)
+    if args.circuit_breaker_failures:
+        helper.enable_circuit_breakers(args.circuit_breaker_failures, args.circuit_breaker_reset)
+    helper.use_regional_sts_endpoints(args.sts_regional_endpoints)
     role_session_name = "AmazonDetectiveMultiAccountScripts_EnableDetective"
     aws_account_dict = helper.read_accounts_csv(args.input_file)
 
     detective_regions, admin_session = helper.collect_session_and_regions(args.admin_account, args.assume_role,
-                                                                          args.enabled_regions, role_session_name, args.skip_prompt)
+                                                                          args.enabled_regions, role_session_name,
+                                                                          args.skip_prompt or args.plan or bool(args.approved_plan))
+
+    if detective_regions and args.verify_emails:
+        aws_account_dict, _ = verify_account_emails(aws_account_dict, admin_session, detective_regions,
+                                                    args.verify_emails == 'exclude')
+
+    # with shards, each worker process reports its own progress
+    if admin_session is not None and args.shards <= 1:
+        progress.activate_from_args(args)
+        progress.instrument(admin_session)
+
+    tag_results, datasource_results = {}, {}
+    if detective_regions and args.reconcile_tags:
+        tag_results = reconcile_graph_tags(admin_session, detective_regions, args.tags, args.reconcile_tags == 'exact')
+
+    if detective_regions and args.datasource_packages:
+        datasource_results = enable_datasource_packages(admin_session, detective_regions, args.skip_prompt, args.tags,
+                                                        args.datasource_packages)
+
+    process_func = process_accounts_organization_enable_detective if args.organization else process_accounts_enable_detective
+    if args.shards > 1:
+        process_func = sharding.sharded(process_func, args.shards, prepare=create_graphs)
+
+    if args.plan or args.approved_plan:
+        report = planning.run_with_plan('enable', aws_account_dict, detective_regions, admin_session, args,
+                                        process_func, parallel=args.shards <= 1)
+    else:
+        report = helper.check_region_existence_and_modify(args, detective_regions, aws_account_dict,
+                                                          admin_session, process_func)
 
-    helper.check_region_existence_and_modify(args, detective_regions, aws_account_dict, admin_session, process_accounts_enable_detective)
\ No newline at end of file
+    helper.log_sts_latency()
+    progress.deactivate()
+    profiling.finish()
+    recording.finish()
+    helper.log_hedge_stats()
+    helper.log_circuit_breakers()
+    logs.log_report_summary(report)
+    skipped = set().union(*report.get('circuit_open', {}).values()) if report else set()
+    if skipped and args.skipped_file:
+        helper.write_accounts_csv({account: aws_account_dict[account] for account in skipped}, args.skipped_file)
+    pending = deadline.write_pending(report, aws_account_dict, args.pending_file)
+    if report is not None and args.report_file:
+        helper.write_report(report, args.report_file)
+    if detective_regions and args.datasource_report:
+        write_datasource_report(datasource_report(admin_session, detective_regions, aws_account_dict.keys()),
+                                args.datasource_report)
+    if report and any(report.get(x) for x in ('aborted', 'recheck', 'verification_failed', 'unprocessed_create', 'circuit_open')) or pending \
+            or 'failed' in tag_results.values() or 'failed' in datasource_results.values():
+        sys.exit(1)
\ No newline at end of file
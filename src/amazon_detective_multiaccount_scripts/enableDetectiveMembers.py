@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" python3 enableDetectiveMembers.py --admin_account 555555555555 --assume_role detectiveAdmin --accounts 111111111111:member@example.com
+
+Fast path to add one or a few accounts (e.g. a newly created account) as members in every region at once,
+without listing the members of the behavior graphs.
+"""
+__author__ = "Amazon Detective"
+__copyright__ = "Amazon 2020"
+__credits__ = "Amazon Detective"
+__license__ = "Apache"
+__version__ = "1.1.0"
+__maintainer__ = "Amazon Detective"
+__email__ = "detective-demo-requests@amazon.com"
+__status__ = "Production"
+
+import argparse
+import logging
+import re
+import sys
+import typing
+
+import boto3
+
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_logging as logs
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_recording as recording
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_utilities as helper
+from amazon_detective_multiaccount_scripts import enableDetective
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=FORMAT)
+
+
+def setup_command_line(args=None) -> argparse.Namespace:
+    """
+    Configures and reads command line arguments.
+
+    Returns:
+        An argparse.Namespace object containing parsed arguments.
+
+    Raises:
+        argpare.ArgumentTypeError if an invalid value is used for
+        admin_account or accounts argument.
+    """
+    def _admin_account_type(val: str, pattern: str = r'[0-9]{12}'):
+        if not re.match(pattern, val):
+            raise argparse.ArgumentTypeError
+        return val
+
+    def _accounts_type(val: str, pattern: str = r'[0-9]{12}:[^,:]+@[^,:]+$'):
+        accounts = {}
+        for account in val.split(','):
+            if not re.match(pattern, account):
+                raise argparse.ArgumentTypeError
+            account_id, _, email = account.partition(':')
+            accounts[account_id] = email
+        return accounts
+
+    parser = argparse.ArgumentParser(description=('Link a few AWS Accounts to central Detective Account '
+                                                  'in all the regions at once.'))
+    parser.add_argument('--admin_account', type=_admin_account_type,
+                        required=True,
+                        help="AccountId for Central AWS Account.")
+    parser.add_argument('--accounts', type=_accounts_type, required=True,
+                        help='Comma-separated list of AccountId:EmailAddress pairs to add as members.')
+    parser.add_argument('--assume_role', type=str, required=True,
+                        help="Role Name to assume in each account.")
+    parser.add_argument('--enabled_regions', type=str,
+                        help=('Regions to add the members in. If not specified, '
+                              'all available regions.'))
+    parser.add_argument('--disable_email', action='store_true',
+                        help=('Don\'t send emails to the member accounts. Member '
+                              'accounts must still accept the invitation before '
+                              'they are added to the behavior graph.'))
+    parser.add_argument('--sts_regional_endpoints', action='store_true',
+                        help=('Assume the roles of the member accounts through the STS endpoint of the region being '
+                              'worked on instead of the global endpoint, and log the latency of each region.'))
+    parser.add_argument('--report_file', type=str,
+                        help='Path of a JSON file to write the per region outcome of each account to.')
+    recording.add_command_line_arguments(parser)
+    logs.add_command_line_arguments(parser)
+    return parser.parse_args(args)
+
+
+def add_members_in_region(d_client, region: str, accounts: typing.Dict[str, str], disable_email: bool,
+                          wait_loop_count: int = 30, interval: int = 2) -> typing.Dict:
+    """
+    Create the members in the graphs of a region and wait until they are invited.
+
+    Only the given accounts are looked up, using the GetMembers API.
+
+    Args:
+        - d_client: Detective boto3 client generated from the admin session.
+        - region: Region of the client.
+        - accounts: A dictionary where the key is account ID and value is email address.
+        - disable_email: Don't send invitation emails to the member accounts.
+        - wait_loop_count: Maximum number of lookups while waiting for the invitations.
+        - interval: Seconds to wait before each lookup.
+
+    Returns:
+        Report of the region, and the pending invitations as a dictionary where the key is the account ID
+        and value is the set of (region, graph) invitations.
+    """
+    report, invitations = helper.new_report(), {}
+    graphs = helper.get_graphs(d_client)
+    if not graphs:
+        logging.info(f'Amazon Detective is not enabled in {region}, skipping.')
+        helper.add_to_report(report, 'skipped', region, accounts.keys())
+        return report, invitations
+
+    for graph in graphs:
+        existing, pending, verification_fail = helper.get_members_by_ids(d_client, graph, accounts.keys())
+        unprocessed = {}
+        created = enableDetective.create_members(d_client, graph, disable_email, existing[graph], accounts, unprocessed)
+        helper.add_to_report(report, 'created', region, created)
+        helper.add_to_report(report, 'failed', region, unprocessed.keys())
+
+        invited, failed, remaining = enableDetective.wait_for_invitations(d_client, graph, created, wait_loop_count, interval)
+        helper.add_to_report(report, 'verification_failed', region, failed | verification_fail[graph])
+        helper.add_to_report(report, 'recheck', region, remaining)
+        for account in invited | pending[graph]:
+            invitations.setdefault(account, set()).add((region, graph))
+    return report, invitations
+
+
+def fast_path_enable_members(admin_session: boto3.Session, accounts: typing.Dict[str, str], detective_regions: typing.List[str],
+                             role: str, disable_email: bool = False) -> typing.Dict:
+    """
+    Add a few accounts as members in all the regions in parallel, then accept the invitations
+    assuming the role of each account only once.
+
+    Args:
+        - admin_session: Detective client in the specified AWS Account and Region
+        - accounts: A dictionary where the key is account ID and value is email address.
+        - detective_regions: A list of the region names to add the members in.
+        - role: Role to assume when accepting the invitations.
+        - disable_email: Don't send invitation emails to the member accounts.
+
+    Returns:
+        Report with the accounts created, accepted and failed in each region.
+    """
+    clients = helper.regional_clients(admin_session, detective_regions)
+    results = helper.run_in_parallel(lambda region: add_members_in_region(clients[region], region, accounts, disable_email),
+                                     detective_regions)
+
+    reports, invitations = [], {}
+    for region in detective_regions:
+        if region not in results:
+            report = helper.new_report()
+            helper.add_to_report(report, 'failed', region, accounts.keys())
+            reports.append(report)
+            continue
+        report, region_invitations = results[region]
+        reports.append(report)
+        for account, account_invitations in region_invitations.items():
+            invitations.setdefault(account, set()).update(account_invitations)
+
+    report = helper.merge_reports(reports)
+    accepted = enableDetective.accept_invitations_by_account(role, invitations)
+    for region, accounts in accepted.items():
+        helper.add_to_report(report, 'accepted', region, accounts)
+    for account, account_invitations in invitations.items():
+        for region, graph in account_invitations:
+            if account not in accepted.get(region, set()):
+                helper.add_to_report(report, 'failed', region, [account])
+    return report
+
+
+if __name__ == '__main__':
+    args = setup_command_line()
+    logs.setup_logging_from_args(args)
+    recording.activate_from_args(args)
+    helper.use_regional_sts_endpoints(args.sts_regional_endpoints)
+    role_session_name = "AmazonDetectiveMultiAccountScripts_EnableDetectiveMembers"
+    session = helper.instrument_session(boto3.session.Session())
+    detective_regions = helper.get_regions(session, True, args.enabled_regions)
+    admin_session = helper.assume_role(args.admin_account, args.assume_role, role_session_name)
+
+    report = fast_path_enable_members(admin_session, args.accounts, detective_regions, args.assume_role, args.disable_email)
+
+    recording.finish()
+    helper.log_sts_latency()
+    logs.log_report_summary(report)
+    if args.report_file:
+        helper.write_report(report, args.report_file)
+    if any(report.get(x) for x in ('failed', 'recheck', 'verification_failed')):
+        sys.exit(1)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" python3 inventoryDetective.py --admin_account 555555555555 --assume_role detectiveAdmin --output_file members.csv --format csv
+
+Export every member of every behavior graph in every region, with its status, email address,
+invitation time and datasource package status. The regions are listed concurrently, and the rows
+are written as they arrive, so the memory used does not grow with the number of members.
+"""
+__author__ = "Amazon Detective"
+__copyright__ = "Amazon 2020"
+__credits__ = "Amazon Detective"
+__license__ = "Apache"
+__version__ = "1.1.0"
+__maintainer__ = "Amazon Detective"
+__email__ = "detective-demo-requests@amazon.com"
+__status__ = "Production"
+
+import argparse
+import concurrent.futures
+import csv
+import datetime
+import json
+import logging
+import queue
+import re
+import sys
+import threading
+import typing
+
+import boto3
+
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_logging as logs
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_utilities as helper
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, stream=sys.stderr, format=FORMAT)
+
+COLUMNS = ['region', 'graph', 'account_id', 'email', 'status', 'invitation_type', 'invited_time', 'updated_time',
+           'disabled_reason', 'datasource_packages']
+
+# Maximum number of rows waiting to be written. The regions wait when it is reached.
+MAX_PENDING_ROWS = 1000
+
+
+def setup_command_line(args=None) -> argparse.Namespace:
+    """
+    Configures and reads command line arguments.
+
+    Returns:
+        An argparse.Namespace object containing parsed arguments.
+
+    Raises:
+        argpare.ArgumentTypeError if an invalid value is used for
+        admin_account argument.
+    """
+    def _admin_account_type(val: str, pattern: str = r'[0-9]{12}'):
+        if not re.match(pattern, val):
+            raise argparse.ArgumentTypeError
+        return val
+
+    parser = argparse.ArgumentParser(description='Export the members of the Detective behavior graphs of every region.')
+    parser.add_argument('--admin_account', type=_admin_account_type,
+                        required=True,
+                        help="AccountId for Central AWS Account.")
+    parser.add_argument('--assume_role', type=str, required=True,
+                        help="Role Name to assume in the admin account.")
+    parser.add_argument('--regions', type=str,
+                        help=('Regions to export the members of. If not specified, '
+                              'all available regions.'))
+    parser.add_argument('--output_file', type=argparse.FileType('w'), default=sys.stdout,
+                        help='Path of the file to write. Standard output if not specified.')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl',
+                        help='One JSON object per line, or CSV with a header line.')
+    parser.add_argument('--max_workers', type=int, default=10,
+                        help='Number of regions listed concurrently.')
+    parser.add_argument('--hedge_percentile', type=float,
+                        help=('Hedge the list calls: when a call has not returned after this percentile of the latency '
+                              'observed in its region (e.g. 0.95), issue a duplicate and use the first response.'))
+    logs.add_command_line_arguments(parser)
+    return parser.parse_args(args)
+
+
+def _time(value) -> typing.Optional[str]:
+    return value.isoformat() if isinstance(value, datetime.datetime) else value
+
+
+def member_row(region: str, graph: str, member: typing.Dict) -> typing.Dict:
+    """
+    Convert the member details returned by the ListMembers API into an inventory row.
+
+    Args:
+        - region: Region of the graph.
+        - graph: Graph arn.
+        - member: Member details.
+
+    Returns:
+        Dictionary with the COLUMNS keys.
+    """
+    return {'region': region, 'graph': graph, 'account_id': member['AccountId'], 'email': member.get('EmailAddress'),
+            'status': member.get('Status'), 'invitation_type': member.get('InvitationType'),
+            'invited_time': _time(member.get('InvitedTime')), 'updated_time': _time(member.get('UpdatedTime')),
+            'disabled_reason': member.get('DisabledReason'),
+            'datasource_packages': {package: details.get('DatasourcePackageIngestState')
+                                    for package, details in member.get('DatasourcePackageIngestStates', {}).items()}}
+
+
+def stream_inventory(admin_session: boto3.Session, detective_regions: typing.List[str], max_workers: int = 10,
+                     failed_regions: typing.Set[str] = None) -> typing.Iterator[typing.Dict]:
+    """
+    List the members of every graph of every region concurrently, yielding the rows as they arrive.
+
+    Args:
+        - admin_session: Session in the admin account.
+        - detective_regions: A list of the region names to list the members of.
+        - max_workers: Number of regions listed concurrently.
+        - failed_regions: Optional set filled with the regions that could not be fully listed.
+
+    Returns:
+        Iterator over the rows, see member_row().
+    """
+    rows = queue.Queue(maxsize=MAX_PENDING_ROWS)
+    done = object()
+    # set when the consumer stops early, so that the regions don't wait forever for room in the queue
+    stop = threading.Event()
+    clients = helper.regional_clients(admin_session, detective_regions)
+
+    def _put(row) -> bool:
+        while not stop.is_set():
+            try:
+                rows.put(row, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _list_region(region: str) -> typing.NoReturn:
+        try:
+            for graph in helper.iter_graphs(clients[region]):
+                for page in helper.iter_member_pages(clients[region], graph['Arn']):
+                    for member in page:
+                        if not _put(member_row(region, graph['Arn'], member)):
+                            return
+        except Exception as e:
+            logging.exception(f'error listing the members in {region}: {e}')
+            if failed_regions is not None:
+                failed_regions.add(region)
+        finally:
+            _put(done)
+
+    if not detective_regions:
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(detective_regions))) as executor:
+        for region in detective_regions:
+            executor.submit(_list_region, region)
+        try:
+            remaining = len(detective_regions)
+            while remaining:
+                row = rows.get()
+                if row is done:
+                    remaining -= 1
+                else:
+                    yield row
+        finally:
+            stop.set()
+
+
+def write_inventory(rows: typing.Iterable[typing.Dict], output: typing.IO, output_format: str) -> int:
+    """
+    Write the rows one at a time.
+
+    Args:
+        - rows: Rows returned by stream_inventory().
+        - output: File to write to.
+        - output_format: jsonl or csv.
+
+    Returns:
+        Number of rows written.
+    """
+    count = 0
+    writer = None
+    if output_format == 'csv':
+        writer = csv.DictWriter(output, fieldnames=COLUMNS)
+        writer.writeheader()
+    for row in rows:
+        if writer:
+            writer.writerow(dict(row, datasource_packages=json.dumps(row['datasource_packages'], sort_keys=True)))
+        else:
+            output.write(json.dumps(row, sort_keys=True) + '\n')
+        count += 1
+    output.flush()
+    return count
+
+
+if __name__ == '__main__':
+    args = setup_command_line()
+    # the rows may be written to stdout
+    logs.setup_logging_from_args(args, stream=sys.stderr)
+    if args.hedge_percentile:
+        helper.enable_hedged_reads(args.hedge_percentile)
+    role_session_name = "AmazonDetectiveMultiAccountScripts_InventoryDetective"
+    detective_regions, admin_session = helper.collect_session_and_regions(args.admin_account, args.assume_role,
+                                                                          args.regions, role_session_name, True)
+
+    failed_regions = set()
+    count = write_inventory(stream_inventory(admin_session, detective_regions, args.max_workers, failed_regions),
+                            args.output_file, args.format)
+    helper.log_hedge_stats()
+    logging.info(f'Exported {count} members from {len(detective_regions)} regions.')
+    if failed_regions:
+        logging.error(f'The members of these regions could not be fully listed: {sorted(failed_regions)}')
+        sys.exit(1)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" python3 queryDetectiveState.py --state_file detective.db --members --region ap-southeast-2 --status INVITED
+    python3 queryDetectiveState.py --state_file detective.db --history --account_id 111111111111 --operation accept_invitation --outcome failed
+
+Query the state file recorded by the scripts with --state_file. The rows are written as CSV to stdout.
+"""
+__author__ = "Amazon Detective"
+__copyright__ = "Amazon 2020"
+__credits__ = "Amazon Detective"
+__license__ = "Apache"
+__version__ = "1.1.0"
+__maintainer__ = "Amazon Detective"
+__email__ = "detective-demo-requests@amazon.com"
+__status__ = "Production"
+
+import argparse
+import csv
+import datetime
+import logging
+import os
+import sys
+import typing
+
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_state as state
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, stream=sys.stderr, format=FORMAT)
+
+
+def setup_command_line(args=None) -> argparse.Namespace:
+    """
+    Configures and reads command line arguments.
+
+    Returns:
+        An argparse.Namespace object containing parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description='Query the members and the history of the operations recorded in a state file.')
+    parser.add_argument('--state_file', type=str, required=True,
+                        help='Path of the SQLite file given to the scripts with --state_file.')
+    query = parser.add_mutually_exclusive_group(required=True)
+    query.add_argument('--members', action='store_true',
+                       help='List the members.')
+    query.add_argument('--history', action='store_true',
+                       help='List the operations, most recent first.')
+    parser.add_argument('--region', type=str,
+                        help='Only this region.')
+    parser.add_argument('--account_id', type=str,
+                        help='Only this account.')
+    parser.add_argument('--status', type=str,
+                        help='Only the members with this status, e.g. INVITED.')
+    parser.add_argument('--operation', choices=state.OPERATIONS,
+                        help='Only this operation.')
+    parser.add_argument('--outcome', type=str,
+                        help='Only this outcome, e.g. failed.')
+    parser.add_argument('--limit', type=int, default=100,
+                        help='Maximum number of operations listed.')
+    args = parser.parse_args(args)
+    if not os.path.exists(args.state_file):
+        raise parser.error(f"The state file {args.state_file} does not exist.")
+
+    return args
+
+
+def query_state(store: state.StateStore, args: argparse.Namespace) -> typing.List[typing.Dict]:
+    """
+    Run the query described by the command line arguments.
+
+    Args:
+        - store: State store to query.
+        - args: An argparse.Namespace object containing parsed arguments.
+
+    Returns:
+        The rows, with the timestamps as ISO 8601 strings.
+    """
+    if args.members:
+        rows = store.members(args.region, args.status, args.account_id)
+        time_column = 'updated_at'
+    else:
+        rows = store.history(args.account_id, args.region, args.operation, args.outcome, args.limit)
+        time_column = 'at'
+    for row in rows:
+        row[time_column] = datetime.datetime.fromtimestamp(row[time_column], datetime.timezone.utc).isoformat()
+    return rows
+
+
+if __name__ == '__main__':
+    args = setup_command_line()
+    store = state.StateStore(args.state_file)
+    rows = query_state(store, args)
+    store.close()
+
+    if rows:
+        writer = csv.DictWriter(sys.stdout, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        logging.info('No matching rows.')
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" python3 queueDetective.py --queue_file detective.db --action produce --operation enable --admin_account 555555555555 --assume_role detectiveAdmin --input_file accounts.csv --skip_prompt
+    python3 queueDetective.py --queue_file detective.db --action work --admin_account 555555555555 --assume_role detectiveAdmin --workers 8
+    python3 queueDetective.py --queue_file detective.db --action status
+
+Enable or disable Detective members through a durable work queue. The producer emits one work item
+per region, graph, operation and batch of accounts, and workers consume them. Failed items can be
+retried on their own with --action retry.
+"""
+__author__ = "Amazon Detective"
+__copyright__ = "Amazon 2020"
+__credits__ = "Amazon Detective"
+__license__ = "Apache"
+__version__ = "1.1.0"
+__maintainer__ = "Amazon Detective"
+__email__ = "detective-demo-requests@amazon.com"
+__status__ = "Production"
+
+import argparse
+import functools
+import logging
+import re
+import sys
+
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_logging as logs
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_state as state
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_utilities as helper
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_workqueue as workqueue
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=FORMAT)
+
+
+def setup_command_line(args=None) -> argparse.Namespace:
+    """
+    Configures and reads command line arguments.
+
+    Returns:
+        An argparse.Namespace object containing parsed arguments.
+
+    Raises:
+        argpare.ArgumentTypeError if an invalid value is used for
+        admin_account argument.
+    """
+    def _admin_account_type(val: str, pattern: str = r'[0-9]{12}'):
+        if not re.match(pattern, val):
+            raise argparse.ArgumentTypeError
+        return val
+
+    parser = argparse.ArgumentParser(description='Enable or disable Detective members through a durable work queue.')
+    parser.add_argument('--queue_file', type=str, required=True,
+                        help='Path of the SQLite file holding the work queue. It is created if needed.')
+    parser.add_argument('--action', choices=['produce', 'work', 'run', 'status', 'retry'], required=True,
+                        help=('produce: queue the work items. work: consume the queue. run: produce then work. '
+                              'status: show the items of each status. retry: queue the failed items again.'))
+    parser.add_argument('--operation', choices=['enable', 'disable'], default='enable',
+                        help='Whether the produced items enable or disable the members.')
+    parser.add_argument('--admin_account', type=_admin_account_type,
+                        help="AccountId for Central AWS Account.")
+    parser.add_argument('--input_file', type=argparse.FileType('r'),
+                        help=('Path to CSV file containing the list of '
+                              'account IDs and Email addresses.'))
+    parser.add_argument('--assume_role', type=str,
+                        help="Role Name to assume in each account.")
+    parser.add_argument('--regions', type=str,
+                        help=('Regions to produce work items for. If not specified, '
+                              'all available regions.'))
+    parser.add_argument('--delete_graph', action='store_true',
+                        help='With the disable operation, delete the admin Detective graphs.')
+    parser.add_argument('--disable_email', action='store_true',
+                        help=('Don\'t send emails to the member accounts. Member '
+                              'accounts must still accept the invitation before '
+                              'they are added to the behavior graph.'))
+    parser.add_argument('--skip_prompt', action='store_true',
+                        help=('Skip the prompt in the script, '
+                              'and answer YES to the possible prompt.'))
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of local worker processes.')
+    parser.add_argument('--executor', choices=sorted(workqueue.EXECUTORS), default='local',
+                        help='How the work items are executed.')
+    parser.add_argument('--max_attempts', type=int, default=5,
+                        help='Attempts of a work item before it is marked as failed.')
+    parser.add_argument('--state_file', type=str,
+                        help=('Path of a SQLite file recording the members and the history of the operations. '
+                              'Query it with queryDetectiveState.py.'))
+    logs.add_command_line_arguments(parser)
+    args = parser.parse_args(args)
+    if args.action in ('produce', 'work', 'run') and not (args.admin_account and args.assume_role):
+        raise parser.error("The admin_account and assume_role arguments are required to produce or work.")
+    if args.action in ('produce', 'run') and not args.input_file and not args.delete_graph:
+        raise parser.error("Either an input file or the delete_graph flag should be provided.")
+
+    return args
+
+
+if __name__ == '__main__':
+    args = setup_command_line()
+    logs.setup_logging_from_args(args)
+    state.activate_from_args(args)
+    role_session_name = "AmazonDetectiveMultiAccountScripts_QueueDetective"
+    queue = workqueue.SqliteWorkQueue(args.queue_file)
+
+    if args.action == 'status':
+        logging.info(f'Work items by status: {queue.counts()}')
+        for item in queue.failed_items():
+            logging.error(f'Item {item["id"]} {item["operation"]} in {item["region"]} for accounts '
+                          f'{sorted(item["accounts"])} failed: {item["last_error"]}')
+    elif args.action == 'retry':
+        logging.info(f'Queued {queue.retry_failed()} failed items again.')
+    else:
+        detective_regions, admin_session = helper.collect_session_and_regions(args.admin_account, args.assume_role,
+                                                                              args.regions, role_session_name, args.skip_prompt)
+        if admin_session is None:
+            sys.exit(1)
+        if args.action in ('produce', 'run'):
+            aws_account_dict = helper.read_accounts_csv(args.input_file)
+            helper.check_region_existence_and_modify(args, detective_regions, aws_account_dict, admin_session,
+                                                     functools.partial(workqueue.produce_work_items, queue))
+        if args.action in ('work', 'run'):
+            workqueue.EXECUTORS[args.executor](args.queue_file, admin_session, args)
+        counts = queue.counts()
+        logging.info(f'Work items by status: {counts}')
+        if counts.get('failed'):
+            sys.exit(1)
+    queue.close()
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" python3 watchDetective.py --admin_account 555555555555 --assume_role detectiveAdmin --input_file accounts.csv --health_port 8080
+
+Resident process keeping the members of the behavior graphs of every region in line with an input
+file, local or s3://bucket/key, instead of full runs launched by cron.
+
+Each cycle re-reads the input file if it changed, lists the members of every region concurrently,
+and only submits the accounts that are not enabled in every region yet: a few accounts go through
+the fast path of enableDetectiveMembers.py, more accounts or missing graphs through
+enableDetective.py. The session in the admin account, the clients and the region catalog are kept
+warm by the programmatic API between cycles.
+
+The cycles follow each other quickly after a change, and slow down to --max_interval once every
+region has converged. An account that stays pending is retried with an increasing delay.
+
+With --health_port, /healthz answers 200 while the cycles succeed, and /metrics exposes the
+pending accounts and the convergence lag of each region in the Prometheus text format.
+"""
+__author__ = "Amazon Detective"
+__copyright__ = "Amazon 2020"
+__credits__ = "Amazon Detective"
+__license__ = "Apache"
+__version__ = "1.1.0"
+__maintainer__ = "Amazon Detective"
+__email__ = "detective-demo-requests@amazon.com"
+__status__ = "Production"
+
+import argparse
+import http.server
+import json
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+import time
+import typing
+
+import boto3
+
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_api as api
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_logging as logs
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_utilities as helper
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=FORMAT)
+
+# Accounts submitted at once through the fast path, more go through the full enable run.
+FAST_PATH_MAX_ACCOUNTS = 50
+
+
+def setup_command_line(args=None) -> argparse.Namespace:
+    """
+    Configures and reads command line arguments.
+
+    Returns:
+        An argparse.Namespace object containing parsed arguments.
+
+    Raises:
+        argpare.ArgumentTypeError if an invalid value is used for
+        admin_account argument.
+    """
+    def _admin_account_type(val: str, pattern: str = r'[0-9]{12}'):
+        if not re.match(pattern, val):
+            raise argparse.ArgumentTypeError
+        return val
+
+    parser = argparse.ArgumentParser(description=('Keep the members of the Detective behavior graphs of every region '
+                                                  'in line with an input file.'))
+    parser.add_argument('--admin_account', type=_admin_account_type,
+                        required=True,
+                        help="AccountId for Central AWS Account.")
+    parser.add_argument('--assume_role', type=str, required=True,
+                        help="Role Name to assume in each account.")
+    parser.add_argument('--input_file', type=str, required=True,
+                        help=('Path or s3://bucket/key of the CSV file containing the list of account IDs and Email '
+                              'addresses, read again at every cycle.'))
+    parser.add_argument('--regions', type=str,
+                        help=('Regions to watch. If not specified, '
+                              'all available regions.'))
+    parser.add_argument('--disable_email', action='store_true',
+                        help=('Don\'t send emails to the member accounts. Member '
+                              'accounts must still accept the invitation before '
+                              'they are added to the behavior graph.'))
+    parser.add_argument('--remove_absent', action='store_true',
+                        help='Also remove the members whose account is removed from the input file while watching.')
+    parser.add_argument('--min_interval', type=float, default=30.0,
+                        help='Seconds between two cycles after a change.')
+    parser.add_argument('--max_interval', type=float, default=600.0,
+                        help='Seconds between two cycles once every region has converged.')
+    parser.add_argument('--backoff', type=float, default=2.0,
+                        help='Factor the interval between two cycles grows by while nothing changes.')
+    parser.add_argument('--health_host', type=str, default='127.0.0.1',
+                        help='Address the health and metrics endpoint listens on.')
+    parser.add_argument('--health_port', type=int, default=0,
+                        help='Port of the /healthz and /metrics endpoint. Disabled if 0.')
+    parser.add_argument('--max_cycles', type=int, default=0,
+                        help='Stop after this many cycles. Run until interrupted if 0.')
+    logs.add_command_line_arguments(parser)
+    return parser.parse_args(args)
+
+
+class Watcher:
+    """
+    Reconciles the members of every region with the input file, one cycle at a time.
+
+    Args:
+        - admin_account: AccountId for Central AWS Account.
+        - role: Role Name to assume in each account.
+        - source: Path or s3://bucket/key of the input file.
+        - regions: Comma separated regions, every Detective region if not provided.
+        - disable_email: Don't send invitation emails to the member accounts.
+        - remove_absent: Remove the members whose account is removed from the input file.
+        - min_interval: Seconds between two cycles after a change.
+        - max_interval: Seconds between two cycles once every region has converged.
+        - backoff: Factor the interval grows by while nothing changes.
+        - clock: Source of the current time.
+    """
+
+    def __init__(self, admin_account: str, role: str, source: str, regions: str = None, disable_email: bool = False,
+                 remove_absent: bool = False, min_interval: float = 30.0, max_interval: float = 600.0,
+                 backoff: float = 2.0, clock: typing.Callable[[], float] = time.time):
+        self.admin_account = admin_account
+        self.role = role
+        self.source = source
+        self.regions = regions
+        self.disable_email = disable_email
+        self.remove_absent = remove_absent
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self._clock = clock
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._desired = None
+        self._signature = None
+        self._source_session = None
+        # account -> [submissions, time of the next one]
+        self._attempts = {}
+        # accounts removed from the input file that are still to be removed from the graphs
+        self._absent = {}
+        # region -> time its members stopped matching the input file
+        self._unconverged_since = {}
+        self.interval = min_interval
+        self.cycles = 0
+        self.errors = 0
+        self.submitted = 0
+        self.last_success = None
+        self.pending = {}
+
+    def read_source(self) -> typing.Tuple[typing.Mapping[str, str], bool]:
+        """
+        Returns:
+            The accounts of the input file, and whether they changed since the last cycle. A local
+            file is only parsed again when its size or modification time changed.
+        """
+        if self.source.startswith('s3://'):
+            if self._source_session is None:
+                self._source_session = boto3.Session()
+            desired = api.read_accounts_s3(self._source_session, self.source)
+        else:
+            stat = os.stat(self.source)
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if signature == self._signature:
+                return self._desired, False
+            with open(self.source) as f:
+                desired = helper.read_accounts_csv(f)
+            self._signature = signature
+        changed = self._desired is None or desired != self._desired
+        self._desired = desired
+        return desired, changed
+
+    def _due(self, account: str, now: float) -> bool:
+        entry = self._attempts.get(account)
+        return entry is None or now >= entry[1]
+
+    def _submitted(self, accounts: typing.Iterable[str], now: float) -> typing.NoReturn:
+        for account in accounts:
+            entry = self._attempts.setdefault(account, [0, now])
+            entry[1] = now + min(self.max_interval, self.min_interval * self.backoff ** entry[0])
+            entry[0] += 1
+
+    def cycle(self) -> float:
+        """
+        Reconcile the members once.
+
+        Returns:
+            Seconds to wait before the next cycle.
+        """
+        now = self._clock()
+        changed = mutated = False
+        try:
+            previous = self._desired
+            desired, changed = self.read_source()
+            regions = api.get_detective_regions(self.regions)
+            admin_session = api.get_admin_session(self.admin_account, self.role)
+
+            if self.remove_absent and changed and previous is not None:
+                self._absent.update({account: email for account, email in previous.items() if account not in desired})
+            for account in [account for account in self._absent if account in desired]:
+                del self._absent[account]
+            if self._absent:
+                logging.info(f'Removing {len(self._absent)} accounts that are no longer in {self.source}.')
+                removal = api.disable_members(self.admin_account, self.role, dict(self._absent), regions)
+                logs.log_report_summary(removal)
+                # the accounts that could not be removed are tried again at the next cycle
+                retry = set().union(*[accounts for outcome in ('failed', 'pending', 'circuit_open')
+                                      for accounts in (removal or {}).get(outcome, {}).values()])
+                self._absent = {account: email for account, email in self._absent.items() if account in retry}
+                mutated = True
+
+            api.invalidate_member_snapshots(admin_session, regions)
+            snapshots = helper.run_in_parallel(lambda region: api.get_member_snapshot(admin_session, region), regions)
+            pending = {}
+            for region in regions:
+                snapshot = snapshots.get(region)
+                pending[region] = {account for account in desired
+                                   if not snapshot or any(members.get(account) != 'ENABLED' for members in snapshot.values())}
+            waiting = set().union(*pending.values())
+            for account in set(self._attempts) - waiting:
+                del self._attempts[account]
+
+            due = {account: desired[account] for account in sorted(waiting) if self._due(account, now)}
+            if due:
+                if len(due) <= FAST_PATH_MAX_ACCOUNTS and all(snapshots.get(region) for region in regions):
+                    logging.info(f'Adding {len(due)} accounts with the fast path.')
+                    report = api.add_members(self.admin_account, self.role, due, regions, self.disable_email)
+                else:
+                    logging.info(f'Enabling {len(due)} accounts.')
+                    report = api.enable_members(self.admin_account, self.role, due, regions, disable_email=self.disable_email)
+                logs.log_report_summary(report)
+                self._submitted(due, now)
+                mutated = True
+
+            with self._lock:
+                self.pending = {region: len(accounts) for region, accounts in pending.items()}
+                for region, accounts in pending.items():
+                    if accounts:
+                        self._unconverged_since.setdefault(region, now)
+                    else:
+                        self._unconverged_since.pop(region, None)
+                self.submitted += len(due)
+                self.last_success = now
+            logging.info(f'{len(waiting)} of {len(desired)} accounts are pending in {len(regions)} regions.')
+        except Exception as e:
+            logging.exception(f'error reconciling the members: {e}')
+            with self._lock:
+                self.errors += 1
+
+        with self._lock:
+            self.cycles += 1
+            self.interval = self.min_interval if changed or mutated else min(self.interval * self.backoff, self.max_interval)
+            return self.interval
+
+    def run(self, max_cycles: int = 0) -> typing.NoReturn:
+        """
+        Run cycles until stop() is called, or max_cycles cycles if not 0.
+        """
+        while not self._stopped.is_set():
+            interval = self.cycle()
+            if max_cycles and self.cycles >= max_cycles:
+                break
+            self._stopped.wait(interval)
+
+    def stop(self) -> typing.NoReturn:
+        self._stopped.set()
+
+    def healthy(self) -> bool:
+        """
+        Returns:
+            True once a cycle succeeded, and as long as the last success is recent.
+        """
+        with self._lock:
+            return self.last_success is not None and self._clock() - self.last_success <= 3 * self.max_interval
+
+    def status(self) -> typing.Dict:
+        """
+        Returns:
+            The state of the reconciliation: pending accounts and convergence lag in seconds of each
+            region, and the counters of the cycles.
+        """
+        with self._lock:
+            now = self._clock()
+            return {'cycles': self.cycles, 'errors': self.errors, 'submitted': self.submitted,
+                    'desired': len(self._desired or {}), 'interval': self.interval,
+                    'last_success': self.last_success, 'converged': self.last_success is not None and not any(self.pending.values()),
+                    'regions': {region: {'pending': count, 'lag': round(now - self._unconverged_since[region], 3)
+                                         if region in self._unconverged_since else 0.0}
+                                for region, count in sorted(self.pending.items())}}
+
+    def metrics(self) -> str:
+        """
+        Returns:
+            The status in the Prometheus text format.
+        """
+        status = self.status()
+        lines = ['# TYPE detective_watch_cycles_total counter', f'detective_watch_cycles_total {status["cycles"]}',
+                 '# TYPE detective_watch_errors_total counter', f'detective_watch_errors_total {status["errors"]}',
+                 '# TYPE detective_watch_submitted_accounts_total counter',
+                 f'detective_watch_submitted_accounts_total {status["submitted"]}',
+                 '# TYPE detective_watch_desired_accounts gauge', f'detective_watch_desired_accounts {status["desired"]}',
+                 '# TYPE detective_watch_converged gauge', f'detective_watch_converged {int(status["converged"])}',
+                 '# TYPE detective_watch_interval_seconds gauge', f'detective_watch_interval_seconds {status["interval"]}',
+                 '# TYPE detective_watch_last_success_timestamp_seconds gauge',
+                 f'detective_watch_last_success_timestamp_seconds {status["last_success"] or 0}',
+                 '# TYPE detective_watch_pending_accounts gauge']
+        lines += [f'detective_watch_pending_accounts{{region="{region}"}} {entry["pending"]}'
+                  for region, entry in status['regions'].items()]
+        lines.append('# TYPE detective_watch_convergence_lag_seconds gauge')
+        lines += [f'detective_watch_convergence_lag_seconds{{region="{region}"}} {entry["lag"]}'
+                  for region, entry in status['regions'].items()]
+        return '\n'.join(lines) + '\n'
+
+
+def serve_health(watcher: Watcher, host: str = '127.0.0.1', port: int = 8080) -> http.server.ThreadingHTTPServer:
+    """
+    Serve /healthz and /metrics from a daemon thread.
+
+    Args:
+        - watcher: Watcher to report on.
+        - host: Address to listen on.
+        - port: Port to listen on, 0 for any free port.
+
+    Returns:
+        The started server. Its server_address has the port, shutdown() stops it.
+    """
+    class HealthHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/healthz':
+                code = 200 if watcher.healthy() else 503
+                body, content_type = json.dumps(watcher.status(), sort_keys=True), 'application/json'
+            elif self.path == '/metrics':
+                code, body, content_type = 200, watcher.metrics(), 'text/plain; version=0.0.4'
+            else:
+                code, body, content_type = 404, 'Not found\n', 'text/plain'
+            data = body.encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logging.debug(f'{self.address_string()} {format % args}')
+
+    server = http.server.ThreadingHTTPServer((host, port), HealthHandler)
+    threading.Thread(target=server.serve_forever, name='health', daemon=True).start()
+    logging.info(f'Serving /healthz and /metrics on {server.server_address[0]}:{server.server_address[1]}.')
+    return server
+
+
+if __name__ == '__main__':
+    args = setup_command_line()
+    logs.setup_logging_from_args(args)
+    watcher = Watcher(args.admin_account, args.assume_role, args.input_file, args.regions, args.disable_email,
+                      args.remove_absent, args.min_interval, args.max_interval, args.backoff)
+    server = serve_health(watcher, args.health_host, args.health_port) if args.health_port else None
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: watcher.stop())
+
+    watcher.run(args.max_cycles)
+    if server is not None:
+        server.shutdown()
+    logging.info(f'Stopped after {watcher.cycles} cycles.')
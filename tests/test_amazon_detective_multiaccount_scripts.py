@@ -7,21 +7,47 @@ __maintainer__ = "Amazon Detective"
 __email__ = "detective-demo-requests@amazon.com"
 __status__ = "Production"
 
+import argparse
+import datetime
+import io
 import itertools
+import json
 import logging
 import sys
+import threading
+import tracemalloc
+import urllib.error
+import urllib.request
 from unittest.mock import Mock, patch, call
 
+import boto3
+import botocore.config
 import botocore.exceptions
 import botocore.session
+from botocore.stub import Stubber
 import pytest
 import time
 
 sys.path.append("..")
 
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_api as api
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_deadline as deadline
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_logging as logs
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_plan as planning
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_profile as profiling
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_progress as progress
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_recording as recording
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_registry as registry
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_sharding as sharding
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_state as state
 from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_utilities as helper
+from amazon_detective_multiaccount_scripts import amazon_detective_multiaccount_workqueue as workqueue
 from amazon_detective_multiaccount_scripts import disableDetective
 from amazon_detective_multiaccount_scripts import enableDetective
+from amazon_detective_multiaccount_scripts import enableDetectiveMembers
+from amazon_detective_multiaccount_scripts import inventoryDetective
+from amazon_detective_multiaccount_scripts import queryDetectiveState
+from amazon_detective_multiaccount_scripts import watchDetective
 
 LOGGER = logging.getLogger(__name__)
 
@@ -494,6 +520,1697 @@ def test_delete_members_disable_detective():
         mock_log_exception.assert_called_once()
 
 
+###
+# The purpose of this test is to make sure accounts are sharded deterministically in amazon_detective_multiaccount_sharding.py
+###
+def test_shard_accounts():
+    aws_account_dict = {"123456789012": "random@gmail.com", "000012345678": "email@gmail.com", "555555555555": "test5@gmail.com",
+                        "111111111111": "test1@gmail.com", "222222222222": "test2@gmail.com", "333333333333": "test3@gmail.com"}
+    shards = sharding.shard_accounts(aws_account_dict, 3)
+
+    # Every account ends up in exactly one shard, and always the same one
+    assert len(shards) == 3
+    assert sum(len(shard) for shard in shards) == 6
+    assert {k: v for shard in shards for k, v in shard.items()} == aws_account_dict
+    for index, shard in enumerate(shards):
+        for account_id in shard:
+            assert sharding.shard_for_account(account_id, 3) == index
+
+    # A single shard holds every account
+    assert sharding.shard_accounts(aws_account_dict, 1) == [aws_account_dict]
+
+
+###
+# The purpose of this test is to make sure shard reports are merged correctly in amazon_detective_multiaccount_utilities.py
+###
+def test_merge_reports():
+    report1 = helper.new_report()
+    helper.add_to_report(report1, 'created', 'us-east-1', {"111111111111"})
+    helper.add_to_report(report1, 'failed', 'us-east-2', ["222222222222"])
+    report2 = helper.new_report()
+    helper.add_to_report(report2, 'created', 'us-east-1', {"333333333333"})
+
+    assert helper.merge_reports([report1, report2]) == {'created': {'us-east-1': {"111111111111", "333333333333"}},
+                                                        'failed': {'us-east-2': {"222222222222"}}}
+    assert helper.merge_reports([]) == {}
+
+
+###
+# The purpose of this test is to make sure run_sharded() runs every shard with the admin credentials
+# and merges the results in amazon_detective_multiaccount_sharding.py
+###
+def test_run_sharded():
+    aws_account_dict = {"123456789012": "random@gmail.com", "111111111111": "test1@gmail.com",
+                        "222222222222": "test2@gmail.com", "333333333333": "test3@gmail.com"}
+    admin_session = Mock()
+    args = enableDetective.setup_command_line(['--admin_account', '555555555555', '--assume_role', 'detectiveAdmin',
+                                               '--input_file', 'accounts.csv', '--shards', '2'])
+    assert args.shards == 2
+
+    def process(shard, regions, session, shard_args):
+        # The open input file is not handed over to the workers
+        assert not hasattr(shard_args, 'input_file')
+        report = helper.new_report()
+        for region in regions:
+            helper.add_to_report(report, 'created', region, shard.keys())
+        if "111111111111" in shard:
+            sys.exit(1)
+        return report
+
+    # Worker processes are replaced by threads, the functions are the same
+    with patch.object(sharding.concurrent.futures, 'ProcessPoolExecutor', sharding.concurrent.futures.ThreadPoolExecutor):
+        with patch.object(helper, 'session_from_credentials') as session_mock:
+            # the threads would share the log listener of the worker processes
+            with patch.object(logs, 'setup_logging_from_args'), patch.object(logs, 'stop_logging'):
+                report = sharding.run_sharded(process, 2, aws_account_dict, ['us-east-1'], admin_session, args)
+
+    assert session_mock.call_args[0][0] == helper.get_session_credentials(admin_session)
+    # the workers can assume the admin role again
+    assert callable(session_mock.call_args[0][1])
+    aborted_shard = sharding.shard_accounts(aws_account_dict, 2)[sharding.shard_for_account("111111111111", 2)]
+    assert report['aborted'] == {'us-east-1': set(aborted_shard.keys())}
+    assert report['created'] == {'us-east-1': aws_account_dict.keys() - aborted_shard.keys()}
+
+
+###
+# The purpose of this test is to make sure accept_invitations_by_account() assumes the role of
+# each member account only once in enableDetective.py
+###
+def test_accept_invitations_by_account_enable_detective():
+    invitations = {"111111111111": {("us-east-1", "graph1"), ("us-east-2", "graph2")},
+                   "222222222222": {("us-east-1", "graph1")}}
+
+    with patch.object(helper, 'assume_role') as helper_assume_role_mock:
+        accepted = enableDetective.accept_invitations_by_account("admin", invitations)
+    assert helper_assume_role_mock.call_count == 2
+    assert accepted == {"us-east-1": {"111111111111", "222222222222"}, "us-east-2": {"111111111111"}}
+    local_client = helper_assume_role_mock.return_value.client.return_value
+    assert local_client.accept_invitation.call_count == 3
+
+    # A failing regional call doesn't prevent the other regions from being accepted
+    def accept_invitation(GraphArn):
+        if GraphArn == "graph2":
+            raise Exception()
+
+    with patch.object(helper, 'assume_role') as helper_assume_role_mock:
+        helper_assume_role_mock.return_value.client.return_value.accept_invitation.side_effect = accept_invitation
+        with patch.object(logging, 'exception') as mock_log_exception:
+            accepted = enableDetective.accept_invitations_by_account("admin", invitations)
+    assert mock_log_exception.call_count == 1
+    assert accepted == {"us-east-1": {"111111111111", "222222222222"}}
+
+
+###
+# The purpose of this test is to make sure process_accounts_enable_detective() defers acceptance
+# to the end of the run with account major acceptance in enableDetective.py
+###
+def test_account_major_process_accounts_enable_detective():
+    args = enableDetective.setup_command_line(['--admin_account', '555555555555', '--assume_role', 'detectiveAdmin',
+                                               '--input_file', 'accounts.csv', '--skip_prompt', '--account_major_acceptance'])
+    aws_account_dict = {"111111111111": "test1@gmail.com"}
+    admin_session = Mock()
+
+    with patch.object(enableDetective, 'enable_detective', side_effect=lambda d_client, region, skip_prompt, tags: ["graph-" + region]):
+        with patch.object(helper, 'get_members', side_effect=lambda d_client, graphs: ({graphs[0]: {"111111111111"}},
+                                                                                       {graphs[0]: {"111111111111"}},
+                                                                                       {graphs[0]: set()})):
+            with patch.object(enableDetective, 'create_members', return_value=set()):
+                with patch.object(time, 'sleep'):
+                    with patch.object(enableDetective, 'accept_invitations') as accept_inv:
+                        with patch.object(enableDetective, 'accept_invitations_by_account',
+                                          return_value={"us-east-1": {"111111111111"}, "us-east-2": {"111111111111"}}) as accept_by_account:
+                            report = enableDetective.process_accounts_enable_detective(aws_account_dict, ['us-east-1', 'us-east-2'],
+                                                                                       admin_session, args)
+    accept_inv.assert_not_called()
+    accept_by_account.assert_called_once_with("detectiveAdmin", {"111111111111": {("us-east-1", "graph-us-east-1"),
+                                                                                  ("us-east-2", "graph-us-east-2")}})
+    assert report['accepted'] == {"us-east-1": {"111111111111"}, "us-east-2": {"111111111111"}}
+
+    # the invitations that could not be accepted are failed, as they are with region major acceptance
+    with patch.object(enableDetective, 'enable_detective', side_effect=lambda d_client, region, skip_prompt, tags: ["graph-" + region]):
+        with patch.object(helper, 'get_members', side_effect=lambda d_client, graphs: ({graphs[0]: {"111111111111"}},
+                                                                                       {graphs[0]: {"111111111111"}},
+                                                                                       {graphs[0]: set()})):
+            with patch.object(enableDetective, 'create_members', return_value=set()):
+                with patch.object(time, 'sleep'):
+                    with patch.object(enableDetective, 'accept_invitations_by_account',
+                                      return_value={"us-east-1": {"111111111111"}}):
+                        report = enableDetective.process_accounts_enable_detective(aws_account_dict, ['us-east-1', 'us-east-2'],
+                                                                                   admin_session, args)
+    assert report['accepted'] == {"us-east-1": {"111111111111"}}
+    assert report['failed'] == {"us-east-2": {"111111111111"}}
+    assert 'pending' not in report
+
+
+###
+# The purpose of this test is to make sure get_members_by_ids() only looks up the given accounts,
+# in batches of 50, in amazon_detective_multiaccount_utilities.py
+###
+def test_get_members_by_ids_detective_multiaccount_utilities():
+    d_client = Mock()
+    d_client.get_members.side_effect = lambda GraphArn, AccountIds: {
+        "MemberDetails": [{"AccountId": x, "Status": "INVITED" if x.endswith("1") else "VERIFICATION_FAILED"} for x in AccountIds],
+        "UnprocessedAccounts": []}
+    account_ids = {str(i).zfill(12) for i in range(60)}
+
+    all_ac, pending, verification_fail = helper.get_members_by_ids(d_client, "graph1", account_ids)
+
+    assert d_client.get_members.call_count == 2
+    assert [len(c.kwargs["AccountIds"]) for c in d_client.get_members.call_args_list] == [50, 10]
+    assert all_ac == {"graph1": account_ids}
+    assert pending == {"graph1": {x for x in account_ids if x.endswith("1")}}
+    assert verification_fail == {"graph1": {x for x in account_ids if not x.endswith("1")}}
+    d_client.list_members.assert_not_called()
+
+    # No accounts to look up, no API calls
+    d_client.get_members.reset_mock()
+    assert helper.get_members_by_ids(d_client, "graph1", set()) == ({"graph1": set()}, {"graph1": set()}, {"graph1": set()})
+    d_client.get_members.assert_not_called()
+
+    # Exception case
+    d_client.get_members.side_effect = botocore.exceptions.EndpointConnectionError(endpoint_url='https://detective.us-weast-1.amazonaws.com/')
+    with patch.object(logging, 'exception') as mock_log_exception:
+        assert helper.get_members_by_ids(d_client, "graph1", {"111111111111"}) == ({"graph1": set()}, {"graph1": set()}, {"graph1": set()})
+    mock_log_exception.assert_called_once()
+
+
+###
+# The purpose of this test is to make sure verify_account_emails() detects email mismatches before
+# the members are created in enableDetective.py
+###
+def test_verify_account_emails_enable_detective():
+    aws_account_dict = {"111111111111": "test1@gmail.com", "222222222222": "test2@gmail.com",
+                        "333333333333": "test3@gmail.com", "444444444444": "test4@gmail.com"}
+    admin_session = Mock()
+    d_client = admin_session.client.return_value
+    d_client.list_graphs.return_value = {"GraphList": [{"Arn": "graph1"}]}
+    # 111111111111 is a verified member with another email, 222222222222 matches ignoring case and
+    # the email of 333333333333 failed verification, so it can't be trusted.
+    d_client.list_members.return_value = {"MemberDetails": [
+        {"AccountId": "111111111111", "EmailAddress": "old1@gmail.com", "Status": "ENABLED"},
+        {"AccountId": "222222222222", "EmailAddress": "Test2@gmail.com", "Status": "INVITED"},
+        {"AccountId": "333333333333", "EmailAddress": "wrong3@gmail.com", "Status": "VERIFICATION_FAILED"}]}
+    # Organizations knows the right email of 444444444444
+    admin_session.client.return_value.get_paginator.return_value.paginate.return_value = [
+        {"Accounts": [{"Id": "444444444444", "Email": "org4@gmail.com"}]}]
+
+    with patch.object(logging, 'warning') as mock_log_warning:
+        accounts, mismatches = enableDetective.verify_account_emails(aws_account_dict, admin_session, ['us-east-1', 'us-east-2'], False)
+    assert mismatches == {"111111111111": ("test1@gmail.com", "old1@gmail.com"), "444444444444": ("test4@gmail.com", "org4@gmail.com")}
+    assert accounts == aws_account_dict
+    assert mock_log_warning.call_count == 2
+
+    accounts, mismatches = enableDetective.verify_account_emails(aws_account_dict, admin_session, ['us-east-1'], True)
+    assert accounts == {"222222222222": "test2@gmail.com", "333333333333": "test3@gmail.com"}
+
+    # Organizations not available
+    admin_session.client.return_value.get_paginator.side_effect = botocore.exceptions.ClientError(
+        {"Error": {"Code": "AWSOrganizationsNotInUseException", "Message": "not in use"}}, "ListAccounts")
+    accounts, mismatches = enableDetective.verify_account_emails(aws_account_dict, admin_session, ['us-east-1'], True)
+    assert set(mismatches) == {"111111111111"}
+
+
+###
+# The purpose of this test is to make sure repair_members() deletes and creates again the members that failed
+# verification, and creates again the unprocessed ones, in enableDetective.py
+###
+def test_repair_members_enable_detective():
+    args = enableDetective.setup_command_line(['--admin_account', '555555555555', '--assume_role', 'detectiveAdmin',
+                                               '--input_file', 'accounts.csv', '--repair_attempts', '2'])
+    aws_account_dict = {"111111111111": "test1@gmail.com", "222222222222": "test2@gmail.com", "333333333333": "test3@gmail.com"}
+    report = helper.new_report()
+    helper.add_to_report(report, 'verification_failed', 'us-east-1', {"111111111111"})
+    helper.add_to_report(report, 'unprocessed_create', 'us-east-1', {"222222222222"})
+    helper.add_to_report(report, 'accepted', 'us-east-1', {"333333333333"})
+
+    admin_session = Mock()
+    d_client = admin_session.client.return_value
+    d_client.list_graphs.return_value = {"GraphList": [{"Arn": "graph1"}]}
+    d_client.create_members.return_value = {"UnprocessedAccounts": [], "Members": [{"AccountId": "111111111111"}, {"AccountId": "222222222222"}]}
+    d_client.get_members.return_value = {"MemberDetails": [{"AccountId": "111111111111", "Status": "INVITED"},
+                                                           {"AccountId": "222222222222", "Status": "INVITED"}]}
+    # The right email of 111111111111 comes from Organizations
+    d_client.get_paginator.return_value.paginate.return_value = [{"Accounts": [{"Id": "111111111111", "Email": "org1@gmail.com"}]}]
+
+    with patch.object(time, 'sleep'):
+        with patch.object(enableDetective, 'accept_invitations') as accept_inv:
+            report = enableDetective.repair_members(admin_session, report, aws_account_dict, args)
+
+    d_client.delete_members.assert_called_once_with(GraphArn="graph1", AccountIds=["111111111111"])
+    assert sorted(d_client.create_members.call_args.kwargs["Accounts"], key=lambda x: x["AccountId"]) == [
+        {"AccountId": "111111111111", "EmailAddress": "org1@gmail.com"}, {"AccountId": "222222222222", "EmailAddress": "test2@gmail.com"}]
+    accept_inv.assert_called_once_with("detectiveAdmin", {"111111111111", "222222222222"}, "graph1", "us-east-1", set())
+    assert report == {'repaired': {'us-east-1': {"111111111111", "222222222222"}},
+                      'accepted': {'us-east-1': {"111111111111", "222222222222", "333333333333"}}}
+
+    # Members are only created again once with the email from Organizations, and not at all when it is the same
+    helper.add_to_report(report, 'verification_failed', 'us-east-1', {"111111111111", "222222222222"})
+    d_client.delete_members.reset_mock()
+    d_client.create_members.reset_mock()
+    d_client.create_members.return_value = {"UnprocessedAccounts": [], "Members": [{"AccountId": "111111111111"}]}
+    d_client.get_members.return_value = {"MemberDetails": [{"AccountId": "111111111111", "Status": "VERIFICATION_FAILED"}]}
+    d_client.get_paginator.return_value.paginate.return_value = [{"Accounts": [{"Id": "111111111111", "Email": "org1@gmail.com"},
+                                                                              {"Id": "222222222222", "Email": "Test2@gmail.com"}]}]
+    with patch.object(time, 'sleep'):
+        with patch.object(enableDetective, 'accept_invitations', return_value=set()):
+            report = enableDetective.repair_members(admin_session, report, aws_account_dict, args)
+    d_client.delete_members.assert_called_once_with(GraphArn="graph1", AccountIds=["111111111111"])
+    assert d_client.create_members.call_count == 1
+    assert report['verification_failed'] == {'us-east-1': {"111111111111", "222222222222"}}
+
+
+###
+# The purpose of this test is to make sure retryable unprocessed accounts are deleted again in disableDetective.py
+###
+def test_retry_delete_members_disable_detective():
+    assert helper.is_retryable_reason("Rate exceeded")
+    assert helper.is_retryable_reason("An internal error occurred, try again")
+    assert not helper.is_retryable_reason("The account is not a member of the behavior graph")
+    assert not helper.is_retryable_reason(None)
+
+    report = helper.new_report()
+    helper.add_to_report(report, 'unprocessed_delete', 'us-east-2', {"111111111111", "222222222222"})
+    admin_session = Mock()
+    d_client = admin_session.client.return_value
+    d_client.list_graphs.return_value = {"GraphList": [{"Arn": "graph1"}]}
+    d_client.delete_members.side_effect = [
+        {"AccountIds": ["111111111111"], "UnprocessedAccounts": [{"AccountId": "222222222222", "Reason": "Rate exceeded"}]},
+        {"AccountIds": ["222222222222"], "UnprocessedAccounts": []}]
+
+    with patch.object(time, 'sleep'):
+        with patch.object(logging, 'exception'):
+            report = disableDetective.retry_delete_members(admin_session, report, 3)
+    assert d_client.delete_members.call_count == 2
+    assert report == {'deleted': {'us-east-2': {"111111111111", "222222222222"}}}
+
+
+###
+# The purpose of this test is to make sure warm invocations of the Lambda handler reuse the admin session
+# and skip accounts that are already enabled in amazon_detective_multiaccount_api.py
+###
+def test_lambda_handler_api():
+    api.clear_caches()
+    event = {"admin_account": "555555555555", "assume_role": "detectiveAdmin", "regions": "us-east-1,us-east-2",
+             "accounts": [{"AccountId": "111111111111", "EmailAddress": "test1@gmail.com"}],
+             "options": {"disable_email": True}}
+    process_report = helper.new_report()
+    helper.add_to_report(process_report, 'created', 'us-east-1', {"111111111111"})
+
+    with patch.object(helper, 'assume_role') as helper_assume_role_mock:
+        d_client = helper_assume_role_mock.return_value.client.return_value
+        d_client.list_graphs.return_value = {"GraphList": [{"Arn": "graph1"}]}
+        d_client.list_members.return_value = {"MemberDetails": [{"AccountId": "111111111111", "Status": "INVITED"}]}
+        with patch.object(enableDetective, 'process_accounts_enable_detective', return_value=process_report) as process_mock:
+            assert api.lambda_handler(event, None) == {'created': {'us-east-1': ["111111111111"]}}
+            args = process_mock.call_args.args[3]
+            assert args.disable_email and args.skip_prompt
+            assert process_mock.call_args.args[:2] == ({"111111111111": "test1@gmail.com"}, ['us-east-1', 'us-east-2'])
+
+            # The account is enabled now: the warm invocation doesn't assume the role again,
+            # and returns without processing anything
+            d_client.list_members.return_value = {"MemberDetails": [{"AccountId": "111111111111", "Status": "ENABLED"}]}
+            assert api.lambda_handler(event, None) == {}
+            assert process_mock.call_count == 1
+            assert helper_assume_role_mock.call_count == 1
+            # The clients are reused too, until the session expires
+            assert helper_assume_role_mock.return_value.client.call_count == 2
+            api._SESSIONS.invalidate()
+            api._MEMBER_SNAPSHOTS.invalidate()
+            api.lambda_handler(event, None)
+            assert helper_assume_role_mock.return_value.client.call_count == 4
+
+    # Disable with the accounts read from S3
+    api.clear_caches()
+    with patch.object(helper, 'assume_role'):
+        with patch.object(api.boto3.session, 'Session') as session_mock:
+            session_mock.return_value.client.return_value.get_object.return_value = {"Body": Mock(read=Mock(return_value=b"111111111111,test1@gmail.com\n"))}
+            with patch.object(disableDetective, 'process_accounts_disable_detective', return_value=helper.new_report()) as process_mock:
+                api.lambda_handler({"action": "disable", "admin_account": "555555555555", "assume_role": "detectiveAdmin",
+                                    "regions": ["us-east-1"], "input_s3_uri": "s3://bucket/accounts.csv"}, None)
+    session_mock.return_value.client.return_value.get_object.assert_called_once_with(Bucket="bucket", Key="accounts.csv")
+    assert process_mock.call_args.args[0] == {"111111111111": "test1@gmail.com"}
+
+
+###
+# The purpose of this test is to make sure the fast path adds the accounts in every region without listing
+# the graph members, and assumes the role of each account once in enableDetectiveMembers.py
+###
+def test_fast_path_enable_members():
+    args = enableDetectiveMembers.setup_command_line(['--admin_account', '555555555555', '--assume_role', 'detectiveAdmin',
+                                                      '--accounts', '111111111111:test1@gmail.com,222222222222:test2@gmail.com'])
+    assert args.accounts == {"111111111111": "test1@gmail.com", "222222222222": "test2@gmail.com"}
+    with pytest.raises(SystemExit):
+        enableDetectiveMembers.setup_command_line(['--admin_account', '555555555555', '--assume_role', 'detectiveAdmin',
+                                                   '--accounts', '111111111111'])
+
+    admin_session = Mock()
+    clients = {region: Mock() for region in ['us-east-1', 'us-east-2', 'eu-west-1']}
+    admin_session.client.side_effect = lambda service, region_name: clients[region_name]
+    for region, d_client in clients.items():
+        d_client.list_graphs.return_value = {"GraphList": [{"Arn": "graph-" + region}]} if region != 'eu-west-1' else {"GraphList": []}
+        # 222222222222 is already invited in us-east-2
+        d_client.get_members.side_effect = [
+            {"MemberDetails": [{"AccountId": "222222222222", "Status": "INVITED"}] if region == 'us-east-2' else []},
+            {"MemberDetails": [{"AccountId": "111111111111", "Status": "INVITED"}, {"AccountId": "222222222222", "Status": "INVITED"}]}]
+        d_client.create_members.side_effect = lambda GraphArn, Message, Accounts, DisableEmailNotification: {
+            "UnprocessedAccounts": [], "Members": [{"AccountId": x["AccountId"]} for x in Accounts]}
+
+    with patch.object(time, 'sleep') as time_sleep:
+        with patch.object(enableDetective, 'accept_invitations_by_account',
+                          return_value={'us-east-1': {"111111111111", "222222222222"}, 'us-east-2': {"111111111111", "222222222222"}}) as accept_by_account:
+            report = enableDetectiveMembers.fast_path_enable_members(admin_session, args.accounts, list(clients), "detectiveAdmin")
+
+    assert time_sleep.call_count == 2
+    for d_client in clients.values():
+        d_client.list_members.assert_not_called()
+    assert clients['us-east-2'].create_members.call_args.kwargs["Accounts"] == [{"AccountId": "111111111111", "EmailAddress": "test1@gmail.com"}]
+    accept_by_account.assert_called_once_with("detectiveAdmin", {
+        "111111111111": {("us-east-1", "graph-us-east-1"), ("us-east-2", "graph-us-east-2")},
+        "222222222222": {("us-east-1", "graph-us-east-1"), ("us-east-2", "graph-us-east-2")}})
+    assert report == {'created': {'us-east-1': {"111111111111", "222222222222"}, 'us-east-2': {"111111111111"}},
+                      'skipped': {'eu-west-1': {"111111111111", "222222222222"}},
+                      'accepted': {'us-east-1': {"111111111111", "222222222222"}, 'us-east-2': {"111111111111", "222222222222"}}}
+
+    # The invitations that could not be accepted are failed, so that the script exits with an error
+    with patch.object(enableDetectiveMembers, 'add_members_in_region',
+                      side_effect=lambda d_client, region, accounts, disable_email: (
+                          helper.new_report(), {x: {(region, "graph-" + region)} for x in accounts})):
+        with patch.object(enableDetective, 'accept_invitations_by_account',
+                          return_value={'us-east-1': {"111111111111", "222222222222"}, 'us-east-2': {"111111111111"}}):
+            report = enableDetectiveMembers.fast_path_enable_members(admin_session, args.accounts, ['us-east-1', 'us-east-2'],
+                                                                     "detectiveAdmin")
+    assert report == {'accepted': {'us-east-1': {"111111111111", "222222222222"}, 'us-east-2': {"111111111111"}},
+                      'failed': {'us-east-2': {"222222222222"}}}
+
+    # An account creation event goes through the fast path
+    api.clear_caches()
+    event = {"detail": {"eventName": "CreateAccountResult",
+                        "serviceEventDetails": {"createAccountStatus": {"state": "SUCCEEDED", "accountId": "333333333333"}}},
+             "options": {"disable_email": True, "repair_attempts": 2}}
+    with patch.dict('os.environ', {"ADMIN_ACCOUNT": "555555555555", "ASSUME_ROLE": "detectiveAdmin", "REGIONS": "us-east-1"}):
+        with patch.object(helper, 'assume_role'):
+            with patch.object(api.boto3.session, 'Session') as session_mock:
+                session_mock.return_value.client.return_value.describe_account.return_value = {"Account": {"Email": "test3@gmail.com"}}
+                with patch.object(enableDetectiveMembers, 'fast_path_enable_members', return_value=helper.new_report()) as fast_path:
+                    api.lambda_handler(event, None)
+    # disable_email is forwarded, and the options of the full run are ignored
+    assert fast_path.call_args.args[1:] == ({"333333333333": "test3@gmail.com"}, ['us-east-1'], "detectiveAdmin", True)
+
+
+###
+# The purpose of this test is to make sure the SQLite work queue leases, retries
+# and fails items correctly in amazon_detective_multiaccount_workqueue.py
+###
+def test_sqlite_work_queue(tmp_path):
+    queue = workqueue.SqliteWorkQueue(str(tmp_path / "queue.db"))
+    first = queue.put("us-east-1", "graph-1", "create_members", {"111111111111": "test1@gmail.com"})
+    queue.put("us-east-1", "graph-1", "delete_members", {"222222222222": "test2@gmail.com"}, delay=3600)
+
+    item = queue.lease()
+    assert item == {"id": first, "region": "us-east-1", "graph": "graph-1", "operation": "create_members",
+                    "accounts": {"111111111111": "test1@gmail.com"}, "attempts": 1}
+    # the other item is not available yet, and the first one is leased
+    assert queue.lease() is None
+    assert queue.fail(first, "throttled", retry_delay=0, max_attempts=2)
+    assert queue.lease()["attempts"] == 2
+    assert not queue.fail(first, "throttled", retry_delay=0, max_attempts=2)
+    assert queue.counts() == {"failed": 1, "queued": 1}
+    assert queue.failed_items()[0]["last_error"] == "throttled"
+
+    assert queue.retry_failed() == 1
+    item = queue.lease()
+    assert item["attempts"] == 1
+    queue.complete(item["id"])
+    assert queue.counts() == {"done": 1, "queued": 1}
+    assert queue.unfinished() == 1
+
+    # an item whose lease expired goes to another worker
+    queue.put("us-east-2", "graph-2", "delete_graph", {})
+    item = queue.lease(lease_seconds=-1)
+    assert queue.lease()["id"] == item["id"]
+    queue.close()
+
+
+###
+# The purpose of this test is to make sure produced items are executed, and that
+# follow-up items are queued, in amazon_detective_multiaccount_workqueue.py
+###
+def test_produce_and_execute_work_items(tmp_path):
+    queue = workqueue.SqliteWorkQueue(str(tmp_path / "queue.db"))
+    args = argparse.Namespace(operation='enable', skip_prompt=True, tags=None, disable_email=False,
+                              assume_role='detectiveAdmin', max_attempts=3, delete_graph=False)
+    accounts = {"111111111111": "test1@gmail.com", "222222222222": "test2@gmail.com"}
+    admin_session = Mock()
+    d_client = admin_session.client.return_value
+    d_client.list_graphs.return_value = {"GraphList": [{"Arn": "graph-1"}]}
+    d_client.list_members.return_value = {"MemberDetails": [{"AccountId": "222222222222", "Status": "INVITED"}]}
+
+    assert workqueue.produce_work_items(queue, accounts, ['us-east-1'], admin_session, args) == 2
+    create = queue.lease()
+    accept = queue.lease()
+    assert (create["operation"], create["accounts"]) == ("create_members", {"111111111111": "test1@gmail.com"})
+    assert (accept["operation"], accept["accounts"]) == ("accept_invitations", {"222222222222": "test2@gmail.com"})
+
+    d_client.create_members.return_value = {"UnprocessedAccounts": [], "Members": [{"AccountId": "111111111111"}]}
+    workqueue.execute_item(create, admin_session, queue, args)
+    assert queue.counts() == {"done": 1, "leased": 1, "queued": 1}
+
+    # 111111111111 is still being verified, so only that account is retried
+    d_client.get_members.return_value = {"MemberDetails": [{"AccountId": "111111111111", "Status": "VERIFICATION_IN_PROGRESS"},
+                                                           {"AccountId": "222222222222", "Status": "INVITED"}]}
+    with patch.object(enableDetective, 'accept_invitations', return_value=set()) as accept_invitations:
+        workqueue.execute_item(dict(accept, accounts=accounts), admin_session, queue, args)
+    accept_invitations.assert_called_once_with('detectiveAdmin', {"222222222222"}, "graph-1", "us-east-1")
+    assert queue.counts() == {"done": 1, "queued": 2}
+    assert queue.unfinished() == 2
+
+    # a failed acceptance is retried, and the accounts that failed the verification get a failed item of their own
+    d_client.get_members.return_value = {"MemberDetails": [{"AccountId": "111111111111", "Status": "VERIFICATION_FAILED"},
+                                                           {"AccountId": "222222222222", "Status": "INVITED"}]}
+    item_id = queue.put("us-east-1", "graph-1", "accept_invitations", accounts)
+    with patch.object(enableDetective, 'accept_invitations', return_value={"222222222222"}):
+        workqueue.execute_item(dict(accept, id=item_id, accounts=accounts), admin_session, queue, args)
+    assert queue._conn.execute('SELECT status, accounts FROM work_items WHERE id = ?', (item_id,)).fetchone()[:] == \
+        ('queued', '{"222222222222": "test2@gmail.com"}')
+    assert [(x["accounts"], x["last_error"]) for x in queue.failed_items()] == \
+        [({"111111111111": "test1@gmail.com"}, "accounts ['111111111111'] failed the email verification")]
+    queue.close()
+
+
+###
+# The purpose of this test is to make sure the state store records the members and the
+# operations, and answers queries, in amazon_detective_multiaccount_state.py
+###
+def test_state_store(tmp_path):
+    store = state.StateStore(str(tmp_path / "state.db"), max_age=3600)
+    graph = "arn:aws:detective:ap-southeast-2:555555555555:graph:1"
+    store.record_members("ap-southeast-2", graph, [{"AccountId": "111111111111", "EmailAddress": "test1@gmail.com", "Status": "INVITED"},
+                                                   {"AccountId": "222222222222", "EmailAddress": "test2@gmail.com", "Status": "ENABLED"}],
+                         full_sweep=True)
+    store.record_operation("ap-southeast-2", graph, "accept_invitation", "failed", ["111111111111"], reasons={"111111111111": "AccessDenied"})
+    store.record_operation("ap-southeast-2", graph, "delete_members", "deleted", ["222222222222"])
+    store.record_operation("ap-southeast-2", graph, "create_members", "created", ["333333333333"], emails={"333333333333": "test3@gmail.com"})
+
+    assert [x["account_id"] for x in store.members(region="ap-southeast-2", status="INVITED")] == ["111111111111"]
+    assert store.members(account_id="333333333333")[0]["status"] == "VERIFICATION_IN_PROGRESS"
+    assert store.cached_members(graph) == [{"AccountId": "111111111111", "EmailAddress": "test1@gmail.com", "Status": "INVITED"},
+                                           {"AccountId": "333333333333", "EmailAddress": "test3@gmail.com", "Status": "VERIFICATION_IN_PROGRESS"}]
+    assert store.cached_members("arn:aws:detective:us-east-1:555555555555:graph:2") is None
+
+    args = queryDetectiveState.setup_command_line(['--state_file', str(tmp_path / "state.db"), '--history',
+                                                   '--account_id', '111111111111', '--outcome', 'failed'])
+    rows = queryDetectiveState.query_state(store, args)
+    assert [(x["operation"], x["reason"]) for x in rows] == [("accept_invitation", "AccessDenied")]
+    assert rows[0]["at"].endswith("+00:00")
+    # every recorded operation can be queried, the member side ones included
+    args = queryDetectiveState.setup_command_line(['--state_file', str(tmp_path / "state.db"), '--history',
+                                                   '--operation', 'disassociate_membership'])
+    assert queryDetectiveState.query_state(store, args) == []
+    store.close()
+
+
+###
+# The purpose of this test is to make sure the scripts record into the active store, and that
+# get_members() reads a recent sweep from it, in amazon_detective_multiaccount_utilities.py
+###
+def test_state_hooks_detective_multiaccount_utilities(tmp_path):
+    graph = "arn:aws:detective:us-east-1:555555555555:graph:1"
+    d_client = Mock()
+    d_client.list_members.return_value = {"MemberDetails": [{"AccountId": "111111111111", "EmailAddress": "test1@gmail.com", "Status": "INVITED"}]}
+    d_client.create_members.return_value = {"UnprocessedAccounts": [{"AccountId": "333333333333", "Reason": "Invalid email"}],
+                                            "Members": [{"AccountId": "222222222222"}]}
+    store = state.activate_from_args(argparse.Namespace(state_file=str(tmp_path / "state.db"), state_max_age=3600))
+    try:
+        assert helper.get_members(d_client, [graph])[1] == {graph: {"111111111111"}}
+        enableDetective.create_members(d_client, graph, False, {"111111111111"},
+                                       {"111111111111": "test1@gmail.com", "222222222222": "test2@gmail.com", "333333333333": "bad"})
+        # the second lookup is answered by the store, including the member created since
+        all_members, pending, verification_fail = helper.get_members(d_client, [graph])
+        assert d_client.list_members.call_count == 1
+        assert all_members == {graph: {"111111111111", "222222222222"}}
+        assert store.history(outcome="failed")[0]["reason"] == "Invalid email"
+    finally:
+        state.deactivate()
+    assert state.cached_members(graph) is None
+
+
+###
+# The purpose of this test is to make sure the queue based logging aggregates the lines about
+# single accounts and writes JSON lines in amazon_detective_multiaccount_logging.py
+###
+def test_setup_logging_detective_multiaccount_logging():
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    try:
+        stream = io.StringIO()
+        logs.setup_logging('summary', stream=stream)
+        logging.info('Accepting invitation for account 111111111111 in graph graph-1.')
+        logging.info('Accepting invitation for account 222222222222 in graph graph-1.')
+        logging.info('Execution finished.')
+        logging.error('Could not create member for account 333333333333.')
+        logs.log_report_summary({'accepted': {'us-east-1': {'111111111111'}, 'us-east-2': {'111111111111', '222222222222'}}})
+        logs.stop_logging()
+        lines = stream.getvalue().splitlines()
+        assert len(lines) == 3
+        assert lines[0].endswith('ERROR - Could not create member for account 333333333333.')
+        assert lines[1].endswith('SUMMARY - accepted: 2 accounts in 2 regions.')
+        assert lines[2].endswith('SUMMARY - Accepting invitation for account <account> in graph graph-1. '
+                                 '[2 accounts: 111111111111, 222222222222]')
+
+        stream = io.StringIO()
+        logs.setup_logging('info', 'json', stream=stream)
+        logging.info('Execution finished.')
+        logs.stop_logging()
+        entry = json.loads(stream.getvalue())
+        assert (entry['level'], entry['message']) == ('INFO', 'Execution finished.')
+    finally:
+        logs.stop_logging()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        for handler in handlers:
+            root.addHandler(handler)
+        root.setLevel(level)
+
+
+###
+# The purpose of this test is to make sure the plan is built, approved once and applied
+# region by region without prompts in amazon_detective_multiaccount_plan.py
+###
+def test_plan_enable_detective(tmp_path):
+    args = enableDetective.setup_command_line(['--admin_account', '555555555555', '--assume_role', 'detectiveAdmin',
+                                               '--input_file', 'accounts.csv', '--tags', 'Team=Security', '--plan'])
+    aws_account_dict = {"111111111111": "test1@gmail.com"}
+    admin_session = Mock()
+    clients = {'us-east-1': Mock(), 'eu-west-1': Mock()}
+    admin_session.client.side_effect = lambda service, region_name: clients[region_name]
+    clients['us-east-1'].list_graphs.return_value = {"GraphList": [{"Arn": "graph-1"}]}
+    clients['eu-west-1'].list_graphs.return_value = {"GraphList": []}
+    clients['eu-west-1'].create_graph.return_value = {"GraphArn": "graph-2"}
+
+    plan = planning.build_plan('enable', aws_account_dict, ['us-east-1', 'eu-west-1'], admin_session, args)
+    assert plan == {'operation': 'enable', 'accounts': 1, 'account_ids': ["111111111111"],
+                    'regions': {'us-east-1': {'graphs': ['graph-1'], 'create_graph': False},
+                                'eu-west-1': {'graphs': [], 'create_graph': True, 'tags': {'Team': 'Security'}}}}
+    assert planning.describe_plan(plan) == ["accounts: 111111111111",
+                                            "eu-west-1: create a behavior graph with tags {'Team': 'Security'} and add 1 accounts to it",
+                                            "us-east-1: add 1 accounts to graph-1"]
+    many = dict(plan, accounts=12, account_ids=[str(i).zfill(12) for i in range(12)])
+    assert planning.describe_plan(many)[0] == f'accounts: {", ".join(str(i).zfill(12) for i in range(10))} and 2 more'
+    with patch('builtins.input', return_value='N') as prompt:
+        assert not planning.confirm_plan(plan, False)
+    prompt.assert_called_once()
+
+    planning.write_plan(plan, str(tmp_path / "plan.json"))
+    assert planning.read_plan(str(tmp_path / "plan.json"), 'enable') == plan
+    with pytest.raises(ValueError):
+        planning.read_plan(str(tmp_path / "plan.json"), 'disable')
+
+    def process(accounts, regions, session, run_args):
+        assert run_args.skip_prompt
+        report = helper.new_report()
+        helper.add_to_report(report, 'created', regions[0], accounts.keys())
+        return report
+
+    process_func = Mock(side_effect=process)
+    report = planning.apply_plan(plan, aws_account_dict, admin_session, args, process_func)
+    clients['eu-west-1'].create_graph.assert_called_once_with(Tags={'Team': 'Security'})
+    clients['us-east-1'].create_graph.assert_not_called()
+    assert sorted(x.args[1] for x in process_func.call_args_list) == [['eu-west-1'], ['us-east-1']]
+    assert report == {'created': {'us-east-1': {"111111111111"}, 'eu-west-1': {"111111111111"}}}
+
+    # the plan is not applied to other accounts, or to graphs that changed since it was built
+    with pytest.raises(ValueError):
+        planning.apply_plan(plan, dict(aws_account_dict, **{"222222222222": "test2@gmail.com"}), admin_session, args, process_func)
+    # the same number of accounts is not enough
+    with pytest.raises(ValueError):
+        planning.apply_plan(plan, {"222222222222": "test2@gmail.com"}, admin_session, args, process_func)
+    with pytest.raises(ValueError):
+        planning.apply_plan({k: v for k, v in plan.items() if k != 'account_ids'}, aws_account_dict, admin_session, args, process_func)
+    clients['us-east-1'].list_graphs.return_value = {"GraphList": [{"Arn": "graph-3"}]}
+    with pytest.raises(ValueError):
+        planning.apply_plan(plan, aws_account_dict, admin_session, args, process_func)
+    assert process_func.call_count == 2
+
+    # the decisions are read from the plan, not from the arguments of the run applying it
+    disable_args = disableDetective.setup_command_line(['--admin_account', '555555555555', '--assume_role', 'detectiveAdmin',
+                                                        '--input_file', 'accounts.csv'])
+    disable_plan = {'operation': 'disable', 'accounts': 1, 'account_ids': ["111111111111"],
+                    'regions': {'us-east-1': {'graphs': ['graph-3'], 'delete_graph': True}}}
+    process_func = Mock(return_value=helper.new_report())
+    planning.apply_plan(disable_plan, aws_account_dict, admin_session, disable_args, process_func, parallel=False)
+    assert process_func.call_args.args[1] == ['us-east-1']
+    assert process_func.call_args.args[3].delete_graph
+
+
+###
+# The purpose of this test is to make sure organization accounts are enabled without invitations,
+# and the other accounts are invited, in enableDetective.py
+###
+def test_organization_process_accounts_enable_detective():
+    args = enableDetective.setup_command_line(['--admin_account', '555555555555', '--assume_role', 'detectiveAdmin',
+                                               '--input_file', 'accounts.csv', '--organization', '--skip_prompt'])
+    aws_account_dict = {"111111111111": "test1@gmail.com", "222222222222": "test2@gmail.com", "333333333333": "test3@gmail.com"}
+    management_session = Mock()
+    management_session.client.return_value.list_organization_admin_accounts.return_value = {"Administrators": []}
+    admin_session = Mock()
+    d_client = admin_session.client.return_value
+    d_client.list_graphs.return_value = {"GraphList": [{"Arn": "graph-1"}]}
+    d_client.get_members.return_value = {"MemberDetails": [{"AccountId": "111111111111", "Status": "ENABLED"}]}
+    d_client.create_members.return_value = {"UnprocessedAccounts": [], "Members": [{"AccountId": "222222222222"}]}
+
+    with patch.object(enableDetective.boto3.session, 'Session', return_value=management_session):
+        with patch.object(helper, 'get_organization_account_emails',
+                          return_value={"111111111111": "test1@gmail.com", "222222222222": "test2@gmail.com"}):
+            with patch.object(enableDetective, 'process_accounts_enable_detective', return_value=helper.new_report()) as invite:
+                report = enableDetective.process_accounts_organization_enable_detective(aws_account_dict, ['us-east-1', 'us-east-2'],
+                                                                                       admin_session, args)
+
+    management_session.client.return_value.enable_organization_admin_account.assert_called_with(AccountId='555555555555')
+    d_client.update_organization_configuration.assert_called_with(GraphArn="graph-1", AutoEnable=True)
+    assert d_client.create_members.call_args.kwargs["Accounts"] == [{"AccountId": "222222222222", "EmailAddress": "test2@gmail.com"}]
+    invite.assert_called_once_with({"333333333333": "test3@gmail.com"}, ['us-east-1', 'us-east-2'], admin_session, args)
+    assert report == {'enabled': {'us-east-1': {"222222222222"}, 'us-east-2': {"222222222222"}}}
+
+
+###
+# The purpose of this test is to make sure get_graphs() follows NextToken
+# in amazon_detective_multiaccount_utilities.py
+###
+def test_get_graphs_pagination_detective_multiaccount_utilities():
+    d_client = Mock()
+    d_client.list_graphs.side_effect = [{"GraphList": [{"Arn": "graph-1"}], "NextToken": "token"},
+                                        {"GraphList": [{"Arn": "graph-2"}]}]
+    assert helper.get_graphs(d_client) == ["graph-1", "graph-2"]
+    assert d_client.list_graphs.call_args_list == [call(), call(NextToken="token")]
+
+
+###
+# The purpose of this test is to make sure the members of every region are streamed
+# as JSONL and CSV rows in inventoryDetective.py
+###
+def test_inventory_detective():
+    admin_session = Mock()
+    clients = {'us-east-1': Mock(), 'eu-west-1': Mock(), 'ap-south-1': Mock()}
+    admin_session.client.side_effect = lambda service, region_name: clients[region_name]
+    clients['us-east-1'].list_graphs.return_value = {"GraphList": [{"Arn": "graph-1"}]}
+    clients['us-east-1'].list_members.side_effect = [
+        {"MemberDetails": [{"AccountId": "111111111111", "EmailAddress": "test1@gmail.com", "Status": "ENABLED",
+                            "InvitedTime": datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+                            "DatasourcePackageIngestStates": {"EKS_AUDIT": {"DatasourcePackageIngestState": "STARTED"}}}],
+         "NextToken": "token"},
+        {"MemberDetails": [{"AccountId": "222222222222", "EmailAddress": "test2@gmail.com", "Status": "INVITED"}]}]
+    clients['eu-west-1'].list_graphs.return_value = {"GraphList": []}
+    clients['ap-south-1'].list_graphs.side_effect = botocore.exceptions.ClientError({"Error": {"Code": "AccessDenied"}}, "ListGraphs")
+
+    failed_regions = set()
+    rows = list(inventoryDetective.stream_inventory(admin_session, list(clients), 2, failed_regions))
+    assert failed_regions == {'ap-south-1'}
+    assert [x["account_id"] for x in rows] == ["111111111111", "222222222222"]
+    assert rows[0]["invited_time"] == "2020-01-01T00:00:00+00:00"
+    assert rows[0]["datasource_packages"] == {"EKS_AUDIT": "STARTED"}
+
+    output = io.StringIO()
+    assert inventoryDetective.write_inventory(iter(rows), output, 'jsonl') == 2
+    assert json.loads(output.getvalue().splitlines()[1])["status"] == "INVITED"
+    output = io.StringIO()
+    inventoryDetective.write_inventory(iter(rows), output, 'csv')
+    lines = output.getvalue().splitlines()
+    assert lines[0] == ','.join(inventoryDetective.COLUMNS)
+    assert lines[1].startswith('us-east-1,graph-1,111111111111,test1@gmail.com,ENABLED,,2020-01-01T00:00:00+00:00,,,')
+
+
+###
+# The purpose of this test is to make sure roles are assumed through the regional STS endpoint,
+# the partition is looked up once, and the latency is recorded, in amazon_detective_multiaccount_utilities.py
+###
+def test_assume_role_regional_sts_detective_multiaccount_utilities():
+    helper.STS_LATENCY.clear()
+    with patch.object(helper, '_PARTITION', None):
+        with patch.object(helper.boto3.session, 'Session') as session_mock:
+            sts_client = session_mock.return_value.client.return_value
+            sts_client.get_caller_identity.return_value = {"Arn": "arn:aws-us-gov:iam::555555555555:user/admin"}
+            sts_client.assume_role.return_value = {"Credentials": {"AccessKeyId": "a", "SecretAccessKey": "b", "SessionToken": "c"}}
+            with patch.object(helper.boto3, 'Session'):
+                helper.use_regional_sts_endpoints(True)
+                try:
+                    helper.assume_role("111111111111", "detectiveAdmin", "test", "us-gov-west-1")
+                    helper.assume_role("222222222222", "detectiveAdmin", "test", "us-gov-west-1")
+                finally:
+                    helper.use_regional_sts_endpoints(False)
+                helper.assume_role("333333333333", "detectiveAdmin", "test", "us-gov-west-1")
+
+    assert session_mock.return_value.client.call_args_list == [call('sts', region_name='us-gov-west-1')] * 2 + [call('sts')]
+    assert session_mock.call_args_list[0].kwargs['botocore_session'].get_config_variable('sts_regional_endpoints') == 'regional'
+    sts_client.get_caller_identity.assert_called_once()
+    assert sts_client.assume_role.call_args.kwargs['RoleArn'] == 'arn:aws-us-gov:iam::333333333333:role/detectiveAdmin'
+    summary = helper.STS_LATENCY.summary()
+    assert summary[('us-gov-west-1', 'regional')]['count'] == 2
+    assert summary[('us-gov-west-1', 'global')]['count'] == 1
+    assert helper.STS_LATENCY.percentile(('us-gov-west-1', 'regional'), 0.9) >= 0
+    helper.STS_LATENCY.clear()
+
+
+###
+# The purpose of this test is to make sure a slow read is hedged after the percentile deadline,
+# and that the first response is used, in amazon_detective_multiaccount_utilities.py
+###
+def test_hedged_call_detective_multiaccount_utilities():
+    d_client = Mock()
+    d_client.meta.region_name = 'ap-southeast-2'
+    released = threading.Event()
+    responses = iter([{"MemberDetails": [], "slow": True}, {"MemberDetails": []}])
+
+    def list_members(**kwargs):
+        response = next(responses)
+        if response.get("slow"):
+            released.wait(5)
+        return response
+
+    d_client.list_members.side_effect = list_members
+    before = helper.hedge_stats()
+    helper.enable_hedged_reads(percentile=0.9, warmup=3, min_deadline=0.01)
+    try:
+        for _ in range(3):
+            helper.READ_LATENCY.record(('list_members', 'ap-southeast-2'), 0.01)
+        assert helper.hedged_call(d_client, 'list_members', GraphArn="graph-1") == {"MemberDetails": []}
+    finally:
+        released.set()
+        helper.disable_hedged_reads()
+        helper.READ_LATENCY.clear()
+    after = helper.hedge_stats()
+    assert (after["issued"] - before["issued"], after["won"] - before["won"]) == (1, 1)
+    assert d_client.list_members.call_args_list == [call(GraphArn="graph-1")] * 2
+
+    # without hedging, the call is made once, directly
+    d_client = Mock()
+    d_client.list_graphs.return_value = {"GraphList": []}
+    assert helper.hedged_call(d_client, 'list_graphs') == {"GraphList": []}
+    d_client.list_graphs.assert_called_once_with()
+
+
+###
+# The purpose of this test is to make sure the circuit breaker opens after the consecutive failures,
+# lets a single probe through once half open, and closes on success in amazon_detective_multiaccount_utilities.py
+###
+def test_circuit_breaker_detective_multiaccount_utilities():
+    now = [0.0]
+    breaker = helper.CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=lambda: now[0])
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == helper.CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == helper.CircuitBreaker.OPEN and not breaker.allow()
+
+    now[0] = 30.0
+    assert breaker.state == helper.CircuitBreaker.HALF_OPEN
+    assert breaker.allow() and not breaker.allow()
+    # a failed probe opens the breaker again for another reset_timeout
+    breaker.record_failure()
+    assert breaker.state == helper.CircuitBreaker.OPEN
+
+    now[0] = 60.0
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == helper.CircuitBreaker.CLOSED and breaker.allow()
+
+
+###
+# The purpose of this test is to make sure a failing region is skipped once its circuit breaker is open,
+# while the other regions are still processed, in disableDetective.py
+###
+def test_circuit_breaker_process_accounts_disable_detective(tmp_path):
+    aws_account_dict = {str(100000000000 + i): f"test{i}@gmail.com" for i in range(150)}
+    args = argparse.Namespace(delete_graph=False)
+    d_client = Mock()
+
+    def client(service, region_name):
+        if region_name == 'us-east-2':
+            raise Exception("Could not connect to the endpoint URL")
+        return d_client
+
+    admin_session = Mock()
+    admin_session.client.side_effect = client
+    helper.enable_circuit_breakers(failure_threshold=2, reset_timeout=300)
+    try:
+        with patch.object(helper, 'get_graphs', return_value=["graph1"]), \
+                patch.object(disableDetective, 'delete_members', side_effect=lambda c, g, ids, u: ids), \
+                patch.object(logging, 'exception'), patch.object(logging, 'warning'):
+            report = disableDetective.process_accounts_disable_detective(aws_account_dict, ['us-east-1', 'us-east-2'],
+                                                                         admin_session, args)
+        assert helper.circuit_breaker('us-east-2', 'disable').state == helper.CircuitBreaker.OPEN
+    finally:
+        helper.disable_circuit_breakers()
+
+    assert len(report["deleted"]["us-east-1"]) == 150
+    # the first two chunks of 50 accounts failed, the third one was shed
+    assert len(report["failed"]["us-east-2"]) == 100
+    assert report["circuit_open"]["us-east-2"] == set(aws_account_dict) - report["failed"]["us-east-2"]
+    assert admin_session.client.call_count == 3 + 2
+
+    helper.write_accounts_csv({account: aws_account_dict[account] for account in report["circuit_open"]["us-east-2"]},
+                              str(tmp_path / "skipped.csv"))
+    with open(tmp_path / "skipped.csv") as f:
+        assert helper.read_accounts_csv(f) == {account: aws_account_dict[account]
+                                               for account in report["circuit_open"]["us-east-2"]}
+
+
+###
+# The purpose of this test is to make sure the phase budgets count the time spent in each phase,
+# and that a wait which can't complete is not started in amazon_detective_multiaccount_deadline.py
+###
+def test_phase_budgets_detective_multiaccount_deadline():
+    run = deadline.RunDeadline(budgets={"create": 60, "wait": 5})
+    with patch.object(time, 'monotonic', side_effect=[100.0, 130.0, 130.0, 200.0]):
+        with run.phase("create"):
+            pass
+        with run.phase("create"):
+            pass
+    assert run.spent("create") == 100.0
+    assert run.expired("create") and not run.expired("wait") and not run.expired()
+    with pytest.raises(deadline.DeadlineExceeded):
+        run.check("create")
+
+    with patch.object(time, 'sleep') as time_sleep:
+        with pytest.raises(deadline.DeadlineExceeded) as e:
+            run.sleep(10)
+        assert e.value.phase == "wait"
+        time_sleep.assert_not_called()
+        run.sleep(2)
+        time_sleep.assert_called_once_with(2)
+
+    assert deadline.RunDeadline(end_time=time.time() - 1).expired()
+    parser = argparse.ArgumentParser()
+    deadline.add_command_line_arguments(parser)
+    args = parser.parse_args(['--deadline', '2030-01-01T00:00:00+00:00', '--phase_budget', 'wait=1.5'])
+    assert args.deadline == datetime.datetime(2030, 1, 1, tzinfo=datetime.timezone.utc).timestamp()
+    assert args.phase_budget == [("wait", 90.0)]
+
+
+###
+# The purpose of this test is to make sure the accounts are reported as pending instead of failed
+# when the budget of the wait phase is too short, or when the deadline has passed, in enableDetective.py
+###
+def test_deadline_process_accounts_enable_detective(tmp_path):
+    aws_account_dict = {"123456789012": "random@gmail.com", "111111111111": "test1@gmail.com"}
+    args = argparse.Namespace(skip_prompt=True, tags=None, disable_email=False, assume_role="detectiveMember")
+    admin_session = Mock()
+
+    deadline.activate(budgets={"wait": 5})
+    try:
+        with patch.object(enableDetective, 'enable_detective', return_value=["graph1"]), \
+                patch.object(helper, 'get_members', return_value=({"graph1": set()}, {"graph1": set()}, {})), \
+                patch.object(enableDetective, 'create_members', side_effect=lambda c, g, e, m, chunk, u: set(chunk)), \
+                patch.object(enableDetective, 'accept_invitations') as accept_invitations, \
+                patch.object(time, 'sleep') as time_sleep:
+            report = enableDetective.process_accounts_enable_detective(aws_account_dict, ["us-east-1", "us-east-2"],
+                                                                       admin_session, args)
+        time_sleep.assert_not_called()
+        accept_invitations.assert_not_called()
+        # the members were created, but there was no time left to wait for their invitations
+        assert report == {"created": {"us-east-1": set(aws_account_dict), "us-east-2": set(aws_account_dict)},
+                          "pending": {"us-east-1": set(aws_account_dict), "us-east-2": set(aws_account_dict)}}
+
+        # the deadline stops the acceptance after the first account: only the other one is pending
+        deadline.activate()
+
+        assumed = []
+
+        def _assume_role(account, *args):
+            if assumed:
+                raise deadline.DeadlineExceeded("accept")
+            assumed.append(account)
+            return Mock()
+
+        with patch.object(enableDetective, 'enable_detective', return_value=["graph1"]), \
+                patch.object(helper, 'get_members', return_value=({"graph1": set()}, {"graph1": set(aws_account_dict)}, {})), \
+                patch.object(helper, 'get_members_by_ids', return_value=({"graph1": set()}, {"graph1": set()}, {})), \
+                patch.object(enableDetective, 'create_members', return_value=set()), \
+                patch.object(helper, 'assume_role', side_effect=_assume_role), \
+                patch.object(time, 'sleep'):
+            report = enableDetective.process_accounts_enable_detective(aws_account_dict, ["us-east-1"], admin_session, args)
+        assert report == {"accepted": {"us-east-1": set(assumed)}, "pending": {"us-east-1": set(aws_account_dict) - set(assumed)}}
+
+        deadline.activate(end_time=time.time() - 1)
+        admin_session = Mock()
+        report = enableDetective.process_accounts_enable_detective(aws_account_dict, ["us-east-1"], admin_session, args)
+        assert report == {"pending": {"us-east-1": set(aws_account_dict)}}
+        admin_session.client.assert_not_called()
+    finally:
+        deadline.deactivate()
+
+    pending_file = tmp_path / "pending.csv"
+    assert deadline.write_pending(report, aws_account_dict, str(pending_file)) == set(aws_account_dict)
+    with open(pending_file) as f:
+        assert helper.read_accounts_csv(f) == aws_account_dict
+
+
+###
+# The purpose of this test is to make sure the progress tracker computes the throughput and an ETA
+# that accounts for the time spent waiting in amazon_detective_multiaccount_progress.py
+###
+def test_progress_tracker_detective_multiaccount_progress():
+    now = [0.0]
+    tracker = progress.ProgressTracker(clock=lambda: now[0])
+    for region in ("us-east-1", "us-east-2"):
+        for phase in ("create", "accept"):
+            tracker.plan(phase, region, 100)
+    tracker.plan_batches(4)
+    assert tracker.snapshot()["eta"] is None
+
+    # one batch of 50 accounts: 20s of work and a 40s wait
+    now[0] = 10.0
+    tracker.advance("create", "us-east-1", 50)
+    tracker.start_wait()
+    now[0] = 50.0
+    tracker.end_wait()
+    now[0] = 60.0
+    tracker.advance("accept", "us-east-1", 50)
+    tracker.finish_batch()
+    for _ in range(30):
+        tracker.count_call()
+
+    snapshot = tracker.snapshot()
+    assert snapshot["phases"]["create"]["regions"] == {"us-east-1": {"completed": 50, "remaining": 50},
+                                                       "us-east-2": {"completed": 0, "remaining": 100}}
+    assert (snapshot["accounts_per_minute"], snapshot["calls_per_second"], snapshot["waited"]) == (50.0, 0.5, 40.0)
+    # 300 remaining units at 0.2s each, plus 3 remaining batches waiting 40s each
+    assert snapshot["eta"] == 180.0
+    assert progress.describe(snapshot) == "accept 50/200 | create 50/200 | 50.0 accounts/min | 0.5 calls/s | ETA 3m00s"
+
+
+###
+# The purpose of this test is to make sure the batches of process_accounts_disable_detective() are
+# counted, including the failed ones, and that the final status line is written in disableDetective.py
+###
+def test_progress_process_accounts_disable_detective():
+    aws_account_dict = {str(100000000000 + i): f"test{i}@gmail.com" for i in range(60)}
+    args = argparse.Namespace(delete_graph=False)
+    d_client = Mock()
+
+    def client(service, region_name):
+        if region_name == 'us-east-2':
+            raise Exception("Could not connect to the endpoint URL")
+        return d_client
+
+    admin_session = Mock()
+    admin_session.client.side_effect = client
+    stream = io.StringIO()
+    tracker = progress.activate('tty', interval=3600, stream=stream)
+    try:
+        with patch.object(helper, 'get_graphs', return_value=["graph1"]), \
+                patch.object(disableDetective, 'delete_members', side_effect=lambda c, g, ids, u: ids), \
+                patch.object(logging, 'exception'):
+            disableDetective.process_accounts_disable_detective(aws_account_dict, ['us-east-1', 'us-east-2'],
+                                                                admin_session, args)
+        assert tracker.batches == [4, 4]
+        assert tracker.snapshot()["phases"]["delete"]["completed"] == 120
+    finally:
+        progress.deactivate()
+    assert stream.getvalue().startswith("\r\033[Kdelete 120/120 | ")
+    assert stream.getvalue().endswith("\n")
+
+    # without an active tracker, the batches cost nothing
+    progress.batch("us-east-1", 50, ("delete",)).close()
+    assert isinstance(progress._TRACKER, progress._NoProgress)
+
+
+###
+# The purpose of this test is to make sure the profiling mode times the phases and writes the sampled
+# stacks in the folded format of the flame graph tools in amazon_detective_multiaccount_profile.py
+###
+def test_profiling_detective_multiaccount_profile(tmp_path):
+    d_client = Mock()
+    d_client.list_graphs.side_effect = lambda: time.sleep(0.1) or {"GraphList": [{"Arn": "graph-1"}]}
+
+    profile_file = tmp_path / "profile.folded"
+    profiling.activate(str(profile_file), interval=0.001)
+    try:
+        assert helper.get_graphs(d_client) == ["graph-1"]
+        deadline.sleep(0.05)
+    finally:
+        summary = profiling.finish()
+
+    assert summary["get_graphs"]["calls"] == 1 and summary["get_graphs"]["wall"] >= 0.1
+    assert summary["wait"]["calls"] == 1 and summary["wait"]["wall"] >= 0.05
+    # the time was spent sleeping, not on the CPU
+    assert summary["get_graphs"]["cpu"] < summary["get_graphs"]["wall"] / 2
+    with open(profile_file) as f:
+        lines = f.read().splitlines()
+    assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert any(line.startswith("MainThread;") and ";get_graphs (amazon_detective_multiaccount_utilities.py:" in line
+               for line in lines)
+
+    # when not profiling, the timed functions are called directly
+    assert profiling.finish() is None
+    with profiling.timer("get_graphs"):
+        pass
+
+
+###
+# The purpose of this test is to make sure the recorded calls are scrubbed of their credentials,
+# and replayed offline, errors included, in amazon_detective_multiaccount_recording.py
+###
+def test_record_replay_detective_multiaccount_recording(tmp_path):
+    recording_file = str(tmp_path / "calls.jsonl")
+    created = datetime.datetime(2026, 10, 1, tzinfo=datetime.timezone.utc)
+    credentials = {"AccessKeyId": "ASIAEXAMPLEEXAMPLE", "SecretAccessKey": "secret-key", "SessionToken": "secret-token",
+                   "Expiration": created}
+
+    def _session():
+        return helper.instrument_session(boto3.session.Session(aws_access_key_id="AKIAEXAMPLE",
+                                                               aws_secret_access_key="admin-secret"))
+
+    recording.record(recording_file)
+    try:
+        session = _session()
+        sts_client = session.client("sts", region_name="us-east-1")
+        d_client = session.client("detective", region_name="us-east-1")
+        with Stubber(sts_client) as sts_stub, Stubber(d_client) as d_stub:
+            sts_stub.add_response("assume_role", {"Credentials": credentials})
+            d_stub.add_response("list_graphs", {"GraphList": [{"Arn": "arn:aws:detective:us-east-1:555555555555:graph:1",
+                                                               "CreatedTime": created}]})
+            d_stub.add_client_error("list_members", "TooManyRequestsException", http_status_code=429)
+            sts_client.assume_role(RoleArn="arn:aws:iam::111111111111:role/detective", RoleSessionName="test")
+            d_client.list_graphs()
+            with pytest.raises(botocore.exceptions.ClientError):
+                d_client.list_members(GraphArn="arn:aws:detective:us-east-1:555555555555:graph:1")
+        # an error without an HTTP response
+        unreachable = session.client("detective", region_name="us-east-1", endpoint_url="http://127.0.0.1:9",
+                                     config=botocore.config.Config(retries={"max_attempts": 0}))
+        with pytest.raises(botocore.exceptions.EndpointConnectionError):
+            unreachable.list_graphs()
+    finally:
+        recording.finish()
+
+    with open(recording_file) as f:
+        recorded = f.read()
+    assert "secret" not in recorded and "ASIAEXAMPLE" not in recorded
+    assert len(recorded.splitlines()) == 1 + 4
+    assert json.loads(recorded.splitlines()[-1])["error"]["code"] == "EndpointConnectionError"
+
+    replayer = recording.replay(recording_file, speed=0)
+    try:
+        session = _session()
+        sts_client = session.client("sts", region_name="us-east-1")
+        d_client = session.client("detective", region_name="us-east-1")
+        response = sts_client.assume_role(RoleArn="arn:aws:iam::111111111111:role/detective", RoleSessionName="test")
+        assert response["Credentials"]["SessionToken"] == recording.REDACTED
+        assert d_client.list_graphs()["GraphList"][0]["CreatedTime"] == created
+        with pytest.raises(botocore.exceptions.ClientError) as e:
+            d_client.list_members(GraphArn="arn:aws:detective:us-east-1:555555555555:graph:1")
+        assert e.value.response["Error"]["Code"] == "TooManyRequestsException"
+        with pytest.raises(botocore.exceptions.ClientError) as e:
+            d_client.list_graphs()
+        assert e.value.response["Error"]["Code"] == "EndpointConnectionError"
+        assert e.value.operation_name == "ListGraphs"
+        # a call the recorded run did not make
+        with pytest.raises(recording.ReplayMismatch):
+            d_client.list_graphs()
+        summary = replayer.summary()
+    finally:
+        recording.finish()
+    assert summary["operations"]["detective.ListGraphs"] == {"recorded": 2, "replayed": 2, "mismatched": 1}
+    assert summary["operations"]["sts.AssumeRole"] == {"recorded": 1, "replayed": 1, "mismatched": 0}
+
+
+###
+# The purpose of this test is to make sure the account registry behaves like the dictionary of accounts it replaces,
+# and that the differences over its sorted integer arrays are correct in amazon_detective_multiaccount_registry.py
+###
+def test_account_registry():
+    accounts_csv = io.StringIO("222222222222,a@example.com\n000012345678,b@example.com\n111111111111,c@example.com\n"
+                               "222222222222,d@example.com\n1234567890123,e@example.com\n")
+    accounts_dict = helper.read_accounts_csv(accounts_csv)
+
+    assert isinstance(accounts_dict, registry.AccountRegistry)
+    assert accounts_dict == {"000012345678": "b@example.com", "111111111111": "c@example.com", "222222222222": "d@example.com"}
+    assert list(accounts_dict) == ["000012345678", "111111111111", "222222222222"]
+    assert "000012345678" in accounts_dict
+    assert "12345678" not in accounts_dict and "not an account" not in accounts_dict
+    with pytest.raises(KeyError):
+        accounts_dict["333333333333"]
+    assert list(accounts_dict.records())[0] == registry.Account("000012345678", "b@example.com")
+
+    # a small collection is merged as a sorted array, a large set is probed
+    assert dict(accounts_dict.difference({"111111111111", "999999999999"})) == {"000012345678": "b@example.com",
+                                                                               "222222222222": "d@example.com"}
+    members = {f'{i:012d}' for i in range(100)} | {"000012345678", "222222222222"}
+    assert set(accounts_dict.difference(members)) == {"111111111111"}
+    assert set(registry.difference(dict(accounts_dict), members)) == {"111111111111"}
+    assert list(accounts_dict.difference(registry.AccountRegistry.from_pairs([("000012345678", "x")]))) == [
+        "111111111111", "222222222222"]
+
+    assert [dict(chunk) for chunk in registry.chunks(accounts_dict, 2)] == [
+        {"000012345678": "b@example.com", "111111111111": "c@example.com"}, {"222222222222": "d@example.com"}]
+    assert [dict(chunk) for chunk in registry.chunks(dict(accounts_dict), 2)] == [
+        dict(chunk) for chunk in registry.chunks(accounts_dict, 2)]
+
+
+###
+# The purpose of this test is to make sure reading 100k accounts into the registry stays within a memory bound per
+# account in amazon_detective_multiaccount_utilities.py
+###
+def test_account_registry_memory():
+    count = 100000
+    for mailboxes, retained_bound, peak_bound in ((count, 96, 160), (1000, 24, 96)):
+        lines = ''.join(f'{100000000000 + i * 7919},user{i % mailboxes}@example.com\n' for i in range(count))
+
+        accounts_csv = io.StringIO(lines)
+        tracemalloc.start()
+        try:
+            accounts_dict = helper.read_accounts_csv(accounts_csv)
+            retained, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        assert len(accounts_dict) == count
+        # 16 bytes for the ID and the list slot, plus ~70 bytes for each distinct email,
+        # against ~170 bytes per account in a dictionary
+        assert retained / count < retained_bound
+        # the sort keys are released once the arrays are built
+        assert peak / count < peak_bound
+        assert accounts_dict[f'{100000000000 + 5 * 7919}'] == 'user5@example.com'
+
+
+###
+# The purpose of this test is to make sure the datasource packages are enabled in the graphs of every region, and that
+# the datasource report asks for 50 accounts per call and keeps the latest ingest state in enableDetective.py
+###
+def test_datasource_packages_and_report(tmp_path):
+    graphs = {region: f'arn:aws:detective:{region}:555555555555:graph:{region[-1]}' for region in ['us-east-1', 'us-east-2']}
+    clients = {}
+    for region, graph in graphs.items():
+        d_client = Mock()
+        d_client.list_graphs.return_value = {'GraphList': [{'Arn': graph}]}
+        d_client.batch_get_graph_member_datasources.side_effect = lambda GraphArn, AccountIds: {
+            'MemberDatasources': [{'AccountId': x, 'GraphArn': GraphArn, 'DatasourcePackageIngestHistory': {
+                'DETECTIVE_CORE': {'STARTED_INGESTION': {'Timestamp': datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)}},
+                'EKS_AUDIT': {'STARTED_INGESTION': {'Timestamp': datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)},
+                              'STOPPED_INGESTION': {'Timestamp': datetime.datetime(2026, 2, 1, tzinfo=datetime.timezone.utc)}}}}
+                for x in AccountIds if x != '000000000007'],
+            'UnprocessedAccounts': [{'AccountId': x, 'Reason': 'not a member'} for x in AccountIds if x == '000000000007']}
+        clients[region] = d_client
+    admin_session = Mock()
+    admin_session.client.side_effect = lambda service, region_name: clients[region_name]
+
+    args = enableDetective.setup_command_line(['--admin_account', '555555555555', '--assume_role', 'detectiveAdmin',
+                                               '--input_file', 'accounts.csv', '--datasource_packages', 'EKS_AUDIT,ASFF_SECURITYHUB_FINDING'])
+    assert args.datasource_packages == ['EKS_AUDIT', 'ASFF_SECURITYHUB_FINDING']
+    with pytest.raises(SystemExit):
+        enableDetective.setup_command_line(['--admin_account', '555555555555', '--assume_role', 'detectiveAdmin',
+                                            '--input_file', 'accounts.csv', '--datasource_packages', 'EKS'])
+
+    with pytest.raises(SystemExit):
+        enableDetective.setup_command_line(['--admin_account', '555555555555', '--assume_role', 'detectiveAdmin',
+                                            '--input_file', 'accounts.csv', '--datasource_packages', 'DETECTIVE_CORE,EKS_AUDIT'])
+    with pytest.raises(SystemExit):
+        enableDetective.setup_command_line(['--admin_account', '555555555555', '--assume_role', 'detectiveAdmin',
+                                            '--input_file', 'accounts.csv', '--datasource_packages', 'EKS_AUDIT', '--plan'])
+
+    assert enableDetective.enable_datasource_packages(admin_session, list(graphs), True, None, args.datasource_packages) == {
+        graph: 'updated' for graph in graphs.values()}
+    for region, graph in graphs.items():
+        clients[region].update_datasource_packages.assert_called_once_with(
+            GraphArn=graph, DatasourcePackages=['EKS_AUDIT', 'ASFF_SECURITYHUB_FINDING'])
+        clients[region].create_graph.assert_not_called()
+
+    # a graph whose update fails, and a region whose graphs cannot be listed, are failed
+    clients['us-east-1'].update_datasource_packages.side_effect = Exception('AccessDenied')
+    clients['us-east-2'].list_graphs.side_effect = Exception('AccessDenied')
+    assert enableDetective.enable_datasource_packages(admin_session, list(graphs), True, None, args.datasource_packages) == {
+        graphs['us-east-1']: 'failed', 'us-east-2': 'failed'}
+    clients['us-east-2'].list_graphs.side_effect = None
+
+    account_ids = [f'{i:012d}' for i in range(120)]
+    rows = enableDetective.datasource_report(admin_session, list(graphs), account_ids)
+    for d_client in clients.values():
+        assert [len(c.kwargs['AccountIds']) for c in d_client.batch_get_graph_member_datasources.call_args_list] == [50, 50, 20]
+    assert len(rows) == 2 * 119 * 2
+    assert rows[0] == {'region': 'us-east-1', 'graph': graphs['us-east-1'], 'account_id': '000000000000',
+                       'datasource_package': 'DETECTIVE_CORE', 'ingest_state': 'STARTED_INGESTION',
+                       'updated_time': '2026-01-01T00:00:00+00:00'}
+    assert rows[1]['datasource_package'] == 'EKS_AUDIT' and rows[1]['ingest_state'] == 'STOPPED_INGESTION'
+
+    enableDetective.write_datasource_report(rows, str(tmp_path / 'datasources.csv'))
+    with open(tmp_path / 'datasources.csv') as f:
+        lines = f.read().splitlines()
+    assert lines[0] == ','.join(enableDetective.DATASOURCE_REPORT_COLUMNS)
+    assert len(lines) == len(rows) + 1
+
+
+###
+# The purpose of this test is to make sure the tags of the existing graphs are reconciled with the minimal tag and
+# untag calls, and that no call is made when they already match in enableDetective.py
+###
+def test_reconcile_graph_tags():
+    assert enableDetective.tag_changes({'Team': 'Ops', 'Old': '1', 'Env': 'prod'}, {'Team': 'Security', 'Env': 'prod', 'Cost': ''}) == (
+        {'Team': 'Security', 'Cost': ''}, [])
+    assert enableDetective.tag_changes({'Team': 'Ops', 'Old': '1'}, {'Team': 'Ops'}, remove_others=True) == ({}, ['Old'])
+
+    desired = {'Team': 'Security'}
+    graphs = {'us-east-1': 'arn:aws:detective:us-east-1:555555555555:graph:1',
+              'us-east-2': 'arn:aws:detective:us-east-2:555555555555:graph:2'}
+    clients, stubbers = {}, {}
+    for region, graph in graphs.items():
+        clients[region] = botocore.session.get_session().create_client('detective', region_name=region)
+        stubbers[region] = Stubber(clients[region])
+        stubbers[region].add_response('list_graphs', {'GraphList': [{'Arn': graph}]})
+    stubbers['us-east-1'].add_response('list_tags_for_resource', {'Tags': {'Team': 'Security'}}, {'ResourceArn': graphs['us-east-1']})
+    stubbers['us-east-2'].add_response('list_tags_for_resource', {'Tags': {'Team': 'Ops', 'Old': '1'}}, {'ResourceArn': graphs['us-east-2']})
+    stubbers['us-east-2'].add_response('tag_resource', {}, {'ResourceArn': graphs['us-east-2'], 'Tags': desired})
+    stubbers['us-east-2'].add_response('untag_resource', {}, {'ResourceArn': graphs['us-east-2'], 'TagKeys': ['Old']})
+    admin_session = Mock()
+    admin_session.client.side_effect = lambda service, region_name: clients[region_name]
+
+    for stubber in stubbers.values():
+        stubber.activate()
+    assert enableDetective.reconcile_graph_tags(admin_session, list(graphs), desired, remove_others=True) == {
+        graphs['us-east-1']: 'unchanged', graphs['us-east-2']: 'updated'}
+    for stubber in stubbers.values():
+        stubber.assert_no_pending_responses()
+
+    # the fast path: once the tags match, only the reads are made
+    for region, graph in graphs.items():
+        stubbers[region].add_response('list_graphs', {'GraphList': [{'Arn': graph}]})
+        stubbers[region].add_response('list_tags_for_resource', {'Tags': dict(desired)}, {'ResourceArn': graph})
+    assert enableDetective.reconcile_graph_tags(admin_session, list(graphs), desired, remove_others=True) == {
+        graph: 'unchanged' for graph in graphs.values()}
+    for stubber in stubbers.values():
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
+
+    # the aws: tags are never removed, and a graph or a region that cannot be read is failed
+    assert enableDetective.tag_changes({'aws:cloudformation:stack-name': 'detective', 'Old': '1'}, desired, remove_others=True) == (
+        desired, ['Old'])
+    mock_clients = {region: Mock() for region in graphs}
+    mock_clients['us-east-1'].list_graphs.return_value = {'GraphList': [{'Arn': graphs['us-east-1']}]}
+    mock_clients['us-east-1'].list_tags_for_resource.side_effect = Exception('AccessDenied')
+    mock_clients['us-east-2'].list_graphs.side_effect = Exception('AccessDenied')
+    admin_session.client.side_effect = lambda service, region_name: mock_clients[region_name]
+    assert enableDetective.reconcile_graph_tags(admin_session, list(graphs), desired) == {
+        graphs['us-east-1']: 'failed', 'us-east-2': 'failed'}
+    mock_clients['us-east-1'].tag_resource.assert_not_called()
+
+    with pytest.raises(SystemExit):
+        enableDetective.setup_command_line(['--admin_account', '555555555555', '--assume_role', 'detectiveAdmin',
+                                            '--input_file', 'accounts.csv', '--reconcile_tags', 'add'])
+    with pytest.raises(SystemExit):
+        enableDetective.setup_command_line(['--admin_account', '555555555555', '--assume_role', 'detectiveAdmin',
+                                            '--input_file', 'accounts.csv', '--tags', 'Team=Security', '--reconcile_tags', 'add',
+                                            '--plan'])
+
+
+###
+# The purpose of this test is to make sure the member side mode assumes the role in each member account once,
+# disassociates from the admin graphs, rejects the invitations never accepted and reports each account in disableDetective.py
+###
+def test_process_accounts_member_side(tmp_path):
+    regions = ['us-east-1', 'us-east-2']
+    admin_graph = {region: f'arn:aws:detective:{region}:555555555555:graph:{region[-1]}' for region in regions}
+    other_graph = 'arn:aws:detective:us-east-1:999999999999:graph:9'
+    invitations = {
+        ('111111111111', 'us-east-1'): [{'GraphArn': admin_graph['us-east-1'], 'Status': 'ENABLED'},
+                                        {'GraphArn': other_graph, 'Status': 'ENABLED'}],
+        ('111111111111', 'us-east-2'): [{'GraphArn': admin_graph['us-east-2'], 'Status': 'INVITED'}],
+        ('222222222222', 'us-east-1'): [],
+        ('222222222222', 'us-east-2'): [{'GraphArn': admin_graph['us-east-2'], 'Status': 'ACCEPTED_BUT_DISABLED'}],
+    }
+    clients = {}
+
+    def _session(account, role, role_session_name, region=None):
+        session = Mock()
+
+        def _client(service, region_name):
+            d_client = Mock()
+            d_client.list_invitations.return_value = {'Invitations': invitations[(account, region_name)]}
+            if account == '222222222222':
+                d_client.disassociate_membership.side_effect = botocore.exceptions.ClientError(
+                    {'Error': {'Code': 'ValidationException', 'Message': 'denied'}}, 'DisassociateMembership')
+            clients[(account, region_name)] = d_client
+            return d_client
+        session.client.side_effect = _client
+        return session
+
+    args = disableDetective.setup_command_line(['--admin_account', '555555555555', '--assume_role', 'detectiveAdmin',
+                                                '--input_file', 'accounts.csv', '--member_side',
+                                                '--member_results_file', str(tmp_path / 'results.csv')])
+    aws_account_dict = {'111111111111': 'test1@gmail.com', '222222222222': 'test2@gmail.com'}
+    disableDetective._MEMBER_SESSIONS.invalidate()
+    with patch.object(helper, 'assume_role', side_effect=_session) as mock_assume_role:
+        report = disableDetective.process_accounts_member_side(aws_account_dict, regions, None, args)
+        disableDetective.member_session('111111111111', 'detectiveAdmin')
+    disableDetective._MEMBER_SESSIONS.invalidate()
+
+    assert mock_assume_role.call_count == 2
+    assert report == {'disassociated': {'us-east-1': {'111111111111'}}, 'rejected': {'us-east-2': {'111111111111'}},
+                      'not_member': {'us-east-1': {'222222222222'}}, 'failed': {'us-east-2': {'222222222222'}}}
+    clients[('111111111111', 'us-east-1')].disassociate_membership.assert_called_once_with(GraphArn=admin_graph['us-east-1'])
+    clients[('111111111111', 'us-east-2')].reject_invitation.assert_called_once_with(GraphArn=admin_graph['us-east-2'])
+    clients[('111111111111', 'us-east-2')].disassociate_membership.assert_not_called()
+
+    with open(tmp_path / 'results.csv') as f:
+        lines = f.read().splitlines()
+    assert lines[0] == ','.join(disableDetective.MEMBER_RESULTS_COLUMNS)
+    assert len(lines) == 5
+    assert f'222222222222,us-east-2,{admin_graph["us-east-2"]},ACCEPTED_BUT_DISABLED,disassociate_membership,failed,' in lines[4]
+
+    # the accounts the deadline left out are in the results file too, as pending
+    with patch.object(helper, 'assume_role', side_effect=_session):
+        with patch.object(deadline, 'exhausted', side_effect=[False, True]):
+            report = disableDetective.process_accounts_member_side(aws_account_dict, regions, None, args)
+    disableDetective._MEMBER_SESSIONS.invalidate()
+    assert report['pending'] == {'us-east-1': {'222222222222'}, 'us-east-2': {'222222222222'}}
+    with open(tmp_path / 'results.csv') as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 5
+    assert lines[3:] == ['222222222222,us-east-1,,,,pending,', '222222222222,us-east-2,,,,pending,']
+
+    with pytest.raises(SystemExit):
+        disableDetective.setup_command_line(['--admin_account', '555555555555', '--assume_role', 'detectiveAdmin',
+                                             '--delete_graph', '--member_side'])
+
+
+###
+# The purpose of this test is to make sure the watch mode only submits the accounts that are not enabled everywhere,
+# polls faster after a change and slower once converged, and reports the lag of each region in watchDetective.py
+###
+def test_watch_detective(tmp_path):
+    input_file = tmp_path / 'accounts.csv'
+    input_file.write_text('111111111111,test1@gmail.com\n222222222222,test2@gmail.com\n')
+    regions = ['us-east-1', 'us-east-2']
+    graphs = {region: f'arn:aws:detective:{region}:555555555555:graph:{region[-1]}' for region in regions}
+    members = {region: {'111111111111': 'ENABLED'} for region in regions}
+    now = [1000.0]
+    admin_session = Mock()
+
+    def _add_members(admin_account, role, accounts, regions, disable_email):
+        for region in regions:
+            members[region].update({account: 'ENABLED' for account in accounts})
+        return {'accepted': {region: set(accounts) for region in regions}}
+
+    watcher = watchDetective.Watcher('555555555555', 'detectiveAdmin', str(input_file), ','.join(regions),
+                                     remove_absent=True, min_interval=10, max_interval=40, clock=lambda: now[0])
+    with patch.object(api, 'get_admin_session', return_value=admin_session), \
+            patch.object(api, 'invalidate_member_snapshots'), \
+            patch.object(api, 'get_member_snapshot', side_effect=lambda session, region: {graphs[region]: dict(members[region])}), \
+            patch.object(api, 'add_members', side_effect=_add_members) as mock_add_members, \
+            patch.object(api, 'enable_members') as mock_enable_members, \
+            patch.object(api, 'disable_members', return_value={}) as mock_disable_members:
+        # the account missing from both regions is added with the fast path
+        assert watcher.cycle() == 10
+        mock_add_members.assert_called_once_with('555555555555', 'detectiveAdmin', {'222222222222': 'test2@gmail.com'},
+                                                 regions, False)
+        assert watcher.status()['regions'] == {region: {'pending': 1, 'lag': 0.0} for region in regions}
+
+        # converged: the interval grows up to max_interval, without any new submission
+        now[0] += 10
+        assert watcher.cycle() == 20
+        assert watcher.status()['converged']
+        now[0] += 20
+        assert watcher.cycle() == 40
+        now[0] += 40
+        assert watcher.cycle() == 40
+        assert mock_add_members.call_count == 1
+        mock_enable_members.assert_not_called()
+
+        # a drift in one region is reported with its lag, and the account is retried with a growing delay
+        members['us-east-2']['111111111111'] = 'ACCEPTED_BUT_DISABLED'
+        mock_add_members.side_effect = lambda *args: {}
+        now[0] += 40
+        assert watcher.cycle() == 10
+        now[0] += 10
+        watcher.cycle()
+        assert watcher.status()['regions']['us-east-2'] == {'pending': 1, 'lag': 10.0}
+        assert watcher.status()['regions']['us-east-1'] == {'pending': 0, 'lag': 0.0}
+        assert mock_add_members.call_count == 3
+        now[0] += 10
+        watcher.cycle()
+        assert mock_add_members.call_count == 3
+
+        # an account removed from the input file is removed from the graphs
+        members['us-east-2']['111111111111'] = 'ENABLED'
+        input_file.write_text('111111111111,test1@gmail.com\n')
+        now[0] += 10
+        assert watcher.cycle() == 10
+        mock_disable_members.assert_called_once_with('555555555555', 'detectiveAdmin',
+                                                     {'222222222222': 'test2@gmail.com'}, regions)
+    assert watcher.healthy()
+
+    server = watchDetective.serve_health(watcher, port=0)
+    try:
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+        with urllib.request.urlopen(url + '/healthz') as response:
+            assert response.status == 200
+            assert json.load(response)['converged']
+        with urllib.request.urlopen(url + '/metrics') as response:
+            metrics = response.read().decode()
+        assert 'detective_watch_pending_accounts{region="us-east-2"} 0' in metrics
+        assert 'detective_watch_cycles_total 8' in metrics
+        now[0] += 1000
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(url + '/healthz')
+        assert e.value.code == 503
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+###
+# The purpose of this test is to make sure a cycle of watchDetective.py that leaves accounts to recheck
+# keeps the watcher running, and the accounts are retried at the next cycle
+###
+def test_watch_detective_recheck(tmp_path):
+    input_file = tmp_path / 'accounts.csv'
+    input_file.write_text('111111111111,test1@gmail.com\n')
+    now = [1000.0]
+    admin_session = Mock()
+    graph = 'arn:aws:detective:us-east-1:555555555555:graph:1'
+
+    watcher = watchDetective.Watcher('555555555555', 'detectiveAdmin', str(input_file), 'us-east-1',
+                                     min_interval=10, max_interval=40, clock=lambda: now[0])
+    # the graph is missing from the snapshot, so the account goes through the full enable run, and the
+    # created member is never invited
+    with patch.object(api, 'get_admin_session', return_value=admin_session), \
+            patch.object(api, 'get_member_snapshot', return_value={}), \
+            patch.object(enableDetective, 'enable_detective', return_value=[graph]), \
+            patch.object(enableDetective, 'create_members', side_effect=lambda *args: {'111111111111'}), \
+            patch.object(helper, 'get_members', return_value=({graph: set()}, {}, {})), \
+            patch.object(helper, 'get_members_by_ids', return_value=({graph: {'111111111111'}}, {graph: set()}, {})), \
+            patch.object(enableDetective, 'accept_invitations') as accept_inv, \
+            patch.object(time, 'sleep'):
+        assert watcher.cycle() == 10
+        assert watcher.healthy()
+        assert watcher.status()['errors'] == 0
+        assert watcher.status()['regions'] == {'us-east-1': {'pending': 1, 'lag': 0.0}}
+        accept_inv.assert_not_called()
+        now[0] += 10
+        watcher.run(max_cycles=2)
+    assert watcher.cycles == 2
+    assert watcher.submitted == 2
+
+
+###
+# The purpose of this test is to make sure the accounts removed from the input file are removed again at the next cycle
+# of watchDetective.py when their removal fails
+###
+def test_watch_detective_remove_absent_retry(tmp_path):
+    input_file = tmp_path / 'accounts.csv'
+    input_file.write_text('111111111111,test1@gmail.com\n222222222222,test2@gmail.com\n')
+    graph = 'arn:aws:detective:us-east-1:555555555555:graph:1'
+    now = [1000.0]
+
+    watcher = watchDetective.Watcher('555555555555', 'detectiveAdmin', str(input_file), 'us-east-1',
+                                     remove_absent=True, min_interval=10, max_interval=40, clock=lambda: now[0])
+    with patch.object(api, 'get_admin_session', return_value=Mock()), \
+            patch.object(api, 'invalidate_member_snapshots'), \
+            patch.object(api, 'get_member_snapshot',
+                         return_value={graph: {'111111111111': 'ENABLED', '222222222222': 'ENABLED'}}), \
+            patch.object(api, 'disable_members', side_effect=[Exception('Throttling'),
+                                                              {'pending': {'us-east-1': {'222222222222'}}},
+                                                              {'deleted': {'us-east-1': {'222222222222'}}}]) as mock_disable_members:
+        watcher.cycle()
+        input_file.write_text('111111111111,test1@gmail.com\n')
+        for _ in range(4):
+            now[0] += 10
+            watcher.cycle()
+    assert watcher.errors == 1
+    assert mock_disable_members.call_count == 3
+    for c in mock_disable_members.call_args_list:
+        assert c.args == ('555555555555', 'detectiveAdmin', {'222222222222': 'test2@gmail.com'}, ['us-east-1'])
+
+
+###
+# The purpose of this test is to make sure an exhausted deadline doesn't take the probe of a half open
+# circuit breaker in enableDetective.py and disableDetective.py
+###
+def test_deadline_half_open_circuit_breaker():
+    aws_account_dict = {"111111111111": "test1@gmail.com"}
+    helper.enable_circuit_breakers(failure_threshold=1, reset_timeout=0)
+    deadline.activate(end_time=time.time() - 1)
+    try:
+        for operation in ('enable', 'disable'):
+            helper.circuit_breaker('us-east-1', operation).record_failure()
+        admin_session = Mock()
+        report = enableDetective.process_accounts_enable_detective(
+            aws_account_dict, ["us-east-1"], admin_session, argparse.Namespace(skip_prompt=True, tags=None))
+        assert report == {"pending": {"us-east-1": {"111111111111"}}}
+        report = disableDetective.process_accounts_disable_detective(
+            aws_account_dict, ["us-east-1"], admin_session, argparse.Namespace(delete_graph=False))
+        assert report == {"pending": {"us-east-1": {"111111111111"}}}
+        admin_session.client.assert_not_called()
+        # the probe is still available to the next run
+        for operation in ('enable', 'disable'):
+            assert helper.circuit_breaker('us-east-1', operation).allow()
+    finally:
+        deadline.deactivate()
+        helper.disable_circuit_breakers()
+
+
+###
+# The purpose of this test is to make sure the graphs are created once, before the shards are started,
+# by create_graphs() in enableDetective.py
+###
+def test_run_sharded_create_graphs():
+    aws_account_dict = {"123456789012": "random@gmail.com", "111111111111": "test1@gmail.com",
+                        "222222222222": "test2@gmail.com", "333333333333": "test3@gmail.com"}
+    args = enableDetective.setup_command_line(['--admin_account', '555555555555', '--assume_role', 'detectiveAdmin',
+                                               '--input_file', 'accounts.csv', '--shards', '2', '--skip_prompt'])
+    admin_session = Mock()
+    clients = {'us-east-1': Mock(), 'us-east-2': Mock()}
+    admin_session.client.side_effect = lambda service, region_name: clients[region_name]
+    created = []
+
+    def create_graph(**kwargs):
+        created.append(kwargs)
+        return {'GraphArn': 'arn:aws:detective:us-east-1:555555555555:graph:new'}
+
+    clients['us-east-1'].create_graph.side_effect = create_graph
+    clients['us-east-1'].list_graphs.return_value = {'GraphList': []}
+    clients['us-east-2'].list_graphs.side_effect = Exception('AccessDenied')
+    processed = []
+
+    def process(shard, regions, session, shard_args):
+        processed.append(regions)
+        return helper.new_report()
+
+    with patch.object(helper, 'get_graphs', side_effect=lambda d_client: d_client.list_graphs()['GraphList']):
+        with patch.object(sharding.concurrent.futures, 'ProcessPoolExecutor', sharding.concurrent.futures.ThreadPoolExecutor):
+            with patch.object(helper, 'session_from_credentials'):
+                with patch.object(logs, 'setup_logging_from_args'), patch.object(logs, 'stop_logging'):
+                    report = sharding.sharded(process, 2, prepare=enableDetective.create_graphs)(
+                        aws_account_dict, ['us-east-1', 'us-east-2'], admin_session, args)
+
+    # a single graph for the two shards, which only process the region that has one
+    assert len(created) == 1
+    assert processed == [['us-east-1'], ['us-east-1']]
+    # the accounts can't be added where the graphs could not be listed
+    assert report['failed'] == {'us-east-2': set(aws_account_dict.keys())}
+
+
+###
+# The purpose of this test is to make sure the session built from handed over credentials assumes the
+# admin role again when they near expiry in amazon_detective_multiaccount_utilities.py
+###
+def test_session_from_credentials_refresh():
+    expiry = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=5)
+    credentials = {'aws_access_key_id': 'a', 'aws_secret_access_key': 'b', 'aws_session_token': 'c',
+                   'expiry_time': expiry.isoformat()}
+    fresh = {'aws_access_key_id': 'd', 'aws_secret_access_key': 'e', 'aws_session_token': 'f',
+             'expiry_time': (expiry + datetime.timedelta(hours=1)).isoformat()}
+    refresh = Mock(return_value=fresh)
+
+    # without expiry, the credentials are used as they are
+    session = helper.session_from_credentials({k: v for k, v in credentials.items() if k != 'expiry_time'}, refresh)
+    assert session.get_credentials().get_frozen_credentials().access_key == 'a'
+
+    # 5 minutes before expiry, the credentials are refreshed before being used
+    session = helper.session_from_credentials(credentials, refresh)
+    assert session.get_credentials().get_frozen_credentials().access_key == 'd'
+    assert session.get_credentials().get_frozen_credentials().access_key == 'd'
+    refresh.assert_called_once_with()
+
+    # the expiry of the assumed sessions is handed over with their credentials
+    with patch.object(helper, '_sts_client') as sts_mock:
+        sts_client = Mock()
+        sts_mock.return_value = (sts_client, 'global')
+        sts_client.get_caller_identity.return_value = {"Arn": "arn:aws:iam::555555555555:user/admin"}
+        sts_client.assume_role.return_value = {"Credentials": {"AccessKeyId": "a", "SecretAccessKey": "b",
+                                                               "SessionToken": "c", "Expiration": expiry}}
+        assumed = helper.assume_role("555555555555", "detectiveAdmin", "test")
+    assert helper.get_session_credentials(assumed) == credentials
+    refresh = sharding._refresh_admin_credentials(argparse.Namespace(admin_account='555555555555', assume_role='detectiveAdmin'),
+                                                  'AmazonDetectiveMultiAccountScripts_Shard1')
+    with patch.object(helper, 'assume_role', return_value=assumed) as assume_role_mock:
+        assert refresh() == credentials
+    assume_role_mock.assert_called_once_with('555555555555', 'detectiveAdmin', 'AmazonDetectiveMultiAccountScripts_Shard1')
+    assert sharding._refresh_admin_credentials(argparse.Namespace(), 'AmazonDetectiveMultiAccountScripts_Shard1') is None
+
+
+###
+# The purpose of this test is to make sure a failed write is rolled back and doesn't stop the
+# later ones in amazon_detective_multiaccount_state.py
+###
+def test_state_store_failed_write(tmp_path):
+    store = state.StateStore(str(tmp_path / "state.db"))
+    graph = "arn:aws:detective:us-east-1:555555555555:graph:1"
+    # a member without Status fails the write after the sweep rows were written
+    with pytest.raises(KeyError):
+        store.record_members("us-east-1", graph, [{"AccountId": "111111111111", "Status": "ENABLED"},
+                                                  {"AccountId": "222222222222"}], full_sweep=True)
+    assert store.members() == []
+
+    store.record_members("us-east-1", graph, [{"AccountId": "111111111111", "Status": "ENABLED"}])
+    store.record_operation("us-east-1", graph, "create_members", "created", ["333333333333"])
+    assert sorted(x["account_id"] for x in store.members()) == ["111111111111", "333333333333"]
+    store.close()
+
+
+###
+# The purpose of this test is to make sure the regions stop listing when the consumer of
+# stream_inventory() stops early in inventoryDetective.py
+###
+def test_inventory_detective_early_close():
+    admin_session = Mock()
+    clients = {'us-east-1': Mock(), 'eu-west-1': Mock()}
+    admin_session.client.side_effect = lambda service, region_name: clients[region_name]
+    for client in clients.values():
+        client.list_graphs.return_value = {"GraphList": [{"Arn": "graph-1"}]}
+        # an endless graph, the listing only stops when the queue stays full
+        client.list_members.return_value = {"MemberDetails": [{"AccountId": "111111111111", "Status": "ENABLED"}],
+                                            "NextToken": "token"}
+
+    def _consume():
+        rows = inventoryDetective.stream_inventory(admin_session, list(clients), 2)
+        next(rows)
+        rows.close()
+
+    with patch.object(inventoryDetective, 'MAX_PENDING_ROWS', 2):
+        thread = threading.Thread(target=_consume, daemon=True)
+        thread.start()
+        thread.join(timeout=10)
+    assert not thread.is_alive()
+
+
+###
+# The purpose of this test is to make sure the queue workers assume the admin role again when
+# their credentials near expiry in amazon_detective_multiaccount_workqueue.py
+###
+def test_run_worker_refresh_credentials(tmp_path):
+    workqueue.SqliteWorkQueue(str(tmp_path / "queue.db")).close()
+    args = argparse.Namespace(admin_account='555555555555', assume_role='detectiveAdmin')
+    credentials = {'aws_access_key_id': 'a', 'aws_secret_access_key': 'b', 'aws_session_token': 'c'}
+
+    with patch.object(helper, 'session_from_credentials') as session_mock:
+        with patch.object(logs, 'setup_logging_from_args'), patch.object(logs, 'stop_logging'):
+            workqueue.run_worker(str(tmp_path / "queue.db"), credentials, args)
+    assert session_mock.call_args[0][0] == credentials
+    refresh = session_mock.call_args[0][1]
+    with patch.object(helper, 'assume_role') as assume_role_mock:
+        with patch.object(helper, 'get_session_credentials', return_value=credentials):
+            assert refresh() == credentials
+    assume_role_mock.assert_called_once_with('555555555555', 'detectiveAdmin', 'AmazonDetectiveMultiAccountScripts_QueueWorker')
+
+
 ###
 # The purpose of this test is to make sure exception brunch in collect_session_and_regions()
 # runs correctly in amazon_detective_multiaccount_utilities.py
@@ -676,6 +2393,8 @@ def test_additionally_process_accounts_enable_detective():
 
     args = Mock()
     args.assume_role = None
+    args.account_major_acceptance = False
+    args.repair_attempts = 0
     detective_regions1 = ['us-east-2']
     aws_account_dict = {"123456789012": "random@gmail.com", "111111111111": "test1@gmail.com",
                         "222222222222": "test2@gmail.com", "333333333333": "test3@gmail.com"}
@@ -691,16 +2410,17 @@ def test_additionally_process_accounts_enable_detective():
 
     # If the new account was first not in the pending list nor the verification failure list,
     # and then get added to the pending list in the second run
+    # The graph is listed once, then only the new account is looked up while waiting
     enableDetective.enable_detective = Mock(return_value=["graph1"])
     helper.get_members = Mock(side_effect=[[{"graph1": {"123456789012", "111111111111", "222222222222", "333333333333"}},
                                             {"graph1": set()},
-                                            {"graph1": set()}],
-                                           [{"graph1": {"123456789012", "111111111111", "222222222222", "333333333333"}},
-                                            {"graph1": set()},
-                                            {"graph1": set()}],
-                                           [{"graph1": {"123456789012", "111111111111", "222222222222", "333333333333"}},
-                                            {"graph1": {"222222222222"}},
                                             {"graph1": set()}]])
+    helper.get_members_by_ids = Mock(side_effect=[[{"graph1": {"222222222222"}},
+                                                   {"graph1": set()},
+                                                   {"graph1": set()}],
+                                                  [{"graph1": {"222222222222"}},
+                                                   {"graph1": {"222222222222"}},
+                                                   {"graph1": set()}]])
     enableDetective.create_members = Mock(return_value={"222222222222"})
 
     with patch.object(enableDetective, "accept_invitations") as accept_inv:
@@ -713,19 +2433,22 @@ def test_additionally_process_accounts_enable_detective():
                 assert logging_info_mock.call_args_list == [call("Sleeping for 10s to allow new members' invitations to propagate."),
                                                             call("Not invited accounts found: Waiting for 30 seconds for {'222222222222'} accounts"),
                                                             ]
-                accept_inv.assert_called_once()
+                accept_inv.assert_called_once_with(None, {"222222222222"}, "graph1", "us-east-2", set())
+                assert helper.get_members.call_count == 1
+                assert helper.get_members_by_ids.call_count == 2
 
     # If a graph has a new account that is not in the pending list or verification failure list
     enableDetective.enable_detective = Mock(return_value=["graph1"])
     helper.get_members = Mock(return_value=[{"graph1": {"123456789012", "111111111111", "222222222222", "333333333333"}},
                                             {"graph1": {"222222222222"}},
                                             {"graph1": {"333333333333"}}])
+    helper.get_members_by_ids = helper.get_members
     enableDetective.create_members = Mock(return_value={"111111111111"})
 
-    with pytest.raises(SystemExit) as e:
+    with patch.object(enableDetective, "accept_invitations") as accept_inv:
         with patch.object(time, 'sleep') as time_sleep:
             with patch.object(logging, 'info') as logging_info_mock:
-                enableDetective.process_accounts_enable_detective(aws_account_dict, detective_regions1, admin_session, args)
+                report = enableDetective.process_accounts_enable_detective(aws_account_dict, detective_regions1, admin_session, args)
                 # one graph could be called 7 times time.sleep because recheck_set will not get empty
                 assert time_sleep.call_count == 7
                 assert logging_info_mock.call_count == 10
@@ -741,7 +2464,10 @@ def test_additionally_process_accounts_enable_detective():
                                                             call("Please verify provided information for above listed accounts and "
                                                                  "run the script again with all accounts for invitation acceptance")
                                                             ]
-                assert e.type == SystemExit
+                # the invitations are not accepted, and the accounts are reported instead of exiting
+                accept_inv.assert_not_called()
+                assert report['recheck'] == {'us-east-2': {'111111111111'}}
+                assert report['verification_failed'] == {'us-east-2': {'333333333333'}}
 
     # If two graphs have a new account that is not in the pending list or verification failure list
     enableDetective.enable_detective = Mock(return_value=["graph1"])
@@ -749,22 +2475,25 @@ def test_additionally_process_accounts_enable_detective():
                                              "graph2": {"123456789012", "111111111111", "222222222222", "333333333333"}},
                                             {"graph1": {"222222222222"}, "graph2": {"222222222222"}},
                                             {"graph1": {"333333333333"}, "graph2": {"333333333333"}}])
+    helper.get_members_by_ids = helper.get_members
     enableDetective.create_members = Mock(return_value={"111111111111"})
 
-    with pytest.raises(SystemExit) as e:
+    with patch.object(enableDetective, "accept_invitations") as accept_inv:
         with patch.object(time, 'sleep') as time_sleep:
             with patch.object(logging, 'info') as logging_info_mock:
-                enableDetective.process_accounts_enable_detective(aws_account_dict, detective_regions1, admin_session, args)
+                report = enableDetective.process_accounts_enable_detective(aws_account_dict, detective_regions1, admin_session, args)
                 # one graph could be called 7 times time.sleep because recheck_set will not get empty
                 assert time_sleep.call_count == 14
                 assert logging_info_mock.call_count == 20
-                assert e.type == SystemExit
+                accept_inv.assert_not_called()
+                assert report['recheck'] == {'us-east-2': {'111111111111'}}
 
     # If graph has new account that is in the pending list or verification failure list
     enableDetective.enable_detective = Mock(return_value=["graph1"])
     helper.get_members = Mock(return_value=[{"graph1": {"123456789012", "111111111111", "222222222222", "333333333333"}},
                                             {"graph1": {"222222222222"}},
                                             {"graph1": {"333333333333"}}])
+    helper.get_members_by_ids = helper.get_members
     enableDetective.create_members = Mock(return_value={"222222222222"})
 
     with patch.object(enableDetective, "accept_invitations") as accept_inv: